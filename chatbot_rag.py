@@ -7,6 +7,7 @@ from utils.langchain import LangChainAssistant
 from utils.shopping_agent import ShoppingAssistant
 from utils.studio_style import apply_studio_style
 from utils.studio_style import keyword_label
+from utils.prompts import RAG_MODEL_ID, RAG_PROMPT
 
 if "user_id" in st.session_state:
     user_id = st.session_state["user_id"]
@@ -32,7 +33,7 @@ def write_top_bar():
 
 clear = write_top_bar()
 
-modelId="anthropic.claude-instant-v1"
+modelId=RAG_MODEL_ID
 
 keywords = [f'Model Id: {modelId}','Amazon Bedrock','Langchain', 'Vector Store: MongoDB Atlas']
 formatted_labels = [keyword_label(keyword) for keyword in keywords]
@@ -42,20 +43,10 @@ apply_studio_style()
 
 @st.cache_resource(ttl=1800)
 def load_assistant():
-    prompt_data = """You are ShoppingBot, a friendly conversationalretail assistant.
-    ShoppingBot is a chatbot made available by company 'AnyCompanyRetail'.
-    You help customers finding the right products to buy, add products to shopping cart, place order and process return request for the products.
-    You should ALWAYS answer user inquiries based on the context provided and avoid making up answers.
-    If you don't know the answer, simply state that you don't know. Do NOT make answers and hyperlinks on your own.
-
-    <context>
-    {context}
-    </context
-    
-    <question>{question}</question>"""
+    prompt_data = RAG_PROMPT
     
     #assistant = LangChainAssistant(modelId=modelId, retriever= get_retriver(), prompt_data= prompt_data)
-    assistant = ShoppingAssistant(modelId= modelId, prompt_data=prompt_data, model_type="chat_doc", logger=st.session_state.logger)
+    assistant = ShoppingAssistant(modelId= modelId, prompt_data=prompt_data, model_type="chat_doc", logger=st.session_state.logger, use_answer_cache=True)
 
     return assistant
 
@@ -78,7 +69,7 @@ def main():
 
     if clear:
         st.session_state.messages = []
-        assistant.clear_history()
+        assistant.clear_history(session_id=user_id)
 
     if "messages" not in st.session_state:
         st.session_state.messages = []
@@ -97,8 +88,10 @@ def main():
             full_response = ""
 
             # prompt = prompt_fixer(prompt)
-            #result  = assistant.chat_doc(prompt)
-            result  = assistant.run(prompt)
+            for token in assistant.stream(prompt, session_id=user_id):
+                full_response += token
+                message_placeholder.markdown(full_response + "▌")
+            result = full_response
 
             message_placeholder.markdown(result)
 
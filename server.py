@@ -0,0 +1,283 @@
+"""Headless HTTP entry point of the assistants, for the web and mobile frontends.
+
+    uvicorn server:app --host 0.0.0.0 --port 8501
+
+POST /chat          {"session_id": "...", "message": "...", "assistant": "chat_agent"} -> {"answer": "..."}
+POST /chat/stream   same body, the answer as server-sent events: data: {"token": "..."}, then
+                    "event: done" (or "event: error")
+POST /clear         {"session_id": "...", "assistant": "chat_agent"}
+GET  /health        200 once the assistants are warm, 503 before that and while shutting down
+GET  /stats         pool, rate limiter, coalescing and routing state
+GET  /metrics       Prometheus metrics, see utils.tracing
+
+"assistant" is optional and defaults to the first of SERVER_ASSISTANTS. The assistants are
+served from a pool of warm instances with bounded queues, see utils.serving: a request that
+does not fit gets a 503 with a Retry-After header.
+"""
+import asyncio
+import contextlib
+import functools
+import json
+import logging
+
+from utils.load_env import load_env
+from utils.prompts import AGENT_GREETING, AGENT_MODEL_ID, AGENT_PROMPT, RAG_MODEL_ID, RAG_PROMPT
+from utils.serving import AssistantPool, Overloaded, ShuttingDown
+
+logger = logging.getLogger('chatbot')
+
+MAX_BODY_BYTES = 64 * 1024
+# An SSE comment is sent when no token came for this long, under the ALB idle timeout (60s)
+KEEPALIVE_SECONDS = 15
+
+
+def chat_doc():
+    from utils.shopping_agent import ShoppingAssistant
+    return ShoppingAssistant(modelId=RAG_MODEL_ID, prompt_data=RAG_PROMPT, model_type="chat_doc", logger=logger,
+                             use_answer_cache=True)
+
+
+def chat_agent():
+    from utils.shopping_agent import ShoppingAssistant
+    return ShoppingAssistant(modelId=AGENT_MODEL_ID, prompt_data=AGENT_PROMPT, model_type="chat_agent", logger=logger)
+
+
+ASSISTANTS = {"chat_doc": chat_doc, "chat_agent": chat_agent}
+GREETINGS = {"chat_agent": AGENT_GREETING}
+
+
+class HTTPError(Exception):
+    def __init__(self, status, message, headers=()):
+        super().__init__(message)
+        self.status = status
+        self.headers = list(headers)
+
+
+class Disconnected(Exception):
+    pass
+
+
+class App:
+    def __init__(self, factories=ASSISTANTS, env_path=".env"):
+        self.factories = factories
+        self.env_path = env_path
+        self.pool = None
+        self.shutdown_timeout = 25.0
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] == "lifespan":
+            return await self.lifespan(receive, send)
+        if scope["type"] == "http":
+            return await self.http(scope, receive, send)
+
+    async def lifespan(self, receive, send):
+        while True:
+            message = await receive()
+            if message["type"] == "lifespan.startup":
+                try:
+                    await self.startup()
+                except Exception as e:
+                    logger.exception("Could not start the assistants")
+                    await send({"type": "lifespan.startup.failed", "message": str(e)})
+                    return
+                await send({"type": "lifespan.startup.complete"})
+            elif message["type"] == "lifespan.shutdown":
+                await self.shutdown()
+                await send({"type": "lifespan.shutdown.complete"})
+                return
+
+    async def startup(self):
+        env = load_env(self.env_path)
+        # Under the 30s ECS stop timeout by default
+        self.shutdown_timeout = float(env.get('SERVER_SHUTDOWN_TIMEOUT', 25))
+        self.pool = AssistantPool.from_env(env, self.factories)
+        await self.pool.start()
+
+    async def shutdown(self):
+        from utils.clients import close_all
+        if self.pool is not None:
+            left = await self.pool.drain(self.shutdown_timeout)
+            if left:
+                logger.warning(f"Shutting down with {left} requests in progress")
+        close_all()
+
+    async def http(self, scope, receive, send):
+        route = (scope["method"], scope["path"].rstrip("/") or "/")
+        handler = {
+            ("POST", "/chat"): self.chat,
+            ("POST", "/chat/stream"): self.chat_stream,
+            ("POST", "/clear"): self.clear,
+            # The default health check path of the ALB target group
+            ("GET", "/"): self.health,
+            ("GET", "/health"): self.health,
+            ("GET", "/stats"): self.stats,
+            ("GET", "/metrics"): self.metrics,
+        }.get(route)
+        try:
+            if handler is None:
+                raise HTTPError(404, "not found")
+            if self.pool is None or not self.pool.ready:
+                raise HTTPError(503, "starting", [(b"retry-after", b"5")])
+            await handler(scope, receive, send)
+        except HTTPError as e:
+            await send_json(send, e.status, {"error": str(e)}, e.headers)
+        except Overloaded as e:
+            await send_json(send, 503, {"error": str(e)}, [(b"retry-after", str(e.retry_after).encode())])
+        except ShuttingDown as e:
+            await send_json(send, 503, {"error": str(e)}, [(b"connection", b"close")])
+        except Disconnected:
+            pass
+        except Exception:
+            logger.exception(f"{scope['method']} {scope['path']} failed")
+            await send_json(send, 500, {"error": "internal error"})
+
+    async def read_request(self, receive):
+        body = b""
+        while True:
+            message = await receive()
+            if message["type"] == "http.disconnect":
+                raise Disconnected()
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_BYTES:
+                raise HTTPError(413, "request too large")
+            if not message.get("more_body"):
+                break
+        try:
+            request = json.loads(body or b"{}")
+        except ValueError:
+            raise HTTPError(400, "invalid JSON") from None
+        if not isinstance(request, dict):
+            raise HTTPError(400, "expected a JSON object")
+        session_id = request.get("session_id")
+        if not isinstance(session_id, str) or not session_id:
+            raise HTTPError(400, "session_id is required")
+        assistant_type = request.get("assistant") or next(iter(self.pool.pools))
+        if assistant_type not in self.pool.pools:
+            raise HTTPError(404, f"unknown assistant {assistant_type!r}, expected one of {list(self.pool.pools)}")
+        return request, session_id, assistant_type
+
+    @staticmethod
+    def message(request):
+        message = request.get("message")
+        if not isinstance(message, str) or not message.strip():
+            raise HTTPError(400, "message is required")
+        return message
+
+    async def chat(self, scope, receive, send):
+        request, session_id, assistant_type = await self.read_request(receive)
+        message = self.message(request)
+
+        async def answer():
+            async with self.pool.turn(assistant_type, session_id) as assistant:
+                return await assistant.arun(message, session_id=session_id)
+
+        answer = await until_disconnect(receive, answer())
+        await send_json(send, 200, {"session_id": session_id, "answer": answer})
+
+    async def chat_stream(self, scope, receive, send):
+        request, session_id, assistant_type = await self.read_request(receive)
+        message = self.message(request)
+
+        async def stream():
+            # The turn is admitted before the response starts, so overload is still a 503
+            async with self.pool.turn(assistant_type, session_id) as assistant:
+                await send({"type": "http.response.start", "status": 200,
+                            "headers": [(b"content-type", b"text/event-stream"), (b"cache-control", b"no-cache"),
+                                        (b"x-accel-buffering", b"no")]})
+                try:
+                    async for token in keepalive(assistant.astream(message, session_id=session_id)):
+                        await send_event(send, None if token is None else {"token": token})
+                except Exception as e:
+                    logger.exception("Streaming failed")
+                    await send_event(send, {"error": str(e)}, event="error", more_body=False)
+                    return
+                await send_event(send, {}, event="done", more_body=False)
+
+        await until_disconnect(receive, stream())
+
+    async def clear(self, scope, receive, send):
+        request, session_id, assistant_type = await self.read_request(receive)
+        async with self.pool.turn(assistant_type, session_id) as assistant:
+            # A MongoDB write with MEMORY_STORE=mongo, off the event loop
+            await asyncio.get_running_loop().run_in_executor(None, functools.partial(
+                assistant.clear_history, session_id=session_id, initial_text=GREETINGS.get(assistant_type)))
+        await send_json(send, 200, {"session_id": session_id, "cleared": True})
+
+    async def health(self, scope, receive, send):
+        if not self.pool.accepting:
+            raise ShuttingDown("the server is shutting down")
+        await send_json(send, 200, {"status": "ok"})
+
+    async def stats(self, scope, receive, send):
+        from utils.model_routing import model_router
+        from utils.ratelimit import bedrock_limiter
+        from utils.singleflight import single_flight
+        await send_json(send, 200, {"pool": self.pool.stats(), "rate_limits": bedrock_limiter.stats(),
+                                    "coalescing": single_flight.stats(), "routing": model_router.stats()})
+
+    async def metrics(self, scope, receive, send):
+        from utils.tracing import tracer
+        await send_body(send, 200, tracer.render_prometheus().encode("utf-8"), b"text/plain; version=0.0.4")
+
+
+async def until_disconnect(receive, coroutine):
+    """Runs `coroutine`, cancelled if the client goes away first so that its turn frees its slot"""
+    task = asyncio.ensure_future(coroutine)
+
+    async def watch():
+        while (await receive())["type"] != "http.disconnect":
+            pass
+
+    watcher = asyncio.ensure_future(watch())
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    finally:
+        watcher.cancel()
+    if not task.done():
+        task.cancel()
+        with contextlib.suppress(asyncio.CancelledError):
+            await task
+        raise Disconnected()
+    return task.result()
+
+
+async def keepalive(tokens):
+    """The tokens, with a None every KEEPALIVE_SECONDS without one"""
+    iterator = tokens.__aiter__()
+    next_token = asyncio.ensure_future(iterator.__anext__())
+    try:
+        while True:
+            done, _ = await asyncio.wait({next_token}, timeout=KEEPALIVE_SECONDS)
+            if not done:
+                yield None
+                continue
+            try:
+                token = next_token.result()
+            except StopAsyncIteration:
+                return
+            yield token
+            next_token = asyncio.ensure_future(iterator.__anext__())
+    finally:
+        if not next_token.done():
+            next_token.cancel()
+
+
+async def send_body(send, status, body, content_type, headers=()):
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", content_type), (b"content-length", str(len(body)).encode()), *headers]})
+    await send({"type": "http.response.body", "body": body})
+
+
+async def send_json(send, status, payload, headers=()):
+    await send_body(send, status, json.dumps(payload).encode("utf-8"), b"application/json", headers)
+
+
+async def send_event(send, data, event=None, more_body=True):
+    if data is None:
+        chunk = b": keep-alive\n\n"
+    else:
+        chunk = (f"event: {event}\n" if event else "").encode() + f"data: {json.dumps(data)}\n\n".encode("utf-8")
+    await send({"type": "http.response.body", "body": chunk, "more_body": more_body})
+
+
+app = App()
@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+
+from utils import answer_cache as answer_cache_module
+from utils.answer_cache import SemanticAnswerCache
+
+
+class FixedEmbeddings:
+    """Embeds the questions of `vectors`, so tests choose the similarities"""
+
+    def __init__(self, vectors):
+        self.vectors = vectors
+
+    def embed_query(self, text):
+        return self.vectors[text]
+
+    async def aembed_query(self, text):
+        return self.vectors[text]
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = FakeClock()
+    monkeypatch.setattr(answer_cache_module, "time", clock)
+    return clock
+
+
+EMBEDDINGS = FixedEmbeddings({
+    "red shoes": [1.0, 0.0],
+    "red shoe": [0.99, 0.1],
+    "blue hat": [0.0, 1.0],
+    "reddish hat": [0.8, 0.6],
+})
+
+
+def test_hit_above_threshold(clock):
+    cache = SemanticAnswerCache(EMBEDDINGS, threshold=0.95)
+    assert cache.lookup("red shoes") is None
+    cache.store("red shoes", "We have red sneakers", ["doc"])
+    assert cache.lookup("red shoe") == {"answer": "We have red sneakers", "source_documents": ["doc"]}
+    assert cache.lookup("reddish hat") is None
+    assert cache.stats() == {"entries": 1, "hits": 1, "misses": 2}
+
+
+def test_threshold_is_configurable(clock):
+    cache = SemanticAnswerCache(EMBEDDINGS, threshold=0.75)
+    cache.store("red shoes", "We have red sneakers")
+    assert cache.lookup("reddish hat")["answer"] == "We have red sneakers"
+
+
+def test_ttl(clock):
+    cache = SemanticAnswerCache(EMBEDDINGS, ttl=60)
+    cache.store("red shoes", "We have red sneakers")
+    clock.now += 61
+    assert cache.lookup("red shoes") is None
+    assert cache.stats()["entries"] == 0
+
+
+def test_max_entries_evicts_oldest(clock):
+    cache = SemanticAnswerCache(EMBEDDINGS, max_entries=1)
+    cache.store("red shoes", "shoes")
+    cache.store("blue hat", "hats")
+    assert cache.lookup("red shoes") is None
+    assert cache.lookup("blue hat")["answer"] == "hats"
+
+
+def test_catalog_version_change_clears(clock):
+    version = {"value": 1}
+    cache = SemanticAnswerCache(EMBEDDINGS, catalog_version=lambda: version["value"], version_check_interval=30)
+    cache.store("red shoes", "shoes")
+    version["value"] = 2
+    # Polled at most every version_check_interval seconds
+    assert cache.lookup("red shoes") is not None
+    clock.now += 31
+    assert cache.lookup("red shoes") is None
+
+
+def test_async_path(clock):
+    cache = SemanticAnswerCache(EMBEDDINGS)
+
+    async def run():
+        await cache.astore("blue hat", "hats")
+        return await cache.alookup("blue hat")
+
+    assert asyncio.run(run())["answer"] == "hats"
@@ -0,0 +1,47 @@
+import pytest
+
+from utils.decompose import QueryDecomposer, intent_quotas
+from utils.ingest import SELECTED_CATEGORIES
+from utils.query_filters import QueryConstraintExtractor
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("a hat and matching earrings for a wedding", ["a hat for a wedding", "matching earrings for a wedding"]),
+    ("boots, a ring and a beanie", ["boots", "a ring", "a beanie"]),
+    ("sandals plus a bag under 50 dollars", ["sandals under 50 dollars", "a bag under 50 dollars"]),
+])
+def test_split(query, expected):
+    decomposer = QueryDecomposer()
+    assert decomposer.split(query) == expected
+    assert decomposer.counters == {"queries": 1, "decomposed": 1}
+
+
+@pytest.mark.parametrize("query", [
+    "black and white sneakers",
+    "red boots",
+    "comfortable and warm",
+    # The last part refers back to the other products
+    "a ring and a necklace that match",
+    "boots and a case for them",
+    "shoes and a bag that go together",
+    "a bracelet and earrings that match each other",
+])
+def test_single_query(query):
+    decomposer = QueryDecomposer()
+    assert decomposer.split(query) == [query]
+    assert decomposer.counters["decomposed"] == 0
+
+
+def test_max_intents():
+    assert QueryDecomposer(max_intents=2).split("boots, a ring and a beanie") == ["boots, a ring and a beanie"]
+
+
+def test_from_extractor():
+    decomposer = QueryDecomposer.from_extractor(QueryConstraintExtractor({"product_type": SELECTED_CATEGORIES}))
+    assert decomposer.split("a fashion ring and a cosmetic case") == ["a fashion ring", "a cosmetic case"]
+    assert decomposer.split("fashion and fine jewelry") == ["fashion and fine jewelry"]
+
+
+def test_intent_quotas():
+    assert intent_quotas(7, 3) == [3, 2, 2]
+    assert intent_quotas(2, 3) == [1, 1, 1]
@@ -0,0 +1,93 @@
+import asyncio
+
+from langchain_core.embeddings import Embeddings
+
+from utils.embedding_cache import CachedEmbeddings, normalize_text
+
+
+class CountingEmbeddings(Embeddings):
+    model_id = "fake-embeddings"
+
+    def __init__(self):
+        self.texts = []
+
+    def embed_documents(self, texts):
+        self.texts += texts
+        return [[float(len(text)), 1.0] for text in texts]
+
+    def embed_query(self, text):
+        return self.embed_documents([text])[0]
+
+
+def disk_rows(cache):
+    return cache._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0]
+
+
+def test_normalize_text():
+    assert normalize_text("  Red  SHOES ") == "red shoes"
+
+
+def test_memory_hits():
+    inner = CountingEmbeddings()
+    cache = CachedEmbeddings(inner)
+    assert cache.embed_query("Red shoes") == cache.embed_query("red  shoes")
+    assert inner.texts == ["Red shoes"]
+    assert cache.stats()["hits"] == 1 and cache.stats()["misses"] == 1
+
+
+def test_embed_documents_only_embeds_missing_texts():
+    inner = CountingEmbeddings()
+    cache = CachedEmbeddings(inner)
+    cache.embed_query("hat")
+    vectors = cache.embed_documents(["hat", "ring", "ring", "scarf"])
+    assert inner.texts == ["hat", "ring", "scarf"]
+    assert vectors[1] == vectors[2] == [4.0, 1.0]
+
+
+def test_disk_tier_survives_restart(tmp_path):
+    path = str(tmp_path / "embeddings.sqlite")
+    CachedEmbeddings(CountingEmbeddings(), db_path=path).embed_documents(["hat", "ring"])
+
+    inner = CountingEmbeddings()
+    cache = CachedEmbeddings(inner, db_path=path)
+    assert cache.embed_query("ring") == [4.0, 1.0]
+    assert inner.texts == []
+    assert cache.stats()["disk_hits"] == 1
+
+
+def test_disk_eviction_keeps_row_count(tmp_path):
+    cache = CachedEmbeddings(CountingEmbeddings(), db_path=str(tmp_path / "e.sqlite"), max_entries=2,
+                             max_disk_entries=5)
+    for i in range(8):
+        cache.embed_query(f"text {i}")
+    # Stored again, not a new row
+    cache._store([(cache._key("text 7"), [0.0, 0.0])])
+    assert disk_rows(cache) == cache._disk_count == 5
+
+    reopened = CachedEmbeddings(CountingEmbeddings(), db_path=str(tmp_path / "e.sqlite"), max_disk_entries=5)
+    assert reopened._disk_count == 5
+    # The least recently used rows were evicted
+    assert not reopened._get_disk([reopened._key("text 0")])
+
+
+def test_async_path(tmp_path):
+    inner = CountingEmbeddings()
+    cache = CachedEmbeddings(inner, db_path=str(tmp_path / "e.sqlite"))
+
+    async def run():
+        first = await cache.aembed_query("hat")
+        documents = await cache.aembed_documents(["hat", "ring"])
+        return first, documents
+
+    first, documents = asyncio.run(run())
+    assert documents == [first, [4.0, 1.0]]
+    assert inner.texts == ["hat", "ring"]
+    assert disk_rows(cache) == 2
+
+
+def test_clear(tmp_path):
+    cache = CachedEmbeddings(CountingEmbeddings(), db_path=str(tmp_path / "e.sqlite"))
+    cache.embed_documents(["hat", "ring"])
+    cache.clear()
+    assert disk_rows(cache) == cache._disk_count == 0
+    assert cache.stats()["memory_entries"] == 0
@@ -0,0 +1,55 @@
+from utils.hybrid import SOURCE_FIELD, BM25Index, reciprocal_rank_fusion, split_rankings, tokenize
+from utils.records import ProductRecord
+
+
+def records(*ids):
+    return [ProductRecord(id=i, item_name=f"item {i}") for i in ids]
+
+
+def keys(ranking):
+    return [record.key for record in ranking]
+
+
+def test_rrf_favors_documents_ranked_by_both():
+    vector = records("a", "b", "c")
+    text = records("c", "d", "a")
+    assert keys(reciprocal_rank_fusion([vector, text], [1.0, 1.0], k=4)) == ["a", "c", "b", "d"]
+
+
+def test_rrf_weights_and_k():
+    vector = records("a", "b")
+    text = records("c", "d")
+    assert keys(reciprocal_rank_fusion([vector, text], [1.0, 2.0], k=3)) == ["c", "d", "a"]
+    # A zero weight leaves a ranking out
+    assert keys(reciprocal_rank_fusion([vector, text], [1.0, 0.0], k=4)) == ["a", "b"]
+
+
+def test_rrf_keeps_the_first_record_of_a_key():
+    vector = [ProductRecord(id="a", item_name="from vector", score=0.9)]
+    text = [ProductRecord(id="a", item_name="from text", score=12.0)]
+    [record] = reciprocal_rank_fusion([vector, text], [1.0, 1.0], k=1)
+    assert record.item_name == "from vector"
+
+
+def test_split_rankings_sorts_each_source():
+    results = [
+        {"_id": 1, "item_name": "hat", "score": 0.5, SOURCE_FIELD: "vector"},
+        {"_id": 2, "item_name": "cap", "score": 3.0, SOURCE_FIELD: "text"},
+        {"_id": 3, "item_name": "scarf", "score": 0.8, SOURCE_FIELD: "vector"},
+        {"_id": 4, "item_name": "beanie", "score": 7.0, SOURCE_FIELD: "text"},
+    ]
+    vector, text = split_rankings(results)
+    assert keys(vector) == ["3", "1"]
+    assert keys(text) == ["4", "2"]
+
+
+def test_bm25_ranks_exact_keywords():
+    index = BM25Index(["Nike Air running shoes", "Leather boots", "Running socks, pack of 3", "Nike cap"])
+    hits = index.search("nike running", k=3)
+    assert hits[0][0] == 0
+    assert {i for i, _ in hits} == {0, 2, 3}
+    # The shorter document ranks first on the same term
+    assert [i for i, _ in index.search("nike", k=5)] == [3, 0]
+    assert [i for i, _ in index.search("nike", k=5, candidates={0})] == [0]
+    assert index.search("sandals", k=3) == []
+    assert tokenize("Nike AIR-2") == ["nike", "air", "2"]
@@ -0,0 +1,25 @@
+import mongomock
+
+from utils.answer_cache import bump_catalog_version
+from utils.local_vector import LocalVectorSearch
+
+
+class FakeEmbeddings:
+    def embed_query(self, text):
+        return [1.0, 0.0]
+
+
+def test_refresh_only_after_catalog_version_bump():
+    collection = mongomock.MongoClient().shop.products
+    collection.insert_one({"text": "Red shoes", "embedding": [1.0, 0.0]})
+    store = LocalVectorSearch(FakeEmbeddings(), collection=collection)
+    assert len(store.similarity_search("shoes", k=5)) == 1
+
+    collection.insert_one({"text": "Red hat", "embedding": [0.9, 0.1]})
+    assert not store.refresh_if_changed()
+    assert len(store.similarity_search("shoes", k=5)) == 1
+
+    bump_catalog_version(collection)
+    assert store.refresh_if_changed()
+    assert len(store.similarity_search("shoes", k=5)) == 2
+    assert not store.refresh_if_changed()
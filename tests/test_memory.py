@@ -0,0 +1,61 @@
+import threading
+import time
+
+import mongomock
+
+from utils.memory import ConversationMemory, InMemorySessionStore, MongoSessionStore
+
+
+def count_words(text):
+    return len(text.split())
+
+
+class SlowStore(InMemorySessionStore):
+    """Widens the window between the load and the save of a turn"""
+
+    def load(self, session_id):
+        state = super().load(session_id)
+        time.sleep(0.01)
+        return state
+
+
+class FakeSummaryLLM:
+    def __init__(self):
+        self.prompts = []
+
+    def predict(self, prompt):
+        self.prompts.append(prompt)
+        return "The shopper asked about hats."
+
+
+def test_concurrent_turns_are_all_saved():
+    memory = ConversationMemory(SlowStore(), max_tokens=10000, window_turns=100, count_tokens=count_words)
+    threads = [threading.Thread(target=memory.save_turn, args=("s1", f"question {i}", f"answer {i}"))
+               for i in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert sorted(m.content for m in memory.messages("s1") if m.type == "human") == [f"question {i}" for i in range(8)]
+
+
+def test_turns_leaving_the_window_are_summarized():
+    llm = FakeSummaryLLM()
+    memory = ConversationMemory(max_tokens=1000, window_turns=1, summary_llm=llm, count_tokens=count_words)
+    memory.save_turn("s1", "Do you sell hats?", "Yes")
+    memory.save_turn("s1", "And scarves?", "Yes")
+    assert len(llm.prompts) == 1 and "Do you sell hats?" in llm.prompts[0]
+    messages = memory.messages("s1")
+    assert messages[0].content.endswith("The shopper asked about hats.")
+    assert [m.content for m in messages[1:]] == ["And scarves?", "Yes"]
+
+
+def test_mongo_store_creates_its_index_on_first_write():
+    collection = mongomock.MongoClient().shop.chat_sessions
+    store = MongoSessionStore(collection, ttl=60)
+    assert list(collection.index_information()) == []
+    memory = ConversationMemory(store)
+    memory.save_turn("s1", "Do you sell hats?", "Yes")
+    memory.save_turn("s1", "And scarves?", "Yes")
+    assert collection.index_information()["updated_at_1"]["expireAfterSeconds"] == 60
+    assert len(memory.messages("s1")) == 4
@@ -0,0 +1,100 @@
+import json
+
+from utils.fake_bedrock import FakeBedrockRuntime
+from utils.model_routing import (COMPLEX_ANSWER, CONDENSE, FAST_MODEL, SIMPLE_ANSWER, TOOL_SELECTION, ModelRouter,
+                                 Route, RoutedBedrockClient, answer_route, parse_routes)
+
+PRIMARY_MODEL = "anthropic.claude-v2:1"
+BODY = json.dumps({"prompt": "\n\nHuman: hi\n\nAssistant:", "max_tokens_to_sample": 50})
+
+
+class SaturatedLimiter:
+    def __init__(self, *models):
+        self.models = set(models)
+
+    def saturated(self, model_id):
+        return model_id in self.models
+
+
+class RecordingClient:
+    def __init__(self, client):
+        self.client = client
+        self.models = []
+
+    def invoke_model(self, **kwargs):
+        self.models.append(kwargs["modelId"])
+        return self.client.invoke_model(**kwargs)
+
+
+def make_router(**kwargs):
+    return ModelRouter(limiter=None, min_samples=2, **kwargs)
+
+
+def test_off_unless_enabled_in_env():
+    router = ModelRouter(limiter=None, enabled=False)
+    router.configure_from_env({})
+    assert not router.enabled
+    assert router.candidates(CONDENSE, PRIMARY_MODEL) == [PRIMARY_MODEL]
+    router.configure_from_env({"MODEL_ROUTING": "true"})
+    assert router.enabled
+    assert router.candidates(CONDENSE, PRIMARY_MODEL) == [FAST_MODEL]
+
+
+def test_primary_and_other_providers():
+    router = make_router()
+    assert router.candidates(TOOL_SELECTION, PRIMARY_MODEL) == [PRIMARY_MODEL, FAST_MODEL]
+    # Claude Instant as the primary model is listed once
+    assert router.candidates(COMPLEX_ANSWER, FAST_MODEL) == [FAST_MODEL]
+    # Another provider needs another request body
+    assert router.candidates(CONDENSE, "meta.llama2-70b-chat-v1") == ["meta.llama2-70b-chat-v1"]
+
+
+def test_falls_back_over_budget_and_recovers():
+    router = make_router(routes={COMPLEX_ANSWER: Route(models=[PRIMARY_MODEL, FAST_MODEL], latency_budget=5.0)})
+    assert router.choose(COMPLEX_ANSWER, PRIMARY_MODEL) == PRIMARY_MODEL
+    router.observe(PRIMARY_MODEL, 9.0)
+    router.observe(PRIMARY_MODEL, 9.0)
+    assert router.choose(COMPLEX_ANSWER, PRIMARY_MODEL) == FAST_MODEL
+    assert router.decisions[-1]["reason"] == "over_budget"
+    router._latencies[PRIMARY_MODEL].samples.clear()
+    assert router.choose(COMPLEX_ANSWER, PRIMARY_MODEL) == PRIMARY_MODEL
+    assert router.stats() == {COMPLEX_ANSWER: {PRIMARY_MODEL: {"calls": 2, "fallbacks": 0},
+                                               FAST_MODEL: {"calls": 1, "fallbacks": 1}}}
+
+
+def test_falls_back_when_rate_limited_but_not_past_the_last_model():
+    router = ModelRouter(limiter=SaturatedLimiter(PRIMARY_MODEL, FAST_MODEL))
+    assert router.choose(TOOL_SELECTION, PRIMARY_MODEL) == FAST_MODEL
+    assert router.decisions[-1]["skipped"][0]["reason"] == "rate_limited"
+
+
+def test_parse_routes():
+    routes = parse_routes("condense=anthropic.claude-instant-v1@2; complex_answer=primary,anthropic.claude-instant-v1")
+    assert routes[CONDENSE].models == [FAST_MODEL] and routes[CONDENSE].latency_budget == 2.0
+    assert routes[COMPLEX_ANSWER].models == ["primary", FAST_MODEL]
+    assert routes[COMPLEX_ANSWER].latency_budget == 10.0
+
+
+def test_answer_route():
+    assert answer_route("do you have red sneakers") == SIMPLE_ANSWER
+    assert answer_route("compare the red and the blue sneakers") == COMPLEX_ANSWER
+
+
+def test_routed_client_swaps_the_model():
+    recording = RecordingClient(FakeBedrockRuntime())
+    router = make_router()
+    client = RoutedBedrockClient(recording, CONDENSE, PRIMARY_MODEL, router=router)
+    client.invoke_model(body=BODY, modelId=PRIMARY_MODEL)
+    assert recording.models == [FAST_MODEL]
+    assert len(router._latencies[FAST_MODEL].samples) == 1
+
+
+def test_stream_latency_is_time_to_first_chunk():
+    fake = FakeBedrockRuntime(completion="one two three four five six", completion_latency=0.05, token_latency=0.05,
+                              chunk_words=1)
+    router = make_router()
+    client = RoutedBedrockClient(fake, COMPLEX_ANSWER, PRIMARY_MODEL, router=router)
+    events = list(client.invoke_model_with_response_stream(body=BODY, modelId=PRIMARY_MODEL)["body"])
+    assert len(events) > 1
+    [(_, latency)] = router._latencies[PRIMARY_MODEL].samples
+    assert 0.05 <= latency < 0.15
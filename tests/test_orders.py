@@ -0,0 +1,127 @@
+import mongomock
+import pytest
+
+from utils import orders as orders_module
+from utils.orders import (DEMO_CUSTOMER, RETURNABLE_STATUS, InMemoryOrderStore, MongoOrderStore, OrderRepository,
+                          seed_sample_orders)
+
+
+def make_order(order_id, customer_id="alice", status=RETURNABLE_STATUS):
+    return {"orderId": order_id, "customerId": customer_id, "status": status, "shippingAddress": "1 Main St",
+            "items": [{"name": f"Item of {order_id}", "price": "10", "quantity": "1", "sku": "SKU-1"}]}
+
+
+@pytest.fixture
+def collection():
+    return mongomock.MongoClient().shop.orders
+
+
+@pytest.fixture
+def store(collection):
+    return MongoOrderStore(collection)
+
+
+class FakeClock:
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+
+def test_indexes(collection, store):
+    indexes = collection.index_information()
+    assert indexes["customer_status_order"]["key"] == [("customerId", 1), ("status", 1), ("orderId", -1)]
+    assert indexes["order_id"]["key"] == [("orderId", 1)]
+    assert indexes["order_id"]["unique"]
+
+
+def test_projection(collection, store):
+    collection.insert_one(make_order("OT1001"))
+    expected = {"orderId": "OT1001", "items": [{"name": "Item of OT1001", "price": "10", "quantity": "1"}]}
+    assert store.find_by_order_id("OT1001") == expected
+    assert store.find_by_status("alice").orders == [expected]
+
+
+def test_keyset_pagination(collection, store):
+    collection.insert_many([make_order(f"OT{1000 + i}") for i in range(25)])
+    seen = []
+    after = None
+    for expected_size in (10, 10, 5):
+        page = store.find_by_status("alice", after=after, limit=10)
+        assert len(page.orders) == expected_size
+        seen += [order["orderId"] for order in page.orders]
+        after = page.next_cursor
+    assert after is None
+    assert seen == sorted((f"OT{1000 + i}" for i in range(25)), reverse=True)
+
+
+def test_exact_page_has_no_next_cursor(collection, store):
+    collection.insert_many([make_order(f"OT{1000 + i}") for i in range(10)])
+    assert store.find_by_status("alice", limit=10).next_cursor is None
+
+
+def test_customer_scoping(collection, store):
+    collection.insert_many([make_order("OT1001"), make_order("OT1002", customer_id="bob"),
+                            make_order("OT1003", status="shipped")])
+    assert [o["orderId"] for o in store.find_by_status("alice").orders] == ["OT1001"]
+    assert [o["orderId"] for o in store.find_by_status("bob").orders] == ["OT1002"]
+    assert store.find_by_order_id("OT1002", customer_id="alice") is None
+    assert store.find_by_order_id("OT1002", customer_id="bob")["orderId"] == "OT1002"
+
+
+def test_repository_pages_with_more(collection, store):
+    collection.insert_many([make_order(f"OT{1000 + i}") for i in range(12)])
+    repository = OrderRepository(store, page_size=5)
+    pages = [repository.returnable_orders("alice")] + [repository.returnable_orders("alice", more=True) for _ in range(3)]
+    assert [len(page.orders) for page in pages] == [5, 5, 2, 0]
+
+
+def test_repository_cache(monkeypatch, collection, store):
+    clock = FakeClock()
+    monkeypatch.setattr(orders_module, "time", clock)
+    collection.insert_one(make_order("OT1001"))
+    repository = OrderRepository(store, ttl=60)
+
+    assert repository.order("alice", "OT1001") is not None
+    assert repository.order("alice", "OT1001") is not None
+    assert repository.counters == {"hits": 1, "misses": 1}
+
+    # Cached per session: another session reads the store
+    repository.order("bob", "OT1001")
+    assert repository.counters == {"hits": 1, "misses": 2}
+
+    collection.delete_one({"orderId": "OT1001"})
+    assert repository.order("alice", "OT1001") is not None
+    clock.now += 61
+    assert repository.order("alice", "OT1001") is None
+    assert repository.counters == {"hits": 2, "misses": 3}
+
+
+def test_repository_invalidate(collection, store):
+    repository = OrderRepository(store)
+    assert not repository.returnable_orders("alice").orders
+    collection.insert_one(make_order("OT1001"))
+    assert not repository.returnable_orders("alice").orders
+    repository.invalidate("alice")
+    assert [o["orderId"] for o in repository.returnable_orders("alice").orders] == ["OT1001"]
+
+
+def test_seed_sample_orders(collection, store):
+    seed_sample_orders(collection, "demo-account")
+    seed_sample_orders(collection, "demo-account")
+    assert [o["orderId"] for o in store.find_by_status("demo-account").orders] == ["OT1003", "OT1002"]
+
+
+def test_in_memory_store_scoping():
+    store = InMemoryOrderStore([make_order("OT1001"), make_order("OT1002", customer_id="bob"),
+                                make_order("OT1003", status="shipped")])
+    assert [o["orderId"] for o in store.find_by_status("alice").orders] == ["OT1001"]
+    assert store.find_by_order_id("OT1002", customer_id="alice") is None
+    assert store.find_by_order_id("OT1002", customer_id="bob")["orderId"] == "OT1002"
+
+
+def test_in_memory_store_sample_orders():
+    store = InMemoryOrderStore()
+    assert [o["orderId"] for o in store.find_by_status(DEMO_CUSTOMER).orders] == ["OT1003", "OT1002"]
+    assert not store.find_by_status("someone-else").orders
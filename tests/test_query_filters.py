@@ -0,0 +1,64 @@
+import pytest
+
+from utils.ingest import SELECTED_CATEGORIES
+from utils.query_filters import QueryConstraintExtractor
+
+
+@pytest.fixture
+def extractor():
+    return QueryConstraintExtractor({"product_type": SELECTED_CATEGORIES})
+
+
+@pytest.mark.parametrize("query, expected", [
+    ("red sandals for the beach", ["SANDAL"]),
+    ("Sneakers for running", ["SHOES"]),
+    ("a fashion ring", ["FASHIONRING"]),
+    ("fine earrings in gold", ["FINEEARRING"]),
+    ("earrings", ["FASHIONEARRING", "FINEEARRING"]),
+    ("a makeup bag", ["COSMETIC_CASE"]),
+    ("a case for my lipstick", ["COSMETIC_CASE"]),
+    ("a cosmetic case", ["COSMETIC_CASE"]),
+    ("boots and a beanie", ["BOOT", "HAT"]),
+])
+def test_extract(extractor, query, expected):
+    assert extractor.extract(query) == {"product_type": expected}
+
+
+@pytest.mark.parametrize("query", [
+    "something without a hat",
+    "not a ring",
+    "no boots please",
+    "anything other than these sandals",
+    "gifts excluding the fine earrings",
+    # Qualifiers of compound types are not products
+    "what is in fashion this summer",
+    "fine gifts for my mother",
+])
+def test_no_constraint(extractor, query):
+    assert extractor.extract(query) == {}
+    assert extractor.to_filter(query) is None
+
+
+def test_negation_only_drops_the_negated_product(extractor):
+    assert extractor.extract("a hat but not a scarf or boots") == {"product_type": ["HAT", "BOOT"]}
+    assert extractor.extract("shoes without any sandals") == {"product_type": ["SHOES"]}
+
+
+def test_to_filter(extractor):
+    assert extractor.to_filter("red boots") == {"product_type": "BOOT"}
+    assert extractor.to_filter("a necklace") == {
+        "product_type": {"$in": ["FASHIONNECKLACEBRACELETANKLET", "FINENECKLACEBRACELETANKLET"]}}
+    assert extractor.counters == {"queries": 2, "filtered": 2}
+
+
+def test_to_filter_with_several_fields():
+    extractor = QueryConstraintExtractor({"product_type": ["BOOT"], "color": ["red", "dark green"]}, synonyms={})
+    # In the order of the query
+    assert extractor.to_filter("red boots") == {"$and": [{"color": "red"}, {"product_type": "BOOT"}]}
+    assert extractor.to_filter("dark green boots") == {"$and": [{"color": "dark green"}, {"product_type": "BOOT"}]}
+
+
+def test_merge_keeps_the_explicit_filter(extractor):
+    explicit = {"brand": "Acme"}
+    assert extractor.merge("hello", explicit) is explicit
+    assert extractor.merge("boots", explicit) == {"$and": [explicit, {"product_type": "BOOT"}]}
@@ -0,0 +1,188 @@
+import json
+import threading
+import time
+
+import pytest
+
+from utils import ratelimit as ratelimit_module
+from utils.clients import close_all, get_bedrock_client, register_bedrock_client
+from utils.fake_bedrock import FakeBedrockRuntime
+from utils.ratelimit import (BACKGROUND, INTERACTIVE, LIMITED_CLIENT_OPTIONS, AdaptiveConcurrency, BedrockRateLimiter,
+                             RateLimitedBedrockClient, priority)
+
+MODEL_ID = "anthropic.claude-instant-v1"
+BODY = json.dumps({"prompt": "\n\nHuman: hi\n\nAssistant:", "max_tokens_to_sample": 50})
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_aimd_halves_once_per_round_of_throttles():
+    concurrency = AdaptiveConcurrency(initial=8)
+    epochs = [concurrency.acquire() for _ in range(4)]
+    concurrency.release(epochs[0], throttled=True)
+    assert concurrency.limit == 4 and concurrency.epoch == 1
+    # Sent before the decrease, the same burst
+    concurrency.release(epochs[1], throttled=True)
+    assert concurrency.limit == 4
+    concurrency.release(concurrency.acquire(), throttled=True)
+    assert concurrency.limit == 2
+    assert concurrency.in_flight == 2
+
+
+def test_aimd_never_goes_below_the_minimum():
+    concurrency = AdaptiveConcurrency(initial=1, minimum=1)
+    concurrency.release(concurrency.acquire(), throttled=True)
+    assert concurrency.limit == 1
+
+
+def test_aimd_increases_at_the_limit_up_to_the_maximum():
+    concurrency = AdaptiveConcurrency(initial=2, maximum=3)
+
+    def full_round():
+        epochs = [concurrency.acquire() for _ in range(int(concurrency.limit))]
+        for epoch in epochs:
+            concurrency.release(epoch)
+
+    full_round()
+    assert concurrency.limit == pytest.approx(2.5)
+    for _ in range(10):
+        full_round()
+    assert concurrency.limit == 3
+    # Successes below the limit do not raise it
+    concurrency = AdaptiveConcurrency(initial=4)
+    concurrency.release(concurrency.acquire())
+    assert concurrency.limit == 4
+
+
+def test_free_slots_go_to_interactive_requests_first():
+    concurrency = AdaptiveConcurrency(initial=1)
+    held = concurrency.acquire()
+    order = []
+
+    def request(level, name):
+        concurrency.release(concurrency.acquire(level))
+        order.append(name)
+
+    threads = [threading.Thread(target=request, args=(BACKGROUND, "background"))]
+    threads[0].start()
+    assert wait_until(lambda: concurrency.queued() == 1)
+    threads.append(threading.Thread(target=request, args=(INTERACTIVE, "interactive")))
+    threads[1].start()
+    assert wait_until(lambda: concurrency.queued() == 2)
+    concurrency.release(held)
+    for thread in threads:
+        thread.join(2)
+    assert order == ["interactive", "background"]
+
+
+def test_bucket_wait_does_not_hold_a_slot(monkeypatch):
+    limiter = BedrockRateLimiter(requests_per_minute=60, burst_seconds=1)
+    in_flight_while_sleeping = []
+
+    class Clock:
+        perf_counter = staticmethod(time.perf_counter)
+        monotonic = staticmethod(time.monotonic)
+
+        @staticmethod
+        def sleep(seconds):
+            in_flight_while_sleeping.append(limiter.stats()[MODEL_ID]["in_flight"])
+
+    monkeypatch.setattr(ratelimit_module, "time", Clock)
+    first = limiter.acquire(MODEL_ID)
+    second = limiter.acquire(MODEL_ID)
+    # The second request had to wait for the bucket, with only the first one in flight
+    assert in_flight_while_sleeping == [1]
+    first.release()
+    second.release()
+    assert limiter.stats()[MODEL_ID]["in_flight"] == 0
+
+
+def test_saturated_while_requests_queue():
+    limiter = BedrockRateLimiter(initial_concurrency=1)
+    assert not limiter.saturated(MODEL_ID)
+    slot = limiter.acquire(MODEL_ID)
+    waiter = threading.Thread(target=lambda: limiter.acquire(MODEL_ID).release())
+    waiter.start()
+    assert wait_until(lambda: limiter.saturated(MODEL_ID))
+    slot.release()
+    waiter.join(2)
+    assert not limiter.saturated(MODEL_ID)
+
+
+def test_priority_context():
+    with priority(BACKGROUND):
+        assert ratelimit_module.current_priority.get() == BACKGROUND
+    assert ratelimit_module.current_priority.get() == INTERACTIVE
+
+
+@pytest.fixture
+def limited():
+    fake = FakeBedrockRuntime(embedding_dim=8)
+    limiter = BedrockRateLimiter(base_delay=0.001)
+    return fake, limiter, RateLimitedBedrockClient(fake, limiter)
+
+
+def in_flight(limiter):
+    return limiter.stats()[MODEL_ID]["in_flight"]
+
+
+def test_slot_released_after_invoke_model(limited):
+    fake, limiter, client = limited
+    client.invoke_model(modelId=MODEL_ID, body=BODY)
+    assert in_flight(limiter) == 0
+    assert limiter.stats()[MODEL_ID]["requests"] == 1
+
+
+def test_stream_holds_its_slot_until_read(limited):
+    fake, limiter, client = limited
+    response = client.invoke_model_with_response_stream(modelId=MODEL_ID, body=BODY)
+    assert in_flight(limiter) == 1
+    events = list(response["body"])
+    assert events and in_flight(limiter) == 0
+    # Bedrock's invocation metrics corrected the token estimate
+    assert response["body"].used_tokens > 0
+
+
+def test_closed_or_dropped_streams_release_their_slot(limited):
+    fake, limiter, client = limited
+    body = client.invoke_model_with_response_stream(modelId=MODEL_ID, body=BODY)["body"]
+    next(body)
+    body.close()
+    assert in_flight(limiter) == 0
+    client.invoke_model_with_response_stream(modelId=MODEL_ID, body=BODY)
+    assert in_flight(limiter) == 0
+
+
+def test_throttles_are_retried_by_the_limiter():
+    fake = FakeBedrockRuntime(max_requests=1, throttle_window=0.05)
+    limiter = BedrockRateLimiter(base_delay=0.05, max_retries=4)
+    client = RateLimitedBedrockClient(fake, limiter)
+    client.invoke_model(modelId=MODEL_ID, body=BODY)
+    client.invoke_model(modelId=MODEL_ID, body=BODY)
+    stats = limiter.stats()[MODEL_ID]
+    assert fake.calls["completion"] == 2
+    assert stats["throttled"] == fake.calls["throttled"] >= 1
+    assert stats["concurrency_limit"] < 8 and stats["in_flight"] == 0
+
+
+def test_errors_other_than_throttles_are_not_retried(limited):
+    fake, limiter, client = limited
+    with pytest.raises(ValueError):
+        client.invoke_model(modelId=MODEL_ID, body="not json")
+    assert in_flight(limiter) == 0
+    assert limiter.stats()[MODEL_ID]["retries"] == 0
+
+
+def test_registered_client_serves_the_limited_options():
+    fake = FakeBedrockRuntime()
+    register_bedrock_client(fake, "eu-west-3")
+    try:
+        assert get_bedrock_client("eu-west-3", **LIMITED_CLIENT_OPTIONS) is fake
+        assert get_bedrock_client("eu-west-3") is fake
+    finally:
+        close_all()
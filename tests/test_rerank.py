@@ -0,0 +1,41 @@
+import numpy as np
+
+from utils.records import ProductRecord
+from utils.rerank import collapse_near_duplicates, mmr, rerank_records
+
+
+def test_mmr_trades_relevance_for_diversity():
+    relevance = np.array([0.9, 0.89, 0.5])
+    similarity = np.array([[1.0, 0.99, 0.1], [0.99, 1.0, 0.1], [0.1, 0.1, 1.0]])
+    assert mmr(relevance, similarity, k=2, lambda_mult=0.5) == [0, 2]
+    # Relevance only
+    assert mmr(relevance, similarity, k=2, lambda_mult=1.0) == [0, 1]
+    assert mmr(relevance, similarity, k=5) == [0, 2, 1]
+    assert mmr(np.array([]), np.zeros((0, 0)), k=3) == []
+
+
+def test_collapse_near_duplicates_keeps_the_most_relevant():
+    relevance = np.array([0.5, 0.9, 0.8])
+    similarity = np.array([[1.0, 0.1, 0.1], [0.1, 1.0, 0.98], [0.1, 0.98, 1.0]])
+    assert list(collapse_near_duplicates(relevance, similarity, threshold=0.97)) == [1, 0]
+    assert list(collapse_near_duplicates(relevance, np.eye(3), threshold=0.97, names=["a", "b", "a"])) == [1, 2]
+
+
+def test_rerank_records_drops_variants():
+    query = [1.0, 0.0, 0.0]
+    records = [
+        ProductRecord(id=1, item_name="Red sneaker", embedding=[0.9, 0.1, 0.0]),
+        ProductRecord(id=2, item_name="Red sneaker, size 9", embedding=[0.9, 0.1, 0.001]),
+        ProductRecord(id=3, item_name="Blue sneaker", embedding=[0.7, 0.0, 0.7]),
+        ProductRecord(id=4, item_name="RED  sneaker", embedding=[0.6, 0.8, 0.0]),
+    ]
+    reranked = rerank_records(query, records, k=3)
+    assert [record.id for record in reranked] == [1, 3]
+    assert all(record.embedding is None for record in reranked)
+
+
+def test_rerank_records_without_vectors_removes_exact_duplicates():
+    records = [ProductRecord(id=1, item_name="Hat"), ProductRecord(id=2, item_name="hat "),
+               ProductRecord(id=3, item_name="Cap"), ProductRecord(id=4, item_name="Scarf")]
+    assert [record.id for record in rerank_records([1.0], records, k=2)] == [1, 3]
+    assert rerank_records([1.0], [], k=2) == []
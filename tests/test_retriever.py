@@ -0,0 +1,86 @@
+import asyncio
+
+import pytest
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from utils.fake_bedrock import fake_embedding
+from utils.local_vector import LocalVectorSearch
+from utils.mongoretriever import MongoDBExtendedRetriever
+
+PRODUCTS = [
+    ("Classic red leather boot", "boot", "Classic boot made of leather", "casual, comfort"),
+    ("Sport red rubber boot", "boot", "Sport boot made of rubber", "waterproof"),
+    ("Classic blue wool hat", "hat", "Classic hat made of wool", "warm, winter"),
+    ("Vintage gold ring", "ring", "Vintage ring made of gold", "elegant"),
+    ("Vintage silver ring", "ring", "Vintage ring made of silver", "elegant, minimalist"),
+    ("Minimalist green cotton scarf", "scarf", "Minimalist scarf made of cotton", "casual"),
+]
+
+
+class FakeEmbeddings(Embeddings):
+    def embed_documents(self, texts):
+        return [fake_embedding(text, 64) for text in texts]
+
+    def embed_query(self, text):
+        return fake_embedding(text, 64)
+
+
+class RecordingVectorStore(VectorStore):
+    """Any other vector store, searched through similarity_search_with_score"""
+
+    def __init__(self):
+        self.calls = []
+
+    @property
+    def embeddings(self):
+        return FakeEmbeddings()
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return [doc for doc, _ in self.similarity_search_with_score(query, k, **kwargs)]
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        self.calls.append(kwargs)
+        return []
+
+
+@pytest.fixture
+def store():
+    texts = [name for name, *_ in PRODUCTS]
+    metadatas = [{"item_name": name, "product_type": product_type, "bullet_point": bullet, "item_keywords": keywords}
+                 for name, product_type, bullet, keywords in PRODUCTS]
+    return LocalVectorSearch.from_texts(texts, FakeEmbeddings(), metadatas=metadatas)
+
+
+def names(records):
+    return [(record.item_name, round(record.score, 6)) for record in records]
+
+
+@pytest.mark.parametrize("search_type", ["similarity", "hybrid"])
+@pytest.mark.parametrize("search_kwargs", [
+    {"k": 3},
+    {"k": 3, "pre_filter": {"product_type": {"$in": ["boot", "ring"]}}},
+    {"k": 2, "fetch_k": 5, "lambda_mult": 0.5},
+])
+def test_sync_and_async_search_agree(store, search_type, search_kwargs):
+    retriever = MongoDBExtendedRetriever(vectorstore=store, search_type=search_type)
+    query = "red boot"
+    expected = retriever.search_records(query, **search_kwargs)
+    assert expected
+    assert names(asyncio.run(retriever.asearch_records(query, **search_kwargs))) == names(expected)
+
+
+def test_other_vector_stores_get_the_post_filter_pipeline():
+    store = RecordingVectorStore()
+    retriever = MongoDBExtendedRetriever(vectorstore=store)
+    pipeline = [{"$match": {"product_type": "boot"}}]
+    retriever.search_records("red boot", post_filter_pipeline=pipeline)
+    asyncio.run(retriever.asearch_records("red boot", post_filter_pipeline=pipeline))
+    assert store.calls == [{"post_filter_pipeline": pipeline}] * 2
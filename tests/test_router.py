@@ -0,0 +1,98 @@
+import pytest
+from langchain_core.messages import AIMessage, HumanMessage, SystemMessage
+from langchain_core.tools import tool
+
+from utils.memory import SUMMARY_PREFIX
+from utils.orders import InMemoryOrderStore
+from utils.router import ASKED_FOR_PRODUCT, ASKED_FOR_REASON, IntentRouter
+
+ORDERS = InMemoryOrderStore([
+    {"orderId": "OT1002", "customerId": "demo", "status": "delivered", "shippingAddress": "1 Main St",
+     "items": [{"name": "Knitted Cap", "price": "12", "quantity": "2"},
+               {"name": "Leather Boots", "price": "80", "quantity": "1"}]},
+])
+
+LISTED_ORDER = f"{ASKED_FOR_PRODUCT}: \n\n OrderId: OT1002 \n - Knitted Cap, Price: 12,  Qty: 2"
+LISTED_REASONS = f"Added Knitted Cap for return. {ASKED_FOR_REASON}: \n\n - Low Quality"
+
+
+@tool
+def add_product_to_cart(product: str) -> str:
+    """Adds product to shopping cart"""
+    return f"Added '{product}' to cart."
+
+
+@tool
+def get_return_items(order_no: str) -> str:
+    """Gets the list of products in order with order_no"""
+    return order_no
+
+
+@tool
+def get_return_reasons(product: str) -> str:
+    """Gets the list of reasons for return"""
+    return product
+
+
+@tool
+def get_email_for_return(reason: str) -> str:
+    """Confirm email address"""
+    return reason
+
+
+@pytest.fixture
+def router():
+    tools = {t.name: t for t in [add_product_to_cart, get_return_items, get_return_reasons, get_email_for_return]}
+    return IntentRouter(tools, order_lookup=lambda order_id: ORDERS.find_by_order_id(order_id, customer_id="demo"))
+
+
+def history(*answers):
+    return [AIMessage(content=answer) for answer in answers]
+
+
+@pytest.mark.parametrize("text, tool_name, tool_input", [
+    ("add the blue cap to my cart", "add_product_to_cart", {"product": "blue cap"}),
+    ("Please put Leather Boots in the basket", "add_product_to_cart", {"product": "Leather Boots"}),
+    ("I want to return items from order ot1002", "get_return_items", {"order_no": "OT1002"}),
+])
+def test_routes_without_history(router, text, tool_name, tool_input):
+    intent = router.route(text)
+    assert (intent.tool_name, intent.tool_input) == (tool_name, tool_input)
+
+
+@pytest.mark.parametrize("text", [
+    "add it to my cart",
+    "add the blue cap to my cart and show me scarves",
+    "can I return order OT1002?",
+    "I want to return orders OT1002 and OT1003",
+    "show me red boots",
+])
+def test_falls_through_to_the_agent(router, text):
+    assert router.route(text) is None
+    assert router.counters["agent"] == 1
+
+
+def test_selected_item_of_the_listed_order(router):
+    intent = router.route("the Knitted Cap, 2", history(LISTED_ORDER))
+    assert (intent.tool_name, intent.tool_input) == ("get_return_reasons", {"product": "Knitted Cap, 2"})
+    # More than ordered, not an item of the order, or not after the listing
+    assert router.route("Knitted Cap, 3", history(LISTED_ORDER)) is None
+    assert router.route("Wool Scarf, 1", history(LISTED_ORDER)) is None
+    assert router.route("Knitted Cap, 1", history("How can I help you?")) is None
+
+
+def test_reason_asks_for_the_email(router):
+    intent = router.route("Low quality", history(LISTED_REASONS))
+    assert (intent.tool_name, intent.tool_input) == ("get_email_for_return", {"reason": "Low Quality"})
+
+
+def test_reason_goes_to_the_agent_once_an_email_was_given(router):
+    chat_history = [HumanMessage(content="my email is jo@example.com"), AIMessage(content=LISTED_REASONS)]
+    assert router.route("Low quality", chat_history) is None
+    assert router.route("Low quality, send it to jo@example.com", history(LISTED_REASONS)) is None
+    summary = SystemMessage(content=f"{SUMMARY_PREFIX}The shopper gave jo@example.com for the return label.")
+    assert router.route("Low quality", [summary] + history(LISTED_REASONS)) is None
+
+
+def test_run_calls_the_tool(router):
+    assert router.run(router.route("add the blue cap to my cart")) == "Added 'blue cap' to cart."
@@ -0,0 +1,248 @@
+import asyncio
+import json
+import zlib
+
+import pytest
+
+from server import App
+from utils.serving import AssistantPool, Overloaded, ShuttingDown, Worker
+from utils.tracing import Tracer
+
+
+class FakeAssistant:
+    """Answers once `release` is set, recording the turns it served"""
+
+    def __init__(self, name="assistant"):
+        self.name = name
+        self.release = asyncio.Event()
+        self.turns = []
+        self.warm = False
+
+    def warm_up(self):
+        self.warm = True
+        return self
+
+    async def arun(self, query, session_id):
+        self.turns.append((session_id, query))
+        await self.release.wait()
+        return f"{self.name}: {query}"
+
+    async def astream(self, query, session_id):
+        self.turns.append((session_id, query))
+        for token in query.split():
+            yield token
+
+    def clear_history(self, session_id, initial_text=None):
+        self.turns.append((session_id, None))
+
+
+def run(coroutine):
+    return asyncio.run(coroutine)
+
+
+async def settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+async def call(app, method, path, body=None):
+    """Sends one request to the ASGI app, returns (status, headers, body)"""
+    messages = [{"type": "http.request", "body": json.dumps(body).encode() if body is not None else b""}]
+    disconnected = asyncio.Event()
+
+    async def receive():
+        if messages:
+            return messages.pop(0)
+        await disconnected.wait()
+        return {"type": "http.disconnect"}
+
+    sent = []
+
+    async def send(message):
+        sent.append(message)
+
+    try:
+        await app({"type": "http", "method": method, "path": path}, receive, send)
+    finally:
+        disconnected.set()
+    headers = dict(sent[0]["headers"])
+    return sent[0]["status"], headers, b"".join(m.get("body", b"") for m in sent[1:])
+
+
+def make_app(tmp_path, env=""):
+    path = tmp_path / ".env"
+    path.write_text(env)
+    return App(factories={"chat_agent": FakeAssistant}, env_path=str(path))
+
+
+def test_worker_rejects_past_its_queue():
+    async def scenario():
+        assistant = FakeAssistant()
+        worker = Worker(assistant, concurrency=1, queue_size=1)
+
+        async def turn(session_id):
+            async with worker.turn(session_id) as a:
+                return await a.arun("hi", session_id)
+
+        tasks = [asyncio.ensure_future(turn(s)) for s in ("a", "b")]
+        await settle()
+        assert worker.stats() == {"running": 1, "waiting": 1, "sessions": 2}
+        with pytest.raises(Overloaded):
+            async with worker.turn("c"):
+                pass
+        assistant.release.set()
+        await asyncio.gather(*tasks)
+        assert worker.stats() == {"running": 0, "waiting": 0, "sessions": 0}
+
+    run(scenario())
+
+
+def test_worker_queue_timeout():
+    async def scenario():
+        assistant = FakeAssistant()
+        worker = Worker(assistant, concurrency=1, queue_size=4)
+        busy = worker.turn("a")
+        await busy.__aenter__()
+        with pytest.raises(Overloaded, match="timed out"):
+            async with worker.turn("b", timeout=0.05):
+                pass
+        await busy.__aexit__(None, None, None)
+        assert worker.pending == 0
+
+    run(scenario())
+
+
+def test_session_turns_run_in_order_without_holding_slots():
+    async def scenario():
+        assistant = FakeAssistant()
+        worker = Worker(assistant, concurrency=2, queue_size=4)
+
+        async def turn(session_id, query):
+            async with worker.turn(session_id) as a:
+                return await a.arun(query, session_id)
+
+        tasks = [asyncio.ensure_future(turn("a", "first")), asyncio.ensure_future(turn("a", "second")),
+                 asyncio.ensure_future(turn("b", "other"))]
+        await settle()
+        # The second turn of "a" waits for the first one, "b" takes the other slot
+        assert assistant.turns == [("a", "first"), ("b", "other")]
+        assistant.release.set()
+        await asyncio.gather(*tasks)
+        assert assistant.turns[-1] == ("a", "second")
+
+    run(scenario())
+
+
+def test_sessions_are_pinned_to_one_worker():
+    async def scenario():
+        pool = AssistantPool({"chat_agent": FakeAssistant}, workers=3, tracer=Tracer())
+        await pool.start()
+        assert all(w.assistant.warm for w in pool.pools["chat_agent"])
+        for session_id in ("alice", "bob", "carol", "dave"):
+            worker = pool.worker("chat_agent", session_id)
+            assert worker is pool.worker("chat_agent", session_id)
+            assert worker is pool.pools["chat_agent"][zlib.crc32(session_id.encode()) % 3]
+
+    run(scenario())
+
+
+def test_drain_waits_for_admitted_turns():
+    async def scenario():
+        pool = AssistantPool({"chat_agent": FakeAssistant}, workers=1, tracer=Tracer())
+        await pool.start()
+        assistant = pool.pools["chat_agent"][0].assistant
+
+        async def turn():
+            async with pool.turn("chat_agent", "a") as a:
+                return await a.arun("hi", "a")
+
+        task = asyncio.ensure_future(turn())
+        await settle()
+        drain = asyncio.ensure_future(pool.drain(timeout=2))
+        await settle()
+        with pytest.raises(ShuttingDown):
+            async with pool.turn("chat_agent", "b"):
+                pass
+        assert not drain.done()
+        assistant.release.set()
+        assert await task == "assistant: hi"
+        assert await drain == 0
+
+    run(scenario())
+
+
+def test_drain_gives_up_after_its_timeout():
+    async def scenario():
+        pool = AssistantPool({"chat_agent": FakeAssistant}, workers=1, tracer=Tracer())
+        await pool.start()
+        busy = pool.turn("chat_agent", "a")
+        await busy.__aenter__()
+        assert await pool.drain(timeout=0.05) == 1
+
+    run(scenario())
+
+
+def test_from_env_rejects_unknown_assistants():
+    with pytest.raises(ValueError):
+        AssistantPool.from_env({"SERVER_ASSISTANTS": "chat_agent,nope"}, {"chat_agent": FakeAssistant})
+
+
+def test_server_overload_is_a_503_with_retry_after(tmp_path):
+    app = make_app(tmp_path, "SERVER_WORKERS=1\nSERVER_CONCURRENCY=1\nSERVER_QUEUE_SIZE=0\n")
+
+    async def scenario():
+        status, _, _ = await call(app, "GET", "/health")
+        assert status == 503
+        await app.startup()
+        assistant = app.pool.pools["chat_agent"][0].assistant
+        first = asyncio.ensure_future(call(app, "POST", "/chat", {"session_id": "a", "message": "hi"}))
+        await settle()
+        status, headers, body = await call(app, "POST", "/chat", {"session_id": "b", "message": "hello"})
+        assert status == 503
+        assert headers[b"retry-after"] == b"1"
+        assert "error" in json.loads(body)
+        assistant.release.set()
+        status, _, body = await first
+        assert status == 200
+        assert json.loads(body) == {"session_id": "a", "answer": "assistant: hi"}
+
+        stats = json.loads((await call(app, "GET", "/stats"))[2])
+        assert stats["pool"]["assistants"]["chat_agent"] == [{"running": 0, "waiting": 0, "sessions": 0}]
+
+    run(scenario())
+
+
+def test_server_streams_and_validates(tmp_path):
+    app = make_app(tmp_path)
+
+    async def scenario():
+        await app.startup()
+        status, headers, body = await call(app, "POST", "/chat/stream", {"session_id": "a", "message": "red shoes"})
+        assert status == 200 and headers[b"content-type"] == b"text/event-stream"
+        assert body.decode() == ('data: {"token": "red"}\n\ndata: {"token": "shoes"}\n\n'
+                                 'event: done\ndata: {}\n\n')
+        assert (await call(app, "POST", "/chat", {"message": "hi"}))[0] == 400
+        assert (await call(app, "POST", "/chat", {"session_id": "a", "message": "hi", "assistant": "x"}))[0] == 404
+        assert (await call(app, "GET", "/nope"))[0] == 404
+
+    run(scenario())
+
+
+def test_server_shutdown_drains(tmp_path):
+    app = make_app(tmp_path)
+
+    async def scenario():
+        await app.startup()
+        assistant = app.pool.worker("chat_agent", "a").assistant
+        request = asyncio.ensure_future(call(app, "POST", "/chat", {"session_id": "a", "message": "hi"}))
+        await settle()
+        shutdown = asyncio.ensure_future(app.shutdown())
+        await settle()
+        status, headers, _ = await call(app, "GET", "/health")
+        assert status == 503 and headers[b"connection"] == b"close"
+        assert not shutdown.done()
+        assistant.release.set()
+        assert (await request)[0] == 200
+        await shutdown
+
+    run(scenario())
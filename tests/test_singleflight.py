@@ -0,0 +1,170 @@
+import asyncio
+import json
+import threading
+import time
+
+import pytest
+
+from utils.fake_bedrock import FakeBedrockRuntime
+from utils.singleflight import CoalescingBedrockClient, SingleFlight, digest
+
+MODEL_ID = "anthropic.claude-instant-v1"
+BODY = json.dumps({"prompt": "\n\nHuman: hi\n\nAssistant:", "max_tokens_to_sample": 50})
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.005)
+    return condition()
+
+
+def test_digest_is_stable():
+    assert digest("search", "hats", {"k": 4, "fetch_k": 20}) == digest("search", "hats", {"fetch_k": 20, "k": 4})
+    assert digest("search", "hats") != digest("search", "caps")
+
+
+def test_concurrent_calls_run_once():
+    flight = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    calls = []
+
+    def work():
+        calls.append(1)
+        started.set()
+        release.wait(2)
+        return "answer"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flight.do("key", work)))
+    leader.start()
+    started.wait(2)
+    followers = [threading.Thread(target=lambda: results.append(flight.do("key", work))) for _ in range(3)]
+    for thread in followers:
+        thread.start()
+    assert wait_until(lambda: flight.stats()["coalesced"] == 3)
+    release.set()
+    for thread in [leader, *followers]:
+        thread.join(2)
+    assert results == ["answer"] * 4
+    assert calls == [1]
+    assert flight.stats() == {"calls": 4, "coalesced": 3, "in_flight": 0}
+    # Nothing is kept once the call returned
+    assert flight.do("key", lambda: "new answer") == "new answer"
+
+
+def test_errors_reach_every_caller():
+    flight = SingleFlight()
+
+    async def fail():
+        await asyncio.sleep(0.01)
+        raise ValueError("no products")
+
+    async def run():
+        return await asyncio.gather(*[flight.ado("key", fail) for _ in range(3)], return_exceptions=True)
+
+    errors = asyncio.run(run())
+    assert all(isinstance(e, ValueError) for e in errors)
+    assert flight.stats()["coalesced"] == 2
+
+
+def test_async_callers_share_a_call_a_cancelled_one_does_not_cancel():
+    flight = SingleFlight()
+    calls = []
+
+    async def work():
+        calls.append(1)
+        await asyncio.sleep(0.05)
+        return "answer"
+
+    async def run():
+        first = asyncio.ensure_future(flight.ado("key", work))
+        second = asyncio.ensure_future(flight.ado("key", work))
+        await asyncio.sleep(0.01)
+        first.cancel()
+        with pytest.raises(asyncio.CancelledError):
+            await first
+        return await second
+
+    assert asyncio.run(run()) == "answer"
+    assert calls == [1]
+
+
+def test_coalescing_client_shares_completions_and_streams():
+    fake = FakeBedrockRuntime(completion="red sneakers in stock", completion_latency=0.05)
+    client = CoalescingBedrockClient(fake, flight=SingleFlight())
+    bodies = []
+    threads = [threading.Thread(target=lambda: bodies.append(client.invoke_model(body=BODY, modelId=MODEL_ID)[
+        "body"].read())) for _ in range(4)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join(2)
+    assert len(set(bodies)) == 1 and len(bodies) == 4
+    assert fake.calls["completion"] == 1
+
+    first = client.invoke_model_with_response_stream(body=BODY, modelId=MODEL_ID)["body"]
+    events = [next(first)]
+    # Joins mid-stream, replays the events received so far
+    second = client.invoke_model_with_response_stream(body=BODY, modelId=MODEL_ID)["body"]
+    events += list(first)
+    assert list(second) == events
+    assert fake.calls["stream"] == 1
+
+
+class GatedSource:
+    """Yields events one at a time, each once its gate is opened"""
+
+    def __init__(self, count):
+        self.gates = [threading.Event() for _ in range(count)]
+        self.pulled = 0
+
+    def __iter__(self):
+        for i, gate in enumerate(self.gates):
+            gate.wait(5)
+            self.pulled += 1
+            yield {"chunk": i}
+
+
+def test_subscribers_replay_while_another_one_pulls():
+    flight = SingleFlight()
+    source = GatedSource(2)
+    source.gates[0].set()
+    first = flight.stream("key", lambda: {"body": source})["body"]
+    second = flight.stream("key", lambda: {"body": iter(())})["body"]
+    assert next(first) == {"chunk": 0}
+
+    # first waits for event 1 on the source
+    pulled = []
+    puller = threading.Thread(target=lambda: pulled.append(next(first)))
+    puller.start()
+    assert wait_until(lambda: flight.stats()["in_flight"] == 1 and not source.gates[1].is_set())
+    # second replays event 0 meanwhile, without waiting for the source
+    start = time.monotonic()
+    assert next(second) == {"chunk": 0}
+    assert time.monotonic() - start < 1
+
+    source.gates[1].set()
+    puller.join(2)
+    assert pulled == [{"chunk": 1}]
+    assert list(second) == [{"chunk": 1}]
+    assert list(first) == []
+    assert source.pulled == 2
+    assert flight.stats()["in_flight"] == 0
+
+
+def test_only_one_subscriber_pulls_at_a_time():
+    flight = SingleFlight()
+    source = GatedSource(1)
+    subscriptions = [flight.stream("key", lambda: {"body": source})["body"] for _ in range(4)]
+    results = []
+    threads = [threading.Thread(target=lambda s=s: results.append(list(s))) for s in subscriptions]
+    for thread in threads:
+        thread.start()
+    time.sleep(0.05)
+    source.gates[0].set()
+    for thread in threads:
+        thread.join(2)
+    assert results == [[{"chunk": 0}]] * 4
+    assert source.pulled == 1
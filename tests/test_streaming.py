@@ -0,0 +1,61 @@
+import asyncio
+import time
+
+from langchain_community.llms.bedrock import Bedrock
+
+from utils.fake_bedrock import FakeBedrockRuntime
+from utils.ratelimit import BedrockRateLimiter, RateLimitedBedrockClient
+from utils.streaming import FINAL_ANSWER_TAG, FinalAnswerExtractor, aiterate_tokens, iterate_tokens
+
+MODEL_ID = "anthropic.claude-instant-v1"
+COMPLETION = " ".join(f"word{i}" for i in range(40))
+
+
+def make_llm(token_latency=0.0):
+    fake = FakeBedrockRuntime(completion=COMPLETION, token_latency=token_latency, chunk_words=1)
+    limiter = BedrockRateLimiter()
+    llm = Bedrock(model_id=MODEL_ID, client=RateLimitedBedrockClient(fake, limiter), streaming=True,
+                  tags=[FINAL_ANSWER_TAG])
+    return llm, fake, limiter
+
+
+def wait_until(condition, timeout=2.0):
+    deadline = time.monotonic() + timeout
+    while not condition() and time.monotonic() < deadline:
+        time.sleep(0.01)
+    return condition()
+
+
+def test_final_answer_extractor():
+    extractor = FinalAnswerExtractor()
+    tokens = ['{"action": "Final', ' Answer", "action_input": "Red \\"', 'hat\\" \\u00e9', '"}', ' trailing']
+    assert "".join(extractor.feed(token) for token in tokens) == 'Red "hat" é'
+
+
+def test_iterate_tokens_streams_the_answer():
+    llm, fake, limiter = make_llm()
+    tokens = list(iterate_tokens(lambda callbacks: llm.invoke("Hi", config={"callbacks": callbacks})))
+    assert "".join(tokens) == COMPLETION
+
+
+def test_closing_the_stream_stops_the_generation():
+    llm, fake, limiter = make_llm(token_latency=0.05)
+    tokens = iterate_tokens(lambda callbacks: llm.invoke("Hi", config={"callbacks": callbacks}))
+    assert next(tokens) == "word0"
+    tokens.close()
+    # Well before the 2 seconds of the whole generation
+    assert wait_until(lambda: limiter.stats()[MODEL_ID]["in_flight"] == 0, timeout=0.5)
+    assert fake._in_flight[MODEL_ID] == 0
+
+
+def test_closing_the_async_stream_stops_the_generation():
+    llm, fake, limiter = make_llm(token_latency=0.05)
+
+    async def first_token():
+        tokens = aiterate_tokens(lambda callbacks: llm.ainvoke("Hi", config={"callbacks": callbacks}))
+        token = await tokens.__anext__()
+        await tokens.aclose()
+        return token
+
+    assert asyncio.run(first_token()) == "word0"
+    assert wait_until(lambda: limiter.stats()[MODEL_ID]["in_flight"] == 0, timeout=0.5)
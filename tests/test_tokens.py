@@ -0,0 +1,72 @@
+from langchain_core.documents import Document
+from langchain_core.messages import AIMessage, HumanMessage
+from langchain_core.prompts import PromptTemplate
+
+from utils.tokens import MESSAGE_OVERHEAD, TokenCounter, pack_documents
+
+DESCRIPTION = ("Soft knitted cap in merino wool, one size fits most, machine washable at 30 degrees. "
+               "Available in red, navy and charcoal. ")
+
+
+def docs(*sizes):
+    return [Document(page_content=f"Product {i}. " + DESCRIPTION * size, metadata={"rank": i})
+            for i, size in enumerate(sizes)]
+
+
+def test_count_is_memoized():
+    counter = TokenCounter()
+    assert counter.count("red shoes") == counter.count("red shoes") == counter.estimate("red shoes")
+    assert counter.counters == {"hits": 1, "misses": 1}
+    assert counter.count("") == 0
+
+
+def test_count_messages_adds_the_overhead():
+    counter = TokenCounter()
+    messages = [HumanMessage(content="hi"), AIMessage(content="red shoes")]
+    assert counter.count_messages(messages) == counter("hi") + counter("red shoes") + 2 * MESSAGE_OVERHEAD
+
+
+def test_truncate_stays_within_the_budget():
+    counter = TokenCounter()
+    text = DESCRIPTION * 10
+    truncated = counter.truncate(text, 50)
+    assert text.startswith(truncated) and truncated
+    assert counter.estimate(truncated) <= 50
+    # Cut at a word boundary
+    assert text[len(truncated)] == " "
+    assert counter.truncate(text, 0) == ""
+    assert counter.truncate("red shoes", 50) == "red shoes"
+
+
+def test_keeps_everything_within_budget():
+    documents = docs(1, 1, 1)
+    assert pack_documents(documents, budget=10000) == documents
+
+
+def test_truncates_the_first_document_that_does_not_fit():
+    counter = TokenCounter()
+    documents = docs(1, 1, 10, 1)
+    budget = sum(counter(d.page_content) for d in documents[:2]) + 2 * counter("\n\n") + 100
+    packed = pack_documents(documents, budget=budget, counter=counter)
+    assert [d.metadata["rank"] for d in packed] == [0, 1, 2]
+    assert packed[2].metadata["truncated"]
+    assert documents[2].page_content.startswith(packed[2].page_content)
+    assert sum(counter(d.page_content) for d in packed) + 2 * counter("\n\n") <= budget
+
+
+def test_drops_the_rest_when_too_little_is_left():
+    counter = TokenCounter()
+    documents = docs(1, 10)
+    budget = counter(documents[0].page_content) + counter("\n\n") + 10
+    assert pack_documents(documents, budget=budget, counter=counter, min_tokens=32) == documents[:1]
+
+
+def test_counts_the_document_prompt():
+    counter = TokenCounter()
+    documents = docs(1, 1)
+    prompt = PromptTemplate.from_template("Product rank {rank}: {page_content}")
+    budget = counter(documents[0].page_content) + counter("\n\n") + counter(documents[1].page_content)
+    # Fits as raw page contents, not once formatted
+    assert len(pack_documents(documents, budget=budget, counter=counter)) == 2
+    packed = pack_documents(documents, budget=budget, counter=counter, document_prompt=prompt, min_tokens=1)
+    assert packed[1].metadata.get("truncated")
@@ -0,0 +1,70 @@
+import asyncio
+import urllib.request
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from utils.mongoretriever import MongoDBExtendedRetriever
+from utils.tracing import TOKENS_METRIC, Tracer, tracer
+
+
+class UsageRecordingVectorStore(VectorStore):
+    """Reports Bedrock usage from the thread it searches on, like an embedding call would"""
+
+    @property
+    def embeddings(self):
+        return None
+
+    def add_texts(self, texts, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    @classmethod
+    def from_texts(cls, texts, embedding: Embeddings, metadatas=None, **kwargs):
+        raise NotImplementedError
+
+    def similarity_search(self, query, k=4, **kwargs):
+        return []
+
+    def similarity_search_with_score(self, query, k=4, **kwargs):
+        tracer.record_usage("amazon.titan-embed-text-v1", 7, 0)
+        return []
+
+
+def test_usage_from_executor_threads_reaches_the_trace():
+    retriever = MongoDBExtendedRetriever(vectorstore=UsageRecordingVectorStore())
+
+    async def search():
+        with tracer.trace("test") as trace:
+            await retriever.asearch_records("red boots")
+        return trace
+
+    assert asyncio.run(search()).usage["input_tokens"] == 7
+
+
+def test_trace_spans_and_metrics():
+    local = Tracer()
+    with local.trace("chat_doc", session_id="s1") as trace:
+        with local.span("embedding"):
+            pass
+        local.record_usage("claude", 10, 5)
+    assert [span["name"] for span in trace.to_dict()["spans"]] == ["embedding"]
+    assert trace.usage == {"input_tokens": 10, "output_tokens": 5, "bedrock_calls": 1}
+    metrics = local.render_prometheus()
+    assert f'{TOKENS_METRIC}{{model="claude",type="input"}} 10' in metrics
+    assert local.percentiles()["chat_doc"]["count"] == 1
+
+
+def test_metrics_endpoint_is_local_by_default():
+    local = Tracer()
+    local.configure_from_env({"METRICS_PORT": "0"})
+    assert local._server is None
+    server = local.start_http_server(0)
+    try:
+        host, port = server.server_address
+        assert host == "127.0.0.1"
+        local.inc("shopping_errors_total", stage="test")
+        body = urllib.request.urlopen(f"http://127.0.0.1:{port}/metrics").read().decode()
+        assert 'shopping_errors_total{stage="test"} 1' in body
+    finally:
+        server.shutdown()
+        server.server_close()
@@ -0,0 +1,140 @@
+import logging
+import threading
+import time
+from typing import Callable, Optional
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+CATALOG_META_COLLECTION = "catalog_meta"
+
+
+def get_catalog_version(collection):
+    """Returns the ingestion version stamp of a product collection (0 if never stamped)"""
+    meta = collection.database[CATALOG_META_COLLECTION].find_one({"_id": collection.name})
+    return meta["version"] if meta else 0
+
+
+def bump_catalog_version(collection):
+    """Marks the product collection as re-ingested so cached answers get invalidated"""
+    collection.database[CATALOG_META_COLLECTION].update_one(
+        {"_id": collection.name},
+        {"$inc": {"version": 1}, "$set": {"updated_at": time.time()}},
+        upsert=True,
+    )
+
+
+class SemanticAnswerCache:
+    """Caches chain answers keyed by the embedding of the question.
+
+    A lookup returns the stored answer of the most similar question answered within `ttl`
+    seconds if its cosine similarity is at least `threshold`. The oldest entries are evicted
+    once `max_entries` is reached. If `catalog_version` is given, it is polled at most every
+    `version_check_interval` seconds and the cache is cleared when it changes.
+    """
+
+    def __init__(self, embeddings, threshold: float = 0.95, ttl: float = 600,
+                 max_entries: int = 1000, catalog_version: Optional[Callable] = None,
+                 version_check_interval: float = 30):
+        self.embeddings = embeddings
+        self.threshold = threshold
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.catalog_version = catalog_version
+        self.version_check_interval = version_check_interval
+        self._lock = threading.Lock()
+        self._vectors = None
+        self._entries = []
+        self._version = None
+        self._version_checked_at = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def _normalize(self, embedding):
+        vector = np.asarray(embedding, dtype=np.float32)
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else vector
+
+    def _check_version(self):
+        if self.catalog_version is None:
+            return
+        now = time.time()
+        if now - self._version_checked_at < self.version_check_interval:
+            return
+        self._version_checked_at = now
+        try:
+            version = self.catalog_version()
+        except Exception as e:
+            logger.warning(f"Could not read catalog version: {e}")
+            return
+        if self._version is not None and version != self._version:
+            self._clear()
+        self._version = version
+
+    def _expire(self):
+        cutoff = time.time() - self.ttl
+        keep = [i for i, entry in enumerate(self._entries) if entry["created"] >= cutoff]
+        if len(keep) != len(self._entries):
+            self._entries = [self._entries[i] for i in keep]
+            self._vectors = self._vectors[keep] if keep else None
+
+    def _clear(self):
+        self._entries = []
+        self._vectors = None
+
+    def lookup(self, question: str):
+        """Returns a dict with 'answer' and 'source_documents', or None on a miss"""
+        return self._lookup_vector(self._normalize(self.embeddings.embed_query(question)))
+
+    async def alookup(self, question: str):
+        return self._lookup_vector(self._normalize(await self.embeddings.aembed_query(question)))
+
+    def _lookup_vector(self, vector):
+        with self._lock:
+            self._check_version()
+            self._expire()
+            if self._vectors is None:
+                self.misses += 1
+                return None
+            scores = self._vectors @ vector
+            best = int(np.argmax(scores))
+            if scores[best] < self.threshold:
+                self.misses += 1
+                return None
+            self.hits += 1
+            entry = self._entries[best]
+            return {"answer": entry["answer"], "source_documents": entry["source_documents"]}
+
+    def store(self, question: str, answer: str, source_documents=None):
+        self._store_vector(self._normalize(self.embeddings.embed_query(question)), question, answer, source_documents)
+
+    async def astore(self, question: str, answer: str, source_documents=None):
+        vector = self._normalize(await self.embeddings.aembed_query(question))
+        self._store_vector(vector, question, answer, source_documents)
+
+    def _store_vector(self, vector, question, answer, source_documents):
+        with self._lock:
+            self._check_version()
+            self._entries.append({
+                "question": question,
+                "answer": answer,
+                "source_documents": source_documents or [],
+                "created": time.time(),
+            })
+            if self._vectors is None:
+                self._vectors = vector[None, :]
+            else:
+                self._vectors = np.vstack([self._vectors, vector])
+            overflow = len(self._entries) - self.max_entries
+            if overflow > 0:
+                self._entries = self._entries[overflow:]
+                self._vectors = self._vectors[overflow:]
+
+    def invalidate(self):
+        with self._lock:
+            self._clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {"entries": len(self._entries), "hits": self.hits, "misses": self.misses}
@@ -0,0 +1,328 @@
+"""Offline, stage-level benchmark of ShoppingAssistant.
+
+Runs without AWS or MongoDB: Bedrock is replaced by utils.fake_bedrock with configurable
+latencies, and the catalog is a synthetic one served by the local vector backend from a
+snapshot. Each stage is timed separately and the results are written as JSON, so runs can
+be compared between releases.
+
+Startup (import, construction and first query) is measured in fresh processes with
+--startup, since a warm interpreter already has every module loaded.
+
+Usage:
+    python -m utils.benchmark --out benchmark_results.json
+    python -m utils.benchmark --startup --out startup_results.json
+"""
+import argparse
+import contextlib
+import json
+import logging
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+from utils.clients import register_bedrock_client
+from utils.fake_bedrock import FakeBedrockRuntime, fake_embedding
+from utils.ingest import SELECTED_CATEGORIES
+from utils.local_vector import LocalVectorSearch
+from utils.tokens import token_counter
+
+REGION = "us-east-1"
+MODEL_ID = "anthropic.claude-instant-v1"
+
+RAG_PROMPT = """You are ShoppingBot, a friendly conversational retail assistant.
+Use the following context to answer the question.
+<context>
+{context}
+</context>
+<question>{question}</question>"""
+
+AGENT_PROMPT = """You are ShoppingBot, a retail assistant that helps shoppers find products and return orders."""
+
+QUERIES = [
+    "Show me red shoes for running",
+    "Do you have leather boots in brown?",
+    "I am looking for a silver necklace as a gift",
+    "Which sandals are good for the beach?",
+    "Find me a warm winter hat",
+    "gold earrings under 50 dollars",
+    "a small cosmetic case for travel",
+    "black ankle boots for women",
+]
+
+FOLLOW_UPS = ["Do they come in blue?", "Which one is the cheapest?", "Is it waterproof?"]
+
+_COLORS = ["red", "blue", "black", "brown", "white", "green", "silver", "gold", "pink", "beige"]
+_MATERIALS = ["leather", "suede", "canvas", "cotton", "wool", "sterling silver", "stainless steel", "rubber"]
+_STYLES = ["classic", "casual", "sport", "vintage", "minimalist", "comfort", "outdoor", "formal"]
+
+
+class _FakeTitanEmbeddings:
+    """Embeds the synthetic catalog without going through the Bedrock client"""
+
+    def __init__(self, dim):
+        self.dim = dim
+
+    def embed_documents(self, texts):
+        return [fake_embedding(text, self.dim) for text in texts]
+
+    def embed_query(self, text):
+        return fake_embedding(text, self.dim)
+
+
+def synthetic_catalog(size: int, seed: int = 0):
+    rng = random.Random(seed)
+    products = []
+    for i in range(size):
+        product_type = SELECTED_CATEGORIES[i % len(SELECTED_CATEGORIES)]
+        color, material, style = rng.choice(_COLORS), rng.choice(_MATERIALS), rng.choice(_STYLES)
+        noun = product_type.lower().replace("_", " ")
+        name = f"{style.title()} {color} {material} {noun} {i}"
+        products.append({
+            "item_id": f"B{i:08d}",
+            "item_name": name,
+            "product_type": product_type,
+            "bullet_point": (f"{style.title()} {noun} made of {material}. Available in {color}. "
+                             + "Durable, lightweight and easy to care for. " * rng.randint(1, 6)),
+            "item_keywords": " ".join([color, material, style, noun] + rng.sample(_STYLES, 3)),
+        })
+    return products
+
+
+def build_snapshot(directory: str, size: int, dim: int) -> str:
+    products = synthetic_catalog(size)
+    store = LocalVectorSearch(_FakeTitanEmbeddings(dim))
+    store.add_texts([p["item_name"] for p in products], products)
+    path = os.path.join(directory, "catalog")
+    store.save(path)
+    return path
+
+
+def write_env(directory: str, snapshot_path: str, extra: dict):
+    values = {
+        "REGION": REGION,
+        "MDB_URI": "",
+        "MDB_DATABASE": "bench",
+        "MDB_COLLECTION": "products",
+        "VECTOR_BACKEND": "local",
+        "VECTOR_SNAPSHOT_PATH": snapshot_path,
+        "EMBEDDING_CACHE_PATH": os.path.join(directory, "embeddings.sqlite"),
+        **extra,
+    }
+    with open(os.path.join(directory, ".env"), "w") as f:
+        f.write("".join(f"{key}={value}\n" for key, value in values.items()))
+
+
+def summarize(samples):
+    ms = sorted(s * 1000 for s in samples)
+    p95 = ms[min(len(ms) - 1, int(round(0.95 * (len(ms) - 1))))]
+    return {
+        "n": len(ms),
+        "mean_ms": round(statistics.fmean(ms), 3),
+        "p50_ms": round(statistics.median(ms), 3),
+        "p95_ms": round(p95, 3),
+        "min_ms": round(ms[0], 3),
+        "max_ms": round(ms[-1], 3),
+    }
+
+
+class StageTimer:
+    def __init__(self):
+        self.samples = {}
+
+    @contextlib.contextmanager
+    def time(self, stage):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.samples.setdefault(stage, []).append(time.perf_counter() - start)
+
+    def results(self):
+        return {stage: summarize(samples) for stage, samples in self.samples.items()}
+
+
+def _git_revision():
+    try:
+        return subprocess.check_output(["git", "rev-parse", "--short", "HEAD"], stderr=subprocess.DEVNULL,
+                                       cwd=os.path.dirname(os.path.abspath(__file__))).decode().strip()
+    except Exception:
+        return None
+
+
+def run_benchmark(iterations: int = 20, catalog_size: int = 2000, embedding_dim: int = 1536,
+                  completion_latency: float = 0.0, token_latency: float = 0.0, embedding_latency: float = 0.0,
+                  env: dict = None):
+    # Imported here so the fake client is registered before any assistant exists
+    from utils.shopping_agent import ShoppingAssistant
+
+    fake = FakeBedrockRuntime(completion_latency=completion_latency, token_latency=token_latency,
+                              embedding_latency=embedding_latency, embedding_dim=embedding_dim)
+    register_bedrock_client(fake, REGION)
+    timer = StageTimer()
+    prompt_tokens = []
+    logger = logging.getLogger("benchmark")
+    cwd = os.getcwd()
+
+    with tempfile.TemporaryDirectory() as directory, open(os.devnull, "w") as devnull:
+        write_env(directory, build_snapshot(directory, catalog_size, embedding_dim), env or {})
+        os.chdir(directory)
+        try:
+            # verbose chains print every prompt, which is part of the cost but not of the output
+            with contextlib.redirect_stdout(devnull):
+                for _ in range(max(iterations // 5, 1)):
+                    with timer.time("construct_chat_doc"):
+                        rag = ShoppingAssistant(MODEL_ID, RAG_PROMPT, model_type="chat_doc", logger=logger)
+                    with timer.time("construct_chat_agent"):
+                        agent = ShoppingAssistant(MODEL_ID, AGENT_PROMPT, model_type="chat_agent", logger=logger)
+
+                retriever = rag.retriever
+                chain = rag.product_agent.model
+                embeddings = rag.br_embeddings
+                for i in range(iterations):
+                    query = f"{QUERIES[i % len(QUERIES)]} #{i}"
+                    with timer.time("embedding_uncached"):
+                        embeddings.embed_query(query)
+                    with timer.time("embedding_cached"):
+                        embeddings.embed_query(query)
+                    with timer.time("retrieval"):
+                        records = retriever.search_records(query, **retriever.search_kwargs)
+                    with timer.time("combine_metadata"):
+                        docs = retriever._to_documents(records, query)
+                    with timer.time("prompt_assembly"):
+                        docs = chain._reduce_tokens_below_limit(docs, query)
+                        inputs = chain.combine_docs_chain._get_inputs(docs, question=query)
+                        prompts, _ = chain.combine_docs_chain.llm_chain.prep_prompts([inputs])
+                    prompt_tokens.append(token_counter.count(prompts[0].to_string()))
+
+                for i in range(iterations):
+                    session = f"rag-{i}"
+                    with timer.time("chat_doc_first_turn"):
+                        rag.run(QUERIES[i % len(QUERIES)], session_id=session)
+                    with timer.time("chat_doc_follow_up"):
+                        rag.run(FOLLOW_UPS[i % len(FOLLOW_UPS)], session_id=session)
+                    with timer.time("chat_agent"):
+                        agent.run(QUERIES[i % len(QUERIES)], session_id=f"agent-{i}")
+        finally:
+            os.chdir(cwd)
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "config": {
+            "iterations": iterations,
+            "catalog_size": catalog_size,
+            "embedding_dim": embedding_dim,
+            "completion_latency": completion_latency,
+            "token_latency": token_latency,
+            "embedding_latency": embedding_latency,
+            "env": env or {},
+        },
+        "bedrock_calls": dict(fake.calls),
+        "stages": timer.results(),
+        # Estimated size of the stuffed answer prompt, see utils.tokens
+        "prompt_tokens_mean": round(statistics.fmean(prompt_tokens), 1) if prompt_tokens else None,
+    }
+
+
+# Timed before anything else is imported, so the import cost includes all of LangChain
+_STARTUP_SCRIPT = """import time
+start = time.perf_counter()
+import utils.shopping_agent
+import_s = time.perf_counter() - start
+from utils.benchmark import startup_child
+startup_child(import_s)
+"""
+
+
+def startup_child(import_s: float):
+    """Runs in the process started by run_startup_benchmark, prints its timings as JSON"""
+    from utils.shopping_agent import ShoppingAssistant
+
+    model_type, embedding_dim = sys.argv[1], int(sys.argv[2])
+    register_bedrock_client(FakeBedrockRuntime(embedding_dim=embedding_dim), REGION)
+    logger = logging.getLogger("benchmark")
+    with contextlib.redirect_stdout(sys.stderr):
+        start = time.perf_counter()
+        assistant = ShoppingAssistant(MODEL_ID, RAG_PROMPT if model_type == "chat_doc" else AGENT_PROMPT,
+                                      model_type=model_type, logger=logger)
+        construct_s = time.perf_counter() - start
+        start = time.perf_counter()
+        assistant.run(QUERIES[0])
+        first_query_s = time.perf_counter() - start
+    print(json.dumps({"import": import_s, "construct": construct_s, "first_query": first_query_s}))
+
+
+def run_startup_benchmark(runs: int = 5, catalog_size: int = 2000, embedding_dim: int = 1536, env: dict = None):
+    """Import time of utils.shopping_agent, then construction and first query of each model
+    type, each in a new interpreter"""
+    timer = StageTimer()
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    child_env = {**os.environ, "PYTHONPATH": os.pathsep.join(filter(None, [root, os.environ.get("PYTHONPATH")]))}
+    with tempfile.TemporaryDirectory() as directory:
+        write_env(directory, build_snapshot(directory, catalog_size, embedding_dim), env or {})
+        for _ in range(runs):
+            for model_type in ("chat_doc", "chat_agent"):
+                output = subprocess.run([sys.executable, "-W", "ignore", "-c", _STARTUP_SCRIPT, model_type, str(embedding_dim)],
+                                        cwd=directory, env=child_env, check=True, capture_output=True, text=True).stdout
+                timings = json.loads(output.strip().splitlines()[-1])
+                timer.samples.setdefault("import", []).append(timings["import"])
+                timer.samples.setdefault(f"construct_{model_type}", []).append(timings["construct"])
+                timer.samples.setdefault(f"first_query_{model_type}", []).append(timings["first_query"])
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%SZ", time.gmtime()),
+        "revision": _git_revision(),
+        "python": platform.python_version(),
+        "config": {"runs": runs, "catalog_size": catalog_size, "embedding_dim": embedding_dim, "env": env or {}},
+        "stages": timer.results(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark ShoppingAssistant stages without AWS or MongoDB")
+    parser.add_argument("--iterations", type=int, default=20)
+    parser.add_argument("--catalog-size", type=int, default=2000, help="Synthetic products in the local index")
+    parser.add_argument("--embedding-dim", type=int, default=1536)
+    parser.add_argument("--completion-latency", type=float, default=0.0, help="Seconds to the first token")
+    parser.add_argument("--token-latency", type=float, default=0.0, help="Seconds per streamed chunk")
+    parser.add_argument("--embedding-latency", type=float, default=0.0, help="Seconds per embedding call")
+    parser.add_argument("--set", action="append", default=[], metavar="KEY=VALUE",
+                        help="Extra .env value for the assistants, e.g. --set SEARCH_TYPE=hybrid")
+    parser.add_argument("--startup", action="store_true",
+                        help="Measure import, construction and first query in fresh processes instead")
+    parser.add_argument("--out", default="benchmark_results.json")
+    args = parser.parse_args()
+
+    env = dict(item.split("=", 1) for item in args.set)
+    if args.startup:
+        results = run_startup_benchmark(runs=args.iterations, catalog_size=args.catalog_size,
+                                        embedding_dim=args.embedding_dim, env=env)
+    else:
+            results = run_benchmark(
+            iterations=args.iterations,
+            catalog_size=args.catalog_size,
+            embedding_dim=args.embedding_dim,
+            completion_latency=args.completion_latency,
+            token_latency=args.token_latency,
+            embedding_latency=args.embedding_latency,
+            env=env,
+        )
+    with open(args.out, "w") as f:
+        json.dump(results, f, indent=2)
+
+    print(f"{'stage':<24}{'mean ms':>10}{'p50 ms':>10}{'p95 ms':>10}")
+    for stage, stats in results["stages"].items():
+        print(f"{stage:<24}{stats['mean_ms']:>10.2f}{stats['p50_ms']:>10.2f}{stats['p95_ms']:>10.2f}")
+    if results.get("prompt_tokens_mean") is not None:
+        print(f"Answer prompt: {results['prompt_tokens_mean']} tokens on average")
+    print(f"Results written to {args.out}")
+
+
+if __name__ == "__main__":
+    main()
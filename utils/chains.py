@@ -0,0 +1,48 @@
+"""Chains built on the LangChain ones.
+
+Kept apart from utils.tokens and utils.langchain because importing langchain.chains takes
+about a second: it is only imported when a chat_doc assistant is constructed.
+"""
+import re
+from typing import Any, List, Optional
+
+from langchain.chains import ConversationalRetrievalChain
+from langchain.chains.combine_documents.stuff import StuffDocumentsChain
+from langchain_core.documents import Document
+
+from utils.tokens import TokenCounter, pack_documents, token_counter
+
+
+class BudgetedRetrievalChain(ConversationalRetrievalChain):
+    """ConversationalRetrievalChain whose `max_tokens_limit` is the budget of the whole stuffed
+    prompt: the template and the question are counted too, and the documents fill the rest"""
+
+    token_counter: Any = None
+
+    @property
+    def _counter(self) -> TokenCounter:
+        return self.token_counter if self.token_counter is not None else token_counter
+
+    def _template_tokens(self) -> int:
+        prompt = self.combine_docs_chain.llm_chain.prompt
+        template = getattr(prompt, "template", "")
+        # Placeholders are replaced by the documents and the question, counted separately
+        return self._counter.count(re.sub(r"\{\w+\}", "", template))
+
+    def _reduce_tokens_below_limit(self, docs: List[Document], question: Optional[str] = None) -> List[Document]:
+        if not self.max_tokens_limit or not isinstance(self.combine_docs_chain, StuffDocumentsChain):
+            return docs
+        budget = self.max_tokens_limit - self._template_tokens()
+        if question:
+            budget -= self._counter.count(question)
+        return pack_documents(docs, budget, self._counter,
+                              document_prompt=self.combine_docs_chain.document_prompt,
+                              separator=self.combine_docs_chain.document_separator)
+
+    def _get_docs(self, question, inputs, *, run_manager) -> List[Document]:
+        docs = self.retriever.get_relevant_documents(question, callbacks=run_manager.get_child())
+        return self._reduce_tokens_below_limit(docs, question)
+
+    async def _aget_docs(self, question, inputs, *, run_manager) -> List[Document]:
+        docs = await self.retriever.aget_relevant_documents(question, callbacks=run_manager.get_child())
+        return self._reduce_tokens_below_limit(docs, question)
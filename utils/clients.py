@@ -0,0 +1,240 @@
+"""Process-wide registry of MongoDB and Bedrock clients.
+
+Clients are created once per URI/region and option set and then shared by every
+ShoppingAssistant, retriever and ingestion run in the process, so connection pools and
+TLS sessions are reused instead of being rebuilt per assistant.
+"""
+import threading
+
+import boto3
+import certifi
+from botocore.config import Config
+from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import MongoClient, monitoring
+
+_lock = threading.Lock()
+_mongo_clients = {}
+_async_mongo_clients = {}
+_bedrock_clients = {}
+# service:region -> client, whatever the options
+_registered_bedrock_clients = {}
+
+MONGO_DEFAULTS = {
+    "max_pool_size": 100,
+    "min_pool_size": 0,
+    "max_idle_time_ms": 300000,
+    "server_selection_timeout_ms": 30000,
+    "connect_timeout_ms": 20000,
+    "socket_timeout_ms": None,
+    "compressors": "zlib",
+}
+
+BEDROCK_DEFAULTS = {
+    "max_pool_connections": 50,
+    "tcp_keepalive": True,
+    "connect_timeout": 60,
+    "read_timeout": 120,
+    "max_attempts": 3,
+}
+
+
+def mongo_options_from_env(env):
+    """Reads the MongoDB pool settings from the .env values, see MONGO_DEFAULTS"""
+    options = {}
+    for key, cast in [("max_pool_size", int), ("min_pool_size", int), ("max_idle_time_ms", int),
+                      ("server_selection_timeout_ms", int), ("connect_timeout_ms", int),
+                      ("socket_timeout_ms", int), ("compressors", str)]:
+        value = env.get(f"MDB_{key.upper()}")
+        if value:
+            options[key] = cast(value)
+    return options
+
+
+def bedrock_options_from_env(env):
+    """Reads the bedrock-runtime pool settings from the .env values, see BEDROCK_DEFAULTS"""
+    options = {}
+    for key, cast in [("max_pool_connections", int), ("connect_timeout", int), ("read_timeout", int),
+                      ("max_attempts", int)]:
+        value = env.get(f"BEDROCK_{key.upper()}")
+        if value:
+            options[key] = cast(value)
+    if env.get("BEDROCK_TCP_KEEPALIVE"):
+        options["tcp_keepalive"] = env["BEDROCK_TCP_KEEPALIVE"].lower() in ("1", "true", "yes")
+    return options
+
+
+class PoolListener(monitoring.ConnectionPoolListener):
+    """Counts connection pool events of one MongoClient"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.created = 0
+        self.closed = 0
+        self.checked_out = 0
+        self.checkout_failed = 0
+
+    def _add(self, name, value):
+        with self._lock:
+            setattr(self, name, getattr(self, name) + value)
+
+    def pool_created(self, event):
+        pass
+
+    def pool_ready(self, event):
+        pass
+
+    def pool_cleared(self, event):
+        pass
+
+    def pool_closed(self, event):
+        pass
+
+    def connection_created(self, event):
+        self._add("created", 1)
+
+    def connection_ready(self, event):
+        pass
+
+    def connection_closed(self, event):
+        self._add("closed", 1)
+
+    def connection_check_out_started(self, event):
+        pass
+
+    def connection_check_out_failed(self, event):
+        self._add("checkout_failed", 1)
+
+    def connection_checked_out(self, event):
+        self._add("checked_out", 1)
+
+    def connection_checked_in(self, event):
+        self._add("checked_out", -1)
+
+    def stats(self, max_pool_size):
+        with self._lock:
+            open_connections = self.created - self.closed
+            return {
+                "open": open_connections,
+                "in_use": self.checked_out,
+                "idle": open_connections - self.checked_out,
+                "created": self.created,
+                "checkout_failed": self.checkout_failed,
+                "utilization": self.checked_out / max_pool_size if max_pool_size else 0.0,
+            }
+
+
+def _mongo_kwargs(options):
+    kwargs = {
+        "tlsCAFile": certifi.where(),
+        "maxPoolSize": options["max_pool_size"],
+        "minPoolSize": options["min_pool_size"],
+        "maxIdleTimeMS": options["max_idle_time_ms"],
+        "serverSelectionTimeoutMS": options["server_selection_timeout_ms"],
+        "connectTimeoutMS": options["connect_timeout_ms"],
+        "socketTimeoutMS": options["socket_timeout_ms"],
+    }
+    if options["compressors"]:
+        kwargs["compressors"] = options["compressors"]
+    return kwargs
+
+
+def _key(name, options):
+    return (name, tuple(sorted(options.items())))
+
+
+def get_mongo_client(uri, **options):
+    options = {**MONGO_DEFAULTS, **options}
+    key = _key(uri, options)
+    with _lock:
+        entry = _mongo_clients.get(key)
+        if entry is None:
+            listener = PoolListener()
+            client = MongoClient(uri, event_listeners=[listener], **_mongo_kwargs(options))
+            entry = _mongo_clients[key] = (client, listener, options)
+        return entry[0]
+
+
+def get_async_mongo_client(uri, **options):
+    options = {**MONGO_DEFAULTS, **options}
+    key = _key(uri, options)
+    with _lock:
+        entry = _async_mongo_clients.get(key)
+        if entry is None:
+            listener = PoolListener()
+            client = AsyncIOMotorClient(uri, event_listeners=[listener], **_mongo_kwargs(options))
+            entry = _async_mongo_clients[key] = (client, listener, options)
+        return entry[0]
+
+
+def get_bedrock_client(region_name, service_name="bedrock-runtime", **options):
+    options = {**BEDROCK_DEFAULTS, **options}
+    key = _key(f"{service_name}:{region_name}", options)
+    with _lock:
+        client = _registered_bedrock_clients.get(key[0]) or _bedrock_clients.get(key)
+        if client is None:
+            config = Config(
+                max_pool_connections=options["max_pool_connections"],
+                tcp_keepalive=options["tcp_keepalive"],
+                connect_timeout=options["connect_timeout"],
+                read_timeout=options["read_timeout"],
+                retries={"max_attempts": options["max_attempts"], "mode": "standard"},
+            )
+            client = boto3.client(service_name=service_name, region_name=region_name, config=config)
+            _bedrock_clients[key] = client
+        return client
+
+
+def register_bedrock_client(client, region_name, service_name="bedrock-runtime"):
+    """Makes get_bedrock_client return `client` for the region whatever the options, e.g. utils.fake_bedrock
+    for offline benchmarks"""
+    with _lock:
+        _registered_bedrock_clients[f"{service_name}:{region_name}"] = client
+
+
+def _http_pool_stats(client, max_pool_connections):
+    # botocore keeps one urllib3 pool per host behind the client endpoint
+    stats = {"hosts": 0, "open": 0, "idle": 0, "requests": 0}
+    try:
+        manager = client._endpoint.http_session._manager
+        for pool_key in list(manager.pools.keys()):
+            pool = manager.pools[pool_key]
+            stats["hosts"] += 1
+            stats["open"] += pool.num_connections
+            stats["requests"] += pool.num_requests
+            stats["idle"] += sum(1 for conn in list(pool.pool.queue) if conn is not None)
+    except AttributeError:
+        return stats
+    in_use = max(stats["open"] - stats["idle"], 0)
+    stats["in_use"] = in_use
+    stats["utilization"] = in_use / max_pool_connections if max_pool_connections else 0.0
+    return stats
+
+
+def pool_stats():
+    """Returns the pool utilization of every registered client"""
+    with _lock:
+        mongo = [(uri, listener, options) for (uri, _), (_, listener, options) in _mongo_clients.items()]
+        async_mongo = [(uri, listener, options) for (uri, _), (_, listener, options) in _async_mongo_clients.items()]
+        bedrock = [(name, client, dict(options)) for (name, options), client in _bedrock_clients.items()]
+
+    # Credentials are stripped from the URIs before they end up in metrics
+    return {
+        "mongo": [{"host": uri.split("@")[-1], **listener.stats(options["max_pool_size"])}
+                  for uri, listener, options in mongo],
+        "mongo_async": [{"host": uri.split("@")[-1], **listener.stats(options["max_pool_size"])}
+                        for uri, listener, options in async_mongo],
+        "bedrock": [{"client": name, **_http_pool_stats(client, options["max_pool_connections"])}
+                    for name, client, options in bedrock],
+    }
+
+
+def close_all():
+    with _lock:
+        for client, _, _ in _mongo_clients.values():
+            client.close()
+        for client, _, _ in _async_mongo_clients.values():
+            client.close()
+        _mongo_clients.clear()
+        _async_mongo_clients.clear()
+        _bedrock_clients.clear()
+        _registered_bedrock_clients.clear()
@@ -0,0 +1,161 @@
+"""Compression of the retrieved products before they are stuffed into the answer prompt.
+
+Catalog descriptions and keywords run up to 1,000 characters each and repeat a lot: the
+same marketing sentence in every description, keywords that restate the item name, and
+variants of one product with the same description. ContextCompressor renders the hits as a
+compact table instead of the "Item Name: ... Item Description: ... Item Keywords: ..."
+strings:
+
+- sentences repeated within a description, or shared by most hits, are dropped
+- keywords are de-duplicated, and those already in the item name or common to all hits are dropped
+- variants with the same description are collapsed into one row listing their names
+- each description is cut to the window of sentences that best matches the query, scored
+  locally with IDF weights computed over the hits
+"""
+import math
+import re
+from collections import Counter
+from typing import List, Optional, Tuple
+
+from utils.embedding_cache import normalize_text
+from utils.hybrid import tokenize
+from utils.records import ProductRecord
+from utils.tokens import TokenCounter, token_counter
+
+HEADER = "name | type | description | keywords"
+
+_SENTENCE = re.compile(r"(?<=[.!?;])\s+|\n+")
+_KEYWORD_SEPARATOR = re.compile(r"\s*[,;|]\s*")
+
+
+def split_sentences(text: str) -> List[str]:
+    return [s.strip(" .") for s in _SENTENCE.split(text or "") if s.strip(" .")]
+
+
+def split_keywords(text: str) -> List[str]:
+    # Keywords are either comma separated phrases or a plain list of words
+    parts = _KEYWORD_SEPARATOR.split(text or "") if _KEYWORD_SEPARATOR.search(text or "") else (text or "").split()
+    return [p.strip() for p in parts if p.strip()]
+
+
+def _cell(text: str) -> str:
+    # The column separator must not appear inside a cell
+    return re.sub(r"\s+", " ", text.replace("|", "/")).strip()
+
+
+class ContextCompressor:
+    def __init__(self, max_description_tokens: int = 80, max_keywords: int = 10,
+                 boilerplate_ratio: float = 0.5, counter: TokenCounter = token_counter):
+        self.max_description_tokens = max_description_tokens
+        self.max_keywords = max_keywords
+        # A sentence found in at least this share of the hits (and at least 2) is boilerplate
+        self.boilerplate_ratio = boilerplate_ratio
+        self.counter = counter
+
+    def _boilerplate(self, descriptions) -> set:
+        if len(descriptions) < 2:
+            return set()
+        frequency = Counter(s for sentences in descriptions for s in {normalize_text(s) for s in sentences})
+        threshold = max(2, math.ceil(self.boilerplate_ratio * len(descriptions)))
+        return {s for s, n in frequency.items() if n >= threshold}
+
+    def _clean_sentences(self, sentences, boilerplate):
+        seen = set()
+        kept = []
+        for sentence in sentences:
+            key = normalize_text(sentence)
+            if key in seen or key in boilerplate:
+                continue
+            seen.add(key)
+            kept.append(sentence)
+        return kept
+
+    def _window(self, sentences, query_terms, idf) -> str:
+        """Consecutive sentences around the best scoring one, within max_description_tokens"""
+        if not sentences:
+            return ""
+        scores = [sum(idf.get(t, 0.0) for t in set(tokenize(s)) & query_terms) for s in sentences]
+        best = max(range(len(sentences)), key=lambda i: (scores[i], -i))
+        start = end = best
+        used = self.counter.count(sentences[best])
+        # Grow the window to the side with the better next sentence, the start on ties
+        while True:
+            candidates = []
+            if start > 0:
+                candidates.append((scores[start - 1], 1, start - 1))
+            if end < len(sentences) - 1:
+                candidates.append((scores[end + 1], 0, end + 1))
+            if not candidates:
+                break
+            _, _, i = max(candidates)
+            tokens = self.counter.count(sentences[i])
+            if used + tokens > self.max_description_tokens:
+                break
+            used += tokens
+            start, end = min(start, i), max(end, i)
+        text = ". ".join(sentences[start:end + 1])
+        if used > self.max_description_tokens:
+            # A single sentence longer than the window
+            text = self.counter.truncate(text, self.max_description_tokens)
+        return text
+
+    def _keywords(self, record, query_terms, common) -> List[str]:
+        name_terms = set(tokenize(record.item_name))
+        seen = set()
+        keywords = []
+        for keyword in split_keywords(record.item_keywords):
+            key = normalize_text(keyword)
+            terms = set(tokenize(keyword))
+            if not terms or key in seen or key in common or terms <= name_terms:
+                continue
+            seen.add(key)
+            keywords.append((bool(terms & query_terms), keyword))
+        # Keywords matching the query first, the catalog order otherwise
+        keywords.sort(key=lambda k: not k[0])
+        return [k for _, k in keywords[:self.max_keywords]]
+
+    def compress(self, query: Optional[str], records: List[ProductRecord]) -> List[Tuple[str, ProductRecord]]:
+        """One table row per distinct product, with the first record it describes. The header
+        is prepended to the first row"""
+        if not records:
+            return []
+        query_terms = set(tokenize(query)) if query else set()
+
+        # Variants (same description and type) are collapsed first, in rank order
+        groups = {}
+        for record in records:
+            key = (normalize_text(record.bullet_point), record.product_type)
+            groups.setdefault(key, []).append(record)
+        groups = list(groups.values())
+
+        descriptions = [split_sentences(group[0].bullet_point) for group in groups]
+        boilerplate = self._boilerplate(descriptions)
+        cleaned = []
+        for sentences in descriptions:
+            # A description made only of boilerplate is kept, de-duplicated
+            cleaned.append(self._clean_sentences(sentences, boilerplate) or self._clean_sentences(sentences, set()))
+
+        sentence_frequency = Counter(t for sentences in cleaned for s in sentences for t in set(tokenize(s)))
+        total = sum(len(sentences) for sentences in cleaned) or 1
+        idf = {t: math.log(1 + total / n) for t, n in sentence_frequency.items()}
+
+        keyword_lists = [{normalize_text(k) for k in split_keywords(group[0].item_keywords)} for group in groups]
+        common = set.intersection(*keyword_lists) if len(groups) > 1 else set()
+
+        rows = []
+        for group, sentences in zip(groups, cleaned):
+            rows.append({"names": [record.item_name for record in group], "record": group[0],
+                         "description": self._window(sentences, query_terms, idf),
+                         "keywords": self._keywords(group[0], query_terms, common)})
+
+        lines = []
+        for row in rows:
+            line = " | ".join([
+                _cell(" / ".join(row["names"])),
+                _cell(str(row["record"].product_type or "").lower()),
+                _cell(row["description"]),
+                _cell(", ".join(row["keywords"])),
+            ])
+            lines.append((line, row["record"]))
+        lines[0] = (f"{HEADER}\n{lines[0][0]}", lines[0][1])
+        return lines
@@ -0,0 +1,84 @@
+"""Splitting multi-product questions into one sub-query per product.
+
+"a hat and matching earrings for a wedding" embedded as a single vector lands between hats
+and earrings and finds neither. QueryDecomposer splits it on conjunctions into "a hat for a
+wedding" and "matching earrings for a wedding", without an LLM call: a split is only kept
+when every part names a product, so "black and white sneakers" stays one query, and only
+when the last part does not refer back to the others: "a ring and a necklace that match"
+and "boots and a case for them" are searched as one query. The retriever searches the sub-queries concurrently and gives each one a share of the k hits.
+"""
+import re
+from typing import Callable, List, Optional
+
+from utils.query_filters import PRODUCT_TYPE_SYNONYMS, _singular
+
+_SEPARATOR = re.compile(r"\s*(?:,|;|&|\bas well as\b|\band also\b|\bplus\b|\band\b)\s*", re.IGNORECASE)
+# Context shared by all the products, e.g. "... for a wedding" or "... under 50 dollars"
+_SHARED_SUFFIX = re.compile(r"\s+((?:for|under|below|to wear|to go with|that|in size)\b.*)$", re.IGNORECASE)
+_WORD = re.compile(r"[a-z]+")
+# The products are wanted together, "matching earrings" on its own is still a product
+_REFERS_BACK = re.compile(r"\b(?:match|matches|them|they|together|each other|one another)\b", re.IGNORECASE)
+
+
+def _product_words():
+    words = {_singular(word) for phrase in PRODUCT_TYPE_SYNONYMS for word in phrase.split()}
+    # Adjectives of the compound synonyms are not products on their own
+    words -= {"fashion", "fine", "flip", "makeup", "cosmetic", "toiletry"}
+    # Plain words of SELECTED_CATEGORIES, the compound ones are covered by the synonyms
+    return words | {"shoe", "sandal", "boot", "jewelry", "hat", "case", "bag"}
+
+
+PRODUCT_WORDS = frozenset(_product_words())
+
+
+class QueryDecomposer:
+    """`is_product` tells whether a part names a product, by default with PRODUCT_WORDS. A
+    QueryConstraintExtractor can be passed instead to recognize every catalog value."""
+
+    def __init__(self, max_intents: int = 4, is_product: Optional[Callable[[str], bool]] = None):
+        self.max_intents = max_intents
+        self.is_product = is_product if is_product is not None else self._names_product
+        self.counters = {"queries": 0, "decomposed": 0}
+
+    @classmethod
+    def from_extractor(cls, extractor, **kwargs) -> "QueryDecomposer":
+        return cls(is_product=lambda part: bool(extractor.extract(part)), **kwargs)
+
+    @staticmethod
+    def _names_product(part: str) -> bool:
+        return any(_singular(word) in PRODUCT_WORDS for word in _WORD.findall(part.lower()))
+
+    def split(self, query: str) -> List[str]:
+        """The sub-queries, or [query] when it asks for a single product"""
+        self.counters["queries"] += 1
+        parts = [p for p in _SEPARATOR.split(query.strip().rstrip("?.!")) if p]
+        if len(parts) < 2:
+            return [query]
+
+        # A part without a product qualifies the next one ("black and white sneakers")
+        merged = []
+        pending = []
+        for part in parts:
+            pending.append(part)
+            if self.is_product(part):
+                merged.append(" and ".join(pending))
+                pending = []
+        if pending:
+            if not merged:
+                return [query]
+            merged[-1] = " and ".join([merged[-1]] + pending)
+        if len(merged) < 2 or len(merged) > self.max_intents or _REFERS_BACK.search(merged[-1]):
+            return [query]
+
+        match = _SHARED_SUFFIX.search(merged[-1])
+        if match and self.is_product(merged[-1][:match.start()]):
+            suffix = match.group(1)
+            merged = [part if part.endswith(suffix) else f"{part} {suffix}" for part in merged]
+        self.counters["decomposed"] += 1
+        return merged
+
+
+def intent_quotas(k: int, intents: int) -> List[int]:
+    """Splits k hits between the intents, earlier intents get the remainder"""
+    base, remainder = divmod(k, intents)
+    return [max(base + (1 if i < remainder else 0), 1) for i in range(intents)]
@@ -0,0 +1,219 @@
+import os
+import sqlite3
+import threading
+import time
+import unicodedata
+from array import array
+from collections import OrderedDict
+from hashlib import sha256
+from typing import List, Optional
+
+from langchain_core.embeddings import Embeddings
+from langchain_core.runnables.config import run_in_executor
+
+
+def normalize_text(text: str) -> str:
+    # Case, unicode form and whitespace differences ("Red  shoes" vs "red shoes")
+    # should not cost an extra Bedrock round trip
+    return " ".join(unicodedata.normalize("NFKC", text).casefold().split())
+
+
+class CachedEmbeddings(Embeddings):
+    """Wraps an Embeddings object (e.g. BedrockEmbeddings) with an in-memory LRU tier
+    and an optional SQLite tier that survives restarts.
+
+    Entries are keyed by model id plus normalized text, so the cache file can be shared
+    between models without collisions.
+    """
+
+    def __init__(self, embeddings: Embeddings, model_id: Optional[str] = None,
+                 max_entries: int = 10000, db_path: Optional[str] = None,
+                 max_disk_entries: int = 1000000):
+        self.embeddings = embeddings
+        self.model_id = model_id or getattr(embeddings, "model_id", embeddings.__class__.__name__)
+        self.max_entries = max_entries
+        self.max_disk_entries = max_disk_entries
+        self.db_path = db_path
+        self._memory = OrderedDict()
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._disk_hits = 0
+        self._misses = 0
+        self._db = self._open_db(db_path) if db_path else None
+        # Rows on disk, kept up to date on insert and evict so that stores don't count the table
+        self._disk_count = self._db.execute("SELECT COUNT(*) FROM embeddings").fetchone()[0] if self._db else 0
+
+    def _open_db(self, db_path):
+        directory = os.path.dirname(db_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        db = sqlite3.connect(db_path, check_same_thread=False)
+        db.execute("PRAGMA journal_mode=WAL")
+        db.execute("PRAGMA synchronous=NORMAL")
+        db.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, vector BLOB NOT NULL, last_used REAL NOT NULL)"
+        )
+        db.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        db.commit()
+        return db
+
+    def _key(self, text: str) -> str:
+        return sha256(f"{self.model_id}\x00{normalize_text(text)}".encode("utf-8")).hexdigest()
+
+    def _get_memory(self, key):
+        vector = self._memory.get(key)
+        if vector is not None:
+            self._memory.move_to_end(key)
+        return vector
+
+    def _put_memory(self, key, vector):
+        self._memory[key] = vector
+        self._memory.move_to_end(key)
+        while len(self._memory) > self.max_entries:
+            self._memory.popitem(last=False)
+
+    def _get_disk(self, keys):
+        if self._db is None or not keys:
+            return {}
+        found = {}
+        # SQLite limits the number of bound parameters per statement
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            rows = self._db.execute(
+                f"SELECT key, vector FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})",
+                chunk,
+            ).fetchall()
+            for key, blob in rows:
+                found[key] = array("f", blob).tolist()
+        if found:
+            self._db.executemany(
+                "UPDATE embeddings SET last_used = ? WHERE key = ?",
+                [(time.time(), key) for key in found],
+            )
+            self._db.commit()
+        return found
+
+    def _put_disk(self, items):
+        if self._db is None or not items:
+            return
+        now = time.time()
+        keys = list(dict.fromkeys(key for key, _ in items))
+        # Primary key lookups, only new keys add a row
+        existing = set()
+        for i in range(0, len(keys), 500):
+            chunk = keys[i:i + 500]
+            existing.update(row[0] for row in self._db.execute(
+                f"SELECT key FROM embeddings WHERE key IN ({','.join('?' * len(chunk))})", chunk))
+        self._db.executemany(
+            "INSERT OR REPLACE INTO embeddings (key, vector, last_used) VALUES (?, ?, ?)",
+            [(key, array("f", vector).tobytes(), now) for key, vector in items],
+        )
+        self._disk_count += len(keys) - len(existing)
+        if self._disk_count > self.max_disk_entries:
+            evicted = self._db.execute(
+                "DELETE FROM embeddings WHERE key IN "
+                "(SELECT key FROM embeddings ORDER BY last_used LIMIT ?)",
+                (self._disk_count - self.max_disk_entries,),
+            ).rowcount
+            self._disk_count -= evicted
+        self._db.commit()
+
+    def _lookup(self, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                vector = self._get_memory(key)
+                if vector is not None:
+                    found[key] = vector
+            memory_hits = len(found)
+            from_disk = self._get_disk([key for key in keys if key not in found])
+            for key, vector in from_disk.items():
+                self._put_memory(key, vector)
+            found.update(from_disk)
+            self._hits += memory_hits
+            self._disk_hits += len(from_disk)
+            self._misses += len(keys) - len(found)
+            return found
+
+    def _store(self, items):
+        with self._lock:
+            for key, vector in items:
+                self._put_memory(key, vector)
+            self._put_disk(items)
+
+    def _partition(self, texts):
+        keys = [self._key(text) for text in texts]
+        found = self._lookup(list(dict.fromkeys(keys)))
+        missing = {}
+        for key, text in zip(keys, texts):
+            if key not in found and key not in missing:
+                missing[key] = text
+        return keys, found, missing
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = self._partition(texts)
+        if missing:
+            computed = list(zip(missing.keys(), self.embeddings.embed_documents(list(missing.values()))))
+            self._store(computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    def embed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        found = self._lookup([key])
+        if key in found:
+            return found[key]
+        vector = self.embeddings.embed_query(text)
+        self._store([(key, vector)])
+        return vector
+
+    async def _in_thread(self, fn, *args):
+        # SQLite reads and writes block, they run on a thread instead of the event loop
+        if self._db is None:
+            return fn(*args)
+        return await run_in_executor(None, fn, *args)
+
+    async def aembed_documents(self, texts: List[str]) -> List[List[float]]:
+        keys, found, missing = await self._in_thread(self._partition, texts)
+        if missing:
+            vectors = await self.embeddings.aembed_documents(list(missing.values()))
+            computed = list(zip(missing.keys(), vectors))
+            await self._in_thread(self._store, computed)
+            found.update(computed)
+        return [found[key] for key in keys]
+
+    async def aembed_query(self, text: str) -> List[float]:
+        key = self._key(text)
+        found = await self._in_thread(self._lookup, [key])
+        if key in found:
+            return found[key]
+        vector = await self.embeddings.aembed_query(text)
+        await self._in_thread(self._store, [(key, vector)])
+        return vector
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self._hits + self._disk_hits + self._misses
+            return {
+                "model_id": self.model_id,
+                "memory_entries": len(self._memory),
+                "hits": self._hits,
+                "disk_hits": self._disk_hits,
+                "misses": self._misses,
+                "hit_rate": (self._hits + self._disk_hits) / lookups if lookups else 0.0,
+            }
+
+    def clear(self):
+        with self._lock:
+            self._memory.clear()
+            if self._db is not None:
+                self._db.execute("DELETE FROM embeddings")
+                self._db.commit()
+            self._disk_count = 0
+
+    def close(self):
+        with self._lock:
+            if self._db is not None:
+                self._db.close()
+                self._db = None
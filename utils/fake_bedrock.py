@@ -0,0 +1,174 @@
+"""In-process stand-in for the bedrock-runtime client, for benchmarks and offline runs.
+
+It answers invoke_model and invoke_model_with_response_stream like the real client for
+Titan embeddings and Anthropic completions, after a configurable latency, and reports the
+token counts in the same headers and stream metrics as Bedrock.
+
+It can also enforce quotas per model id, requests per `throttle_window` seconds and
+concurrent requests, and answers over quota with the ThrottlingException Bedrock raises,
+to exercise utils.ratelimit offline.
+"""
+import io
+import json
+import re
+import threading
+import time
+from collections import deque
+from hashlib import md5
+
+import numpy as np
+from botocore.exceptions import ClientError
+
+DEFAULT_COMPLETION = ("Here are some products from our catalog that match what you are looking for. "
+                      "Let me know if you would like more details on any of them.")
+
+# What the structured chat agent parses as its final answer
+DEFAULT_AGENT_COMPLETION = ('Action:\n```json\n{\n  "action": "Final Answer",\n  "action_input": "'
+                            + DEFAULT_COMPLETION + '"\n}\n```')
+
+_WORD = re.compile(r"\w+")
+
+
+def fake_embedding(text: str, dim: int = 1536):
+    """Deterministic bag-of-words vector, so similar texts get similar embeddings"""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in _WORD.findall(text.lower()):
+        vector[int(md5(word.encode("utf-8")).hexdigest(), 16) % dim] += 1.0
+    norm = np.linalg.norm(vector)
+    return (vector / norm if norm else vector).tolist()
+
+
+def _approx_tokens(text: str) -> int:
+    return len(text) // 4 + 1
+
+
+class FakeBedrockRuntime:
+    """Duck-typed bedrock-runtime client.
+
+    Latencies are in seconds: `completion_latency` until the first token, then
+    `token_latency` per streamed chunk, and `embedding_latency` per embedding call.
+
+    Quotas are off by default: `max_requests` per `throttle_window` seconds and
+    `max_concurrency` requests in flight, per model id.
+    """
+
+    def __init__(self, completion: str = DEFAULT_COMPLETION, agent_completion: str = DEFAULT_AGENT_COMPLETION,
+                 completion_latency: float = 0.0, token_latency: float = 0.0, embedding_latency: float = 0.0,
+                 embedding_dim: int = 1536, chunk_words: int = 3, max_requests: int = None,
+                 throttle_window: float = 60.0, max_concurrency: int = None):
+        self.completion = completion
+        self.agent_completion = agent_completion
+        self.completion_latency = completion_latency
+        self.token_latency = token_latency
+        self.embedding_latency = embedding_latency
+        self.embedding_dim = embedding_dim
+        self.chunk_words = chunk_words
+        self.max_requests = max_requests
+        self.throttle_window = throttle_window
+        self.max_concurrency = max_concurrency
+        self._lock = threading.Lock()
+        self._recent = {}
+        self._in_flight = {}
+        self.calls = {"embedding": 0, "completion": 0, "stream": 0, "throttled": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.calls[name] += 1
+
+    def _admit(self, model_id, operation):
+        """Counts a request against the quotas of the model, or raises ThrottlingException"""
+        now = time.monotonic()
+        with self._lock:
+            recent = self._recent.setdefault(model_id, deque())
+            while recent and recent[0] <= now - self.throttle_window:
+                recent.popleft()
+            in_flight = self._in_flight.get(model_id, 0)
+            if ((self.max_requests is not None and len(recent) >= self.max_requests)
+                    or (self.max_concurrency is not None and in_flight >= self.max_concurrency)):
+                self.calls["throttled"] += 1
+                raise ClientError({"Error": {"Code": "ThrottlingException", "Message": "Too many requests, please wait before trying again."},
+                                   "ResponseMetadata": {"HTTPStatusCode": 429}}, operation)
+            recent.append(now)
+            self._in_flight[model_id] = in_flight + 1
+
+    def _done(self, model_id):
+        with self._lock:
+            self._in_flight[model_id] -= 1
+
+    def _complete(self, body):
+        prompt = body.get("prompt", "")
+        # The structured chat agent prompt asks for a JSON blob with an "action" key
+        return self.agent_completion if '"action"' in prompt else self.completion
+
+    def _headers(self, input_tokens, output_tokens):
+        return {
+            "x-amzn-bedrock-input-token-count": str(input_tokens),
+            "x-amzn-bedrock-output-token-count": str(output_tokens),
+        }
+
+    def invoke_model(self, body, modelId, accept=None, contentType=None, **kwargs):
+        self._admit(modelId, "InvokeModel")
+        try:
+            return self._invoke_model(body, modelId)
+        finally:
+            self._done(modelId)
+
+    def _invoke_model(self, body, modelId):
+        request = json.loads(body)
+        if "embed" in modelId:
+            self._count("embedding")
+            time.sleep(self.embedding_latency)
+            text = request.get("inputText", "")
+            payload = {"embedding": fake_embedding(text, self.embedding_dim),
+                       "inputTextTokenCount": _approx_tokens(text)}
+            headers = self._headers(_approx_tokens(text), 0)
+        else:
+            self._count("completion")
+            completion = self._complete(request)
+            time.sleep(self.completion_latency + self.token_latency * len(completion.split()) / self.chunk_words)
+            payload = {"completion": completion, "stop_reason": "stop_sequence"}
+            headers = self._headers(_approx_tokens(request.get("prompt", "")), _approx_tokens(completion))
+        return {
+            "body": io.BytesIO(json.dumps(payload).encode("utf-8")),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": headers},
+        }
+
+    def invoke_model_with_response_stream(self, body, modelId, accept=None, contentType=None, **kwargs):
+        self._admit(modelId, "InvokeModelWithResponseStream")
+        self._count("stream")
+        request = json.loads(body)
+        completion = self._complete(request)
+        input_tokens = _approx_tokens(request.get("prompt", ""))
+        return {
+            "body": self._stream(modelId, completion, input_tokens),
+            "contentType": "application/json",
+            "ResponseMetadata": {"HTTPStatusCode": 200, "HTTPHeaders": {}},
+        }
+
+    def _stream(self, model_id, completion, input_tokens):
+        try:
+            yield from self._chunks(completion, input_tokens)
+        finally:
+            # The stream is in flight until it is read
+            self._done(model_id)
+
+    def _chunks(self, completion, input_tokens):
+        started = time.time()
+        time.sleep(self.completion_latency)
+        words = completion.split(" ")
+        chunks = [" ".join(words[i:i + self.chunk_words]) for i in range(0, len(words), self.chunk_words)]
+        for i, text in enumerate(chunks):
+            if self.token_latency:
+                time.sleep(self.token_latency)
+            chunk = {"completion": (" " if i else "") + text, "stop_reason": None}
+            if i == len(chunks) - 1:
+                chunk["stop_reason"] = "stop_sequence"
+                # Bedrock appends the invocation metrics to the last chunk
+                chunk["amazon-bedrock-invocationMetrics"] = {
+                    "inputTokenCount": input_tokens,
+                    "outputTokenCount": _approx_tokens(completion),
+                    "invocationLatency": int((time.time() - started) * 1000),
+                    "firstByteLatency": int(self.completion_latency * 1000),
+                }
+            yield {"chunk": {"bytes": json.dumps(chunk).encode("utf-8")}}
@@ -0,0 +1,114 @@
+"""Hybrid lexical + vector retrieval.
+
+Brand names, SKUs and other exact keywords are often missed by the embeddings alone, so
+MongoDBExtendedRetriever can run an Atlas Search `$search` over the item name and keywords
+next to `$vectorSearch` and merge both rankings with reciprocal rank fusion (RRF).
+"""
+import math
+import re
+from collections import Counter
+from typing import Dict, List, Optional, Sequence
+
+from utils.records import ProductRecord, product_projection
+
+SOURCE_FIELD = "_hybrid_source"
+
+_TOKEN = re.compile(r"\w+")
+
+
+def tokenize(text) -> List[str]:
+    return _TOKEN.findall(str(text).lower()) if text else []
+
+
+def reciprocal_rank_fusion(rankings: Sequence[List[ProductRecord]], weights: Sequence[float], k: int,
+                           rrf_k: int = 60, key=lambda record: record.key) -> List[ProductRecord]:
+    """Merges ranked lists of records, score(d) = sum(weight / (rrf_k + rank(d)))"""
+    scores: Dict = {}
+    records = {}
+    for ranking, weight in zip(rankings, weights):
+        if not weight:
+            continue
+        for rank, record in enumerate(ranking, start=1):
+            record_key = key(record)
+            scores[record_key] = scores.get(record_key, 0.0) + weight / (rrf_k + rank)
+            records.setdefault(record_key, record)
+    best = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [records[record_key] for record_key in best]
+
+
+def hybrid_pipeline(query: str, embedding: List[float], collection_name: str, vector_index: str,
+                    text_index: str, text_paths: List[str], limit: int, embedding_key: str = "embedding",
+                    pre_filter: Optional[dict] = None, num_candidates: Optional[int] = None,
+                    include_embedding: bool = False) -> List[dict]:
+    """One aggregation returning the top `limit` hits of both searches, tagged by source.
+
+    `$search` does not take MQL filters, so `pre_filter` is applied to the text hits with a
+    `$match` instead.
+    """
+    projected_embedding = embedding_key if include_embedding else None
+    vector_search = {
+        "queryVector": embedding,
+        "path": embedding_key,
+        "numCandidates": num_candidates or limit * 10,
+        "limit": limit,
+        "index": vector_index,
+    }
+    if pre_filter:
+        vector_search["filter"] = pre_filter
+
+    text_pipeline = [
+        {"$search": {"index": text_index, "text": {"query": query, "path": text_paths}}},
+    ]
+    if pre_filter:
+        text_pipeline.append({"$match": pre_filter})
+    text_pipeline += [
+        {"$limit": limit},
+        product_projection("searchScore", {SOURCE_FIELD: {"$literal": "text"}}, projected_embedding),
+    ]
+
+    return [
+        {"$vectorSearch": vector_search},
+        product_projection("vectorSearchScore", {SOURCE_FIELD: {"$literal": "vector"}}, projected_embedding),
+        {"$unionWith": {"coll": collection_name, "pipeline": text_pipeline}},
+    ]
+
+
+def split_rankings(results, embedding_key: str = "embedding") -> tuple:
+    """Splits the tagged results of hybrid_pipeline into the vector and the text ranking"""
+    vector, text = [], []
+    for res in results:
+        record = ProductRecord.from_result(res, embedding_key=embedding_key)
+        (text if res.get(SOURCE_FIELD) == "text" else vector).append(record)
+    vector.sort(key=lambda record: -record.score)
+    text.sort(key=lambda record: -record.score)
+    return vector, text
+
+
+class BM25Index:
+    """Small in-process BM25 index, the local stand-in for Atlas Search"""
+
+    def __init__(self, documents: List[str], k1: float = 1.2, b: float = 0.75):
+        self.k1 = k1
+        self.b = b
+        self.term_freqs = [Counter(tokenize(text)) for text in documents]
+        self.lengths = [sum(tf.values()) for tf in self.term_freqs]
+        self.avg_length = sum(self.lengths) / len(self.lengths) if self.lengths else 0.0
+        self.postings: Dict[str, List[int]] = {}
+        for i, tf in enumerate(self.term_freqs):
+            for term in tf:
+                self.postings.setdefault(term, []).append(i)
+        n = len(documents)
+        self.idf = {term: math.log(1 + (n - len(ids) + 0.5) / (len(ids) + 0.5))
+                    for term, ids in self.postings.items()}
+
+    def search(self, query: str, k: int, candidates=None):
+        """Returns [(doc index, score)] for the best `k` documents containing a query term"""
+        scores: Dict[int, float] = {}
+        for term in set(tokenize(query)):
+            for i in self.postings.get(term, ()):
+                if candidates is not None and i not in candidates:
+                    continue
+                tf = self.term_freqs[i][term]
+                norm = tf + self.k1 * (1 - self.b + self.b * self.lengths[i] / self.avg_length)
+                scores[i] = scores.get(i, 0.0) + self.idf[term] * tf * (self.k1 + 1) / norm
+        return sorted(scores.items(), key=lambda hit: -hit[1])[:k]
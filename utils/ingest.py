@@ -0,0 +1,222 @@
+"""Streaming catalog ingestion into MongoDB Atlas.
+
+Reads the product CSV in chunks, applies the same truncation and category filters as the
+notebook, embeds the item names on a bounded thread pool and upserts the documents with
+unordered bulk writes. Progress is checkpointed after every chunk so a rerun resumes where
+the previous run stopped.
+
+Usage:
+    python -m utils.ingest --csv data/product_data.csv
+"""
+import argparse
+import json
+import logging
+import math
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+from langchain_community.embeddings.bedrock import BedrockEmbeddings
+from pymongo import UpdateOne
+
+from utils.answer_cache import bump_catalog_version
+from utils.clients import bedrock_options_from_env, get_bedrock_client, get_mongo_client, mongo_options_from_env
+from utils.embedding_cache import CachedEmbeddings
+from utils.load_env import load_env
+from utils.ratelimit import BACKGROUND, LIMITED_CLIENT_OPTIONS, RateLimitedBedrockClient, bedrock_limiter
+
+logger = logging.getLogger(__name__)
+
+MAX_TEXT_LENGTH = 1000  # Maximum num of text characters to use
+
+SELECTED_CATEGORIES = ['SHOES', 'SANDAL', 'BOOT', 'JEWELRY', 'FASHIONRING', 'FINEEARRING', 'FASHIONEARRING', 'HAT',
+                       'COSMETIC_CASE', 'FASHIONNECKLACEBRACELETANKLET', 'FINENECKLACEBRACELETANKLET']
+
+
+def auto_truncate(val):
+    """Truncate the given text."""
+    return val[:MAX_TEXT_LENGTH]
+
+
+class Checkpoint:
+    """Persists the number of CSV rows already written and the per category counts"""
+
+    def __init__(self, path, resume=True):
+        self.path = path
+        self.rows_done = 0
+        self.category_counts = {}
+        if resume and path and os.path.isfile(path):
+            with open(path) as f:
+                state = json.load(f)
+            self.rows_done = state["rows_done"]
+            self.category_counts = state["category_counts"]
+
+    def save(self):
+        if not self.path:
+            return
+        directory = os.path.dirname(self.path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        tmp_path = f"{self.path}.tmp"
+        with open(tmp_path, "w") as f:
+            json.dump({"rows_done": self.rows_done, "category_counts": self.category_counts}, f)
+        # Atomic rename, so a crash never leaves a half written checkpoint
+        os.replace(tmp_path, self.path)
+
+    def clear(self):
+        if self.path and os.path.isfile(self.path):
+            os.remove(self.path)
+
+
+class CatalogIngestor:
+    def __init__(self, collection, embeddings, text_field="item_name", id_field="item_id",
+                 categories=SELECTED_CATEGORIES, max_per_category=None, chunk_size=1000,
+                 embed_batch_size=16, max_workers=8, checkpoint_path=".cache/ingest_checkpoint.json",
+                 resume=True):
+        self.collection = collection
+        self.embeddings = embeddings
+        self.text_field = text_field
+        self.id_field = id_field
+        self.categories = set(categories) if categories else None
+        self.max_per_category = max_per_category
+        self.chunk_size = chunk_size
+        self.embed_batch_size = embed_batch_size
+        self.max_workers = max_workers
+        self.checkpoint = Checkpoint(checkpoint_path, resume=resume)
+
+    def read_chunks(self, csv_path):
+        return pd.read_csv(csv_path, chunksize=self.chunk_size, converters={
+            'bullet_point': auto_truncate,
+            'item_keywords': auto_truncate,
+            'item_name': auto_truncate
+        })
+
+    def filter_chunk(self, df):
+        # Same filters as the notebook: products need keywords and a selected category
+        df = df[df['item_keywords'] != '']
+        df = df.dropna(subset=['item_keywords'])
+        if self.categories is not None:
+            df = df[df['product_type'].isin(self.categories)]
+        if self.max_per_category is None:
+            return df
+
+        keep = []
+        counts = self.checkpoint.category_counts
+        for index, category in df['product_type'].items():
+            if counts.get(category, 0) < self.max_per_category:
+                counts[category] = counts.get(category, 0) + 1
+                keep.append(index)
+        return df.loc[keep]
+
+    def embed(self, executor, texts):
+        batches = [texts[i:i + self.embed_batch_size] for i in range(0, len(texts), self.embed_batch_size)]
+        vectors = []
+        for batch_vectors in executor.map(self.embeddings.embed_documents, batches):
+            vectors.extend(batch_vectors)
+        return vectors
+
+    def to_documents(self, df, vectors):
+        documents = []
+        for record, vector in zip(df.to_dict(orient='records'), vectors):
+            metadata = {k: (None if isinstance(v, float) and math.isnan(v) else v) for k, v in record.items()}
+            # Same document shape as MongoDBAtlasVectorSearch.from_texts
+            documents.append({"text": record[self.text_field], "embedding": vector, **metadata})
+        return documents
+
+    def write(self, documents):
+        if not documents:
+            return 0
+        operations = []
+        for document in documents:
+            if self.id_field in document and document[self.id_field] is not None:
+                # Upserts keep reruns idempotent
+                operations.append(UpdateOne({self.id_field: document[self.id_field]}, {"$set": document}, upsert=True))
+            else:
+                operations.append(UpdateOne({"text": document["text"]}, {"$set": document}, upsert=True))
+        result = self.collection.bulk_write(operations, ordered=False)
+        return result.upserted_count + result.modified_count
+
+    def run(self, csv_path):
+        start = time.time()
+        rows_read = 0
+        rows_written = 0
+        skip = self.checkpoint.rows_done
+        if skip:
+            logger.info(f"Resuming after {skip} rows")
+
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            for chunk in self.read_chunks(csv_path):
+                chunk_end = rows_read + len(chunk)
+                if chunk_end <= skip:
+                    rows_read = chunk_end
+                    continue
+                if rows_read < skip:
+                    chunk = chunk.iloc[skip - rows_read:]
+
+                df = self.filter_chunk(chunk)
+                texts = df[self.text_field].tolist()
+                vectors = self.embed(executor, texts)
+                rows_written += self.write(self.to_documents(df, vectors))
+
+                rows_read = chunk_end
+                self.checkpoint.rows_done = rows_read
+                self.checkpoint.save()
+
+                elapsed = time.time() - start
+                logger.info(f"Read {rows_read} rows, wrote {rows_written} products "
+                      f"({(rows_read - skip) / elapsed:.1f} rows/sec)")
+
+        elapsed = time.time() - start
+        logger.info(f"Finished in {elapsed:.1f}s: {rows_written} products written "
+              f"({(rows_read - skip) / elapsed if elapsed else 0:.1f} rows/sec)")
+
+        self.checkpoint.clear()
+        bump_catalog_version(self.collection)
+        return rows_written
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load the product catalog into MongoDB Atlas")
+    parser.add_argument("--csv", default="data/product_data.csv")
+    parser.add_argument("--env", default=".env")
+    parser.add_argument("--chunk-size", type=int, default=1000, help="CSV rows read per chunk")
+    parser.add_argument("--workers", type=int, default=8, help="Concurrent embedding requests")
+    parser.add_argument("--batch-size", type=int, default=16, help="Texts per embedding task")
+    parser.add_argument("--max-per-category", type=int, default=None,
+                        help="Limit products per category (default: full catalog)")
+    parser.add_argument("--all-categories", action="store_true", help="Do not filter on product_type")
+    parser.add_argument("--checkpoint", default=".cache/ingest_checkpoint.json")
+    parser.add_argument("--restart", action="store_true", help="Ignore an existing checkpoint")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO, format="%(asctime)s %(message)s")
+
+    env = load_env(args.env)
+    # One pooled connection per embedding worker
+    bedrock_options = {"max_pool_connections": args.workers, **bedrock_options_from_env(env), **LIMITED_CLIENT_OPTIONS}
+    # Ingestion yields to the answers of the assistants running in the same process
+    bedrock_limiter.configure_from_env(env)
+    bedrock_client = RateLimitedBedrockClient(get_bedrock_client(env.get('REGION'), **bedrock_options), level=BACKGROUND)
+    embeddings = CachedEmbeddings(
+        BedrockEmbeddings(client=bedrock_client, model_id='amazon.titan-embed-text-v1'),
+        db_path=env.get('EMBEDDING_CACHE_PATH', '.cache/embeddings.sqlite')
+    )
+    client = get_mongo_client(env.get("MDB_URI"), **mongo_options_from_env(env))
+    collection = client[env.get('MDB_DATABASE')][env.get('MDB_COLLECTION')]
+
+    ingestor = CatalogIngestor(
+        collection,
+        embeddings,
+        categories=None if args.all_categories else SELECTED_CATEGORIES,
+        max_per_category=args.max_per_category,
+        chunk_size=args.chunk_size,
+        embed_batch_size=args.batch_size,
+        max_workers=args.workers,
+        checkpoint_path=args.checkpoint,
+        resume=not args.restart,
+    )
+    ingestor.run(args.csv)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,45 +1,78 @@
-import boto3
-from langchain.chains import ConversationChain, ConversationalRetrievalChain, RetrievalQA
-from langchain.llms.bedrock import Bedrock
-from langchain.chat_models.bedrock import BedrockChat
-from langchain.memory import ConversationBufferMemory
-from langchain.prompts import PromptTemplate
-from langchain.agents import AgentType, initialize_agent
-from langchain.schema import BaseMessage
-from langchain.prompts.chat import MessagesPlaceholder
+from langchain_core.messages import BaseMessage
+from langchain_core.prompts import MessagesPlaceholder, PromptTemplate
+from langchain_core.runnables.config import run_in_executor
+from utils.memory import DEFAULT_SESSION, ConversationMemory
+from utils.model_routing import COMPLEX_ANSWER, CONDENSE, SIMPLE_ANSWER, TOOL_SELECTION, RoutedBedrockClient, answer_route
+from utils.rewrite import QuestionRewriter
+from utils.streaming import FINAL_ANSWER_TAG, aiterate_tokens, iterate_tokens
+from utils.tracing import AGENT_TAG, CONDENSE_TAG, TracingCallbackHandler, tracer as default_tracer
+# The LangChain chains, agents and LLMs take seconds to import, they are imported by the
+# load_* method that needs them, so an assistant only pays for its own model type
 #import langchain
 
 class LangChainAssistant():
     # We are also providing a different chat history retriever which outputs the history as a Claude chat (ie including the \n\n)
-    _ROLE_MAP = {"human": "\n\nHuman: ", "ai": "\n\nAssistant: "}
+    _ROLE_MAP = {"human": "\n\nHuman: ", "ai": "\n\nAssistant: ", "system": "\n\n"}
 
     def __init__(self, modelId,bedrock_client, model_args = {"temperature": 0.7, "max_tokens_to_sample": 2048},
-                model_type="chat_doc", retriever = None, chat_memory= None, prompt_data = None,
-                tools=None, logger=None):
+                model_type="chat_doc", retriever = None, memory= None, prompt_data = None,
+                tools=None, logger=None, answer_cache=None, tracer=None, model_router=None):
         self.bedrock_a= bedrock_client
+        # Optional ModelRouter, picks the model of each call type, see utils.model_routing
+        self.model_router = model_router
+        # Spans and metrics of every call, see utils.tracing
+        self.tracer = tracer if tracer is not None else default_tracer
         self.retriever = retriever
+        # Optional SemanticAnswerCache, only consulted for questions without chat history
+        self.answer_cache = answer_cache
         self.model_type = model_type
         if model_type == "chat_doc":
-            self.llm, self.model, self.memory  = self.load_chat_doc_model(modelId, model_args, prompt_data, chat_memory)
+            self.llm, self.model, self.memory  = self.load_chat_doc_model(modelId, model_args, prompt_data, memory)
         elif model_type == "chat_agent":
-            self.llm, self.model, self.memory  = self.load_agent_model(modelId, model_args,prompt_data, tools, chat_memory)
+            self.llm, self.model, self.memory  = self.load_agent_model(modelId, model_args,prompt_data, tools, memory)
         elif model_type == "chat_qa":
             self.llm, self.model  = self.load_qa_model(modelId, model_args,prompt_data)
 
         self.logger = logger
     
-    def run(self, input_text):
-        if hasattr(self, 'memory'):
-            print(self.memory.buffer)
-
-        if self.model_type == "chat_doc":
-            result= self.chat_doc(input_text)
-        elif self.model_type == "chat_agent":
-            result = self.chat_agent(input_text)
+    def run(self, input_text, session_id=DEFAULT_SESSION, callbacks=[]):
+        with self.tracer.trace(self.model_type, session_id=session_id) as trace:
+            callbacks = callbacks + [TracingCallbackHandler(self.tracer, trace)]
+            if self.model_type == "chat_doc":
+                result= self.chat_doc(input_text, callbacks=callbacks, session_id=session_id)
+            elif self.model_type == "chat_agent":
+                result = self.chat_agent(input_text, callbacks=callbacks, session_id=session_id)
         return result
 
+    async def arun(self, input_text, session_id=DEFAULT_SESSION, callbacks=[]):
+        with self.tracer.trace(self.model_type, session_id=session_id) as trace:
+            callbacks = callbacks + [TracingCallbackHandler(self.tracer, trace)]
+            if self.model_type == "chat_doc":
+                result = await self.achat_doc(input_text, callbacks=callbacks, session_id=session_id)
+            elif self.model_type == "chat_agent":
+                result = await self.achat_agent(input_text, callbacks=callbacks, session_id=session_id)
+        return result
+
+    def stream(self, input_text, session_id=DEFAULT_SESSION):
+        """Yields the answer tokens as Bedrock generates them"""
+        return iterate_tokens(lambda callbacks: self.run(input_text, session_id=session_id, callbacks=callbacks),
+                              agent=self.model_type == "chat_agent")
+
+    def astream(self, input_text, session_id=DEFAULT_SESSION):
+        return aiterate_tokens(lambda callbacks: self.arun(input_text, session_id=session_id, callbacks=callbacks),
+                               agent=self.model_type == "chat_agent")
+
+
+    def _client(self, route, modelId):
+        # Each LLM gets its own client, the route of its calls is fixed when it is built
+        if self.model_router is None:
+            return self.bedrock_a
+        return RoutedBedrockClient(self.bedrock_a, route, modelId, router=self.model_router)
 
     def load_chat_model(self, modelId, model_args, chat_memory):
+        from langchain.chains import ConversationChain
+        from langchain.memory import ConversationBufferMemory
+        from langchain_community.llms.bedrock import Bedrock
 
         #print('In chat')
         # Setup bedrock
@@ -59,18 +92,21 @@ class LangChainAssistant():
         return llm, model, memory
     
     def chat(self, input_text):
-        #num_tokens = self.llm.get_num_tokens(input_text)
-        num_tokens = 0 #Commenting for performance
-        response = self.model.predict(input=input_text)
+        with self.tracer.trace("chat") as trace:
+            response = self.model.predict(input=input_text, callbacks=[TracingCallbackHandler(self.tracer, trace)])
+        # Counted by Bedrock rather than a local tokenizer, see InstrumentedBedrockClient
+        num_tokens = trace.usage["input_tokens"]
         return response, num_tokens
     
     def load_qa_model(self, modelId, model_args, prompt_data):
+        from langchain.chains import RetrievalQA
+        from langchain_community.chat_models.bedrock import BedrockChat
 
         #print('In chat doc')
         # Setup bedrock
         llm = BedrockChat(
             model_id= modelId,
-            client= self.bedrock_a,
+            client= self._client(COMPLEX_ANSWER, modelId),
         )
         llm.model_kwargs = model_args
 
@@ -89,14 +125,27 @@ class LangChainAssistant():
         
         return llm, model
 
-    def load_chat_doc_model(self, modelId, model_args, prompt_data, chat_memory):
+    def load_chat_doc_model(self, modelId, model_args, prompt_data, memory):
+        from langchain_community.llms.bedrock import Bedrock
+        from utils.chains import BudgetedRetrievalChain
         #print('In chat doc')
         # Setup bedrock
+        # Bedrock only implements the async call on top of the response stream API
         llm = Bedrock(
             model_id= modelId,
-            client= self.bedrock_a,
+            client= self._client(COMPLEX_ANSWER, modelId),
+            streaming=True,
+            # Only the answer is streamed to the user, not the condensed question
+            tags=[FINAL_ANSWER_TAG],
         )
         llm.model_kwargs = model_args
+        condense_llm = Bedrock(
+            model_id= modelId,
+            client= self._client(CONDENSE, modelId),
+            streaming=True,
+            tags=[CONDENSE_TAG],
+        )
+        condense_llm.model_kwargs = model_args
 
         if 'anthropic' in modelId:
             condense_prompt = self._create_prompt_template_claude()
@@ -105,34 +154,99 @@ class LangChainAssistant():
             condense_prompt = self._create_prompt_template()
             prompt_template = f"{prompt_data}"
 
-        memory = self._load_chat_memory(chat_memory)
-        model = ConversationalRetrievalChain.from_llm(
-            llm=llm, 
-            retriever =self.retriever,
-            memory=memory,
-            verbose=True,
-            condense_question_prompt= condense_prompt, 
-            chain_type='stuff', # 'refine',
-            return_source_documents=True,
-            get_chat_history=self._get_chat_history,
-            max_tokens_limit=4096
-        )
+        # The chain is shared by all sessions, the history of each session is passed in per call
+        memory = memory if memory is not None else ConversationMemory()
 
-        model.combine_docs_chain.llm_chain.prompt = PromptTemplate.from_template(prompt_template)
+        def answer_chain(llm):
+            # max_tokens_limit is the budget of the whole stuffed prompt, see utils.tokens
+            model = BudgetedRetrievalChain.from_llm(
+                llm=llm,
+                retriever =self.retriever,
+                verbose=True,
+                condense_question_prompt= condense_prompt,
+                condense_question_llm=condense_llm,
+                chain_type='stuff', # 'refine',
+                return_source_documents=True,
+                get_chat_history=self._get_chat_history,
+                max_tokens_limit=4096
+            )
+            model.combine_docs_chain.llm_chain.prompt = PromptTemplate.from_template(prompt_template)
+            if getattr(self.retriever, "compressor", None) is not None:
+                # The documents are the rows of one table
+                model.combine_docs_chain.document_separator = "\n"
+            return model
+
+        model = answer_chain(llm)
+        # Single-product questions are answered by the simple_answer route. Async calls reach
+        # the client in another thread, so the route is fixed per chain rather than per call
+        self.simple_model = model
+        if self.model_router is not None:
+            simple_llm = Bedrock(model_id=modelId, client=self._client(SIMPLE_ANSWER, modelId), streaming=True,
+                                 tags=[FINAL_ANSWER_TAG])
+            simple_llm.model_kwargs = model_args
+            self.simple_model = answer_chain(simple_llm)
+        # The question is made standalone before the chain is called, so the chain itself
+        # never sees the history and never calls condense_llm
+        self.rewriter = QuestionRewriter(model.question_generator, self._get_chat_history)
         
         return llm, model, memory
+
+    def _answer_model(self, question):
+        if self.model_router is None:
+            return self.model
+        route = answer_route(question, getattr(self.retriever, "decomposer", None))
+        return self.simple_model if route == SIMPLE_ANSWER else self.model
     
-    def chat_doc(self, input_text, callbacks=[]):
-        response = self.model(input_text)
+    def chat_doc(self, input_text, callbacks=[], session_id=DEFAULT_SESSION):
+        chat_history = self.memory.messages(session_id)
+        # Follow-up questions depend on the history, so only first turns are cacheable
+        use_cache = self.answer_cache is not None and not self.memory.has_history(session_id)
+        if use_cache:
+            cached = self.answer_cache.lookup(input_text)
+            if cached is not None:
+                self.memory.save_turn(session_id, input_text, cached["answer"])
+                return cached["answer"]
+
+        question = self.rewriter.rewrite(input_text, chat_history, callbacks=callbacks)
+        response = self._answer_model(question).invoke({"question": question, "chat_history": []}, config={"callbacks": callbacks})
+        self.memory.save_turn(session_id, input_text, response['answer'])
+        if use_cache:
+            self.answer_cache.store(input_text, response['answer'], response.get('source_documents'))
+        return response['answer']
+
+    def _history(self, session_id):
+        return self.memory.messages(session_id), self.memory.has_history(session_id)
+
+    async def achat_doc(self, input_text, callbacks=[], session_id=DEFAULT_SESSION):
+        # The memory can be in MongoDB and summarize with an LLM, it runs on a thread so the
+        # event loop keeps serving the other sessions
+        chat_history, has_history = await run_in_executor(None, self._history, session_id)
+        use_cache = self.answer_cache is not None and not has_history
+        if use_cache:
+            cached = await self.answer_cache.alookup(input_text)
+            if cached is not None:
+                await run_in_executor(None, self.memory.save_turn, session_id, input_text, cached["answer"])
+                return cached["answer"]
+
+        question = await self.rewriter.arewrite(input_text, chat_history, callbacks=callbacks)
+        response = await self._answer_model(question).ainvoke({"question": question, "chat_history": []}, config={"callbacks": callbacks})
+        await run_in_executor(None, self.memory.save_turn, session_id, input_text, response['answer'])
+        if use_cache:
+            await self.answer_cache.astore(input_text, response['answer'], response.get('source_documents'))
         return response['answer']
     
-    def load_agent_model(self, modelId, model_args, prefix, tools, chat_memory):
+    def load_agent_model(self, modelId, model_args, prefix, tools, memory):
+        from langchain.agents import AgentExecutor, StructuredChatAgent
+        from langchain_community.chat_models.bedrock import BedrockChat
         #print('In chat doc')
         # Setup bedrock
         
+        # Streaming lets stream() forward the final answer while it is generated
         llm = BedrockChat(
             model_id= modelId,
-            client= self.bedrock_a,
+            client= self._client(TOOL_SELECTION, modelId),
+            streaming=True,
+            tags=[AGENT_TAG],
         )
         llm.model_kwargs = model_args
 
@@ -144,57 +258,46 @@ class LangChainAssistant():
         """
         #langchain.debug=True
 
-        memory = ConversationBufferMemory(
-            k= 3,
-            ai_prefix="Assistant",
-            memory_key="chat_history",
-            return_messages=True
-        )
-        memory.chat_memory.add_ai_message(f"How can I help you?")
+        memory = memory if memory is not None else ConversationMemory(initial_ai_message="How can I help you?")
 
         chat_history = MessagesPlaceholder(variable_name="chat_history")
 
-        #memory = self._load_chat_memory(chat_memory)
-        model = initialize_agent(
-            tools,
+        # What initialize_agent(agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION) builds,
+        # without its deprecation check that inspects every loaded module (~0.4s)
+        agent = StructuredChatAgent.from_llm_and_tools(
             llm,
-            agent=AgentType.STRUCTURED_CHAT_ZERO_SHOT_REACT_DESCRIPTION,
-            verbose=True,
-            max_iterations=2,
-            agent_kwargs={
-                "prefix": PREFIX,
-                # 'format_instructions':FORMAT_INSTRUCTIONS,
-                'suffix' : SUFFIX,
-                "memory_prompts": [chat_history],
-                "input_variables": ["input", "agent_scratchpad", "chat_history"]
-            },
-            memory=memory,
+            tools,
+            prefix=PREFIX,
+            # format_instructions=FORMAT_INSTRUCTIONS,
+            suffix=SUFFIX,
+            memory_prompts=[chat_history],
+            input_variables=["input", "agent_scratchpad", "chat_history"],
             #prompt= ANTHROPIC_PROMPT,
         )
+        model = AgentExecutor.from_agent_and_tools(agent=agent, tools=tools, verbose=True, max_iterations=2)
 
         #print(model.agent.llm_chain.prompt.template)
         
         return llm, model, memory
     
     
-    def chat_agent(self, input_text, callbacks=[]):
-        response = self.model.run(input_text)
+    def chat_agent(self, input_text, callbacks=[], session_id=DEFAULT_SESSION):
+        response = self.model.invoke({"input": input_text, "chat_history": self.memory.messages(session_id)},
+                                     config={"callbacks": callbacks})["output"]
+        self.memory.save_turn(session_id, input_text, response)
+        return response
+
+    async def achat_agent(self, input_text, callbacks=[], session_id=DEFAULT_SESSION):
+        chat_history = await run_in_executor(None, self.memory.messages, session_id)
+        response = (await self.model.ainvoke({"input": input_text, "chat_history": chat_history},
+                                             config={"callbacks": callbacks}))["output"]
+        await run_in_executor(None, self.memory.save_turn, session_id, input_text, response)
         return response
     
-    def clear_history(self, initial_text=None):
-        self.model.memory.clear()
-        if initial_text is not None:
-            self.model.memory.chat_memory.add_ai_message(initial_text)
+    def clear_history(self, initial_text=None, session_id=DEFAULT_SESSION):
+        self.memory.clear(session_id, initial_text=initial_text)
         #self.logger.info("History cleared")
         return True
-    
-    def _load_chat_memory(self, chat_memory):
-        if chat_memory is not None:
-            memory = ConversationBufferMemory(ai_prefix="Assistant", k=3, memory_key="chat_history", chat_memory=chat_memory, output_key="answer", return_messages=True)
-        else:
-            memory = ConversationBufferMemory(memory_key="chat_history", k=3, ai_prefix="Assistant", output_key="answer", return_messages=True)
-
-        return memory
 
 
     def _get_claude_prompt(self):
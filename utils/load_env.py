@@ -1,8 +1,20 @@
+import os
+
+# Parsed files by path, re-read when the file changes
+_cache = {}
+
+
 def load_env(file_path=".env"):
-    with open(file_path, 'r') as f:
+    path = os.path.abspath(file_path)
+    mtime = os.stat(path).st_mtime_ns
+    cached = _cache.get(path)
+    if cached is not None and cached[0] == mtime:
+        return dict(cached[1])
+    with open(path, 'r') as f:
         env = f.readlines()
     dic = {}
     for l in env:
         key, *val = l.strip('\n').split('=')
         dic[key] = '='.join(val)
-    return dic
\ No newline at end of file
+    _cache[path] = (mtime, dic)
+    return dict(dic)
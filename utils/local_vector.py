@@ -0,0 +1,272 @@
+import json
+import logging
+import threading
+import time
+from typing import Any, Dict, Iterable, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+from langchain_core.vectorstores import VectorStore
+
+from utils.answer_cache import get_catalog_version
+from utils.hybrid import BM25Index
+from utils.records import ProductRecord
+
+try:
+    import faiss
+except ImportError:
+    faiss = None
+
+logger = logging.getLogger(__name__)
+
+_COMPARISONS = {
+    "$eq": lambda value, arg: value == arg,
+    "$ne": lambda value, arg: value != arg,
+    "$gt": lambda value, arg: value is not None and value > arg,
+    "$gte": lambda value, arg: value is not None and value >= arg,
+    "$lt": lambda value, arg: value is not None and value < arg,
+    "$lte": lambda value, arg: value is not None and value <= arg,
+    "$in": lambda value, arg: value in arg,
+    "$nin": lambda value, arg: value not in arg,
+}
+
+
+def matches_filter(metadata: dict, query: Optional[dict]) -> bool:
+    """Evaluates the subset of MongoDB query operators supported by Atlas vector search filters"""
+    if not query:
+        return True
+    for key, condition in query.items():
+        if key == "$and":
+            if not all(matches_filter(metadata, q) for q in condition):
+                return False
+        elif key == "$or":
+            if not any(matches_filter(metadata, q) for q in condition):
+                return False
+        elif isinstance(condition, dict):
+            value = metadata.get(key)
+            for op, arg in condition.items():
+                if op not in _COMPARISONS:
+                    raise ValueError(f"Unsupported filter operator: {op}")
+                if not _COMPARISONS[op](value, arg):
+                    return False
+        elif metadata.get(key) != condition:
+            return False
+    return True
+
+
+class _IndexState:
+    __slots__ = ("matrix", "texts", "metadatas", "index", "lexical")
+
+    def __init__(self, matrix, texts, metadatas):
+        self.matrix = matrix
+        self.texts = texts
+        self.metadatas = metadatas
+        self.index = None
+        # BM25 indexes per set of text fields, built on first use
+        self.lexical = {}
+        if faiss is not None and len(texts):
+            self.index = faiss.IndexFlatIP(matrix.shape[1])
+            self.index.add(matrix)
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+class LocalVectorSearch(VectorStore):
+    """In-process cosine similarity search over the product embeddings.
+
+    The embeddings are loaded from a MongoDB collection (Atlas or a plain mongod) or from a
+    snapshot file, and kept in a FAISS flat index when faiss is installed, else in a NumPy
+    matrix. Results have the same Document/metadata shape as MongoDBAtlasVectorSearch, so
+    MongoDBExtendedRetriever works on top of either backend.
+    """
+
+    def __init__(self, embedding: Embeddings, collection=None, text_key: str = "text",
+                 embedding_key: str = "embedding", refresh_interval: Optional[float] = None,
+                 load_batch_size: int = 1000):
+        self._embedding = embedding
+        self._collection = collection
+        self._text_key = text_key
+        self._embedding_key = embedding_key
+        self._load_batch_size = load_batch_size
+        self._state = _IndexState(np.zeros((0, 0), dtype=np.float32), [], [])
+        self._refresh_lock = threading.Lock()
+        self._stop = threading.Event()
+        self.last_refresh = None
+        # Stamp of the catalog loaded last, see utils.answer_cache.bump_catalog_version
+        self.catalog_version = None
+        if collection is not None:
+            self.refresh()
+            if refresh_interval:
+                thread = threading.Thread(target=self._refresh_loop, args=(refresh_interval,), daemon=True)
+                thread.start()
+
+    @property
+    def embeddings(self) -> Embeddings:
+        return self._embedding
+
+    def _refresh_loop(self, interval):
+        while not self._stop.wait(interval):
+            try:
+                self.refresh_if_changed()
+            except Exception as e:
+                logger.warning(f"Local vector index refresh failed: {e}")
+
+    def refresh_if_changed(self) -> bool:
+        """Reloads the collection if ingestion bumped the catalog version since the last load"""
+        if get_catalog_version(self._collection) == self.catalog_version:
+            return False
+        self.refresh()
+        return True
+
+    def stop(self):
+        self._stop.set()
+
+    def _set_state(self, vectors, texts, metadatas):
+        if vectors:
+            matrix = _normalize(np.asarray(vectors, dtype=np.float32))
+        else:
+            matrix = np.zeros((0, 0), dtype=np.float32)
+        # Searches keep using the old state until this single reference swap
+        self._state = _IndexState(np.ascontiguousarray(matrix), texts, metadatas)
+        self.last_refresh = time.time()
+
+    def refresh(self):
+        """Reloads all embeddings and metadata from the collection"""
+        with self._refresh_lock:
+            # Read first: a version bumped during the load triggers the next reload
+            version = get_catalog_version(self._collection)
+            vectors, texts, metadatas = [], [], []
+            cursor = self._collection.find({self._embedding_key: {"$exists": True}},
+                                           batch_size=self._load_batch_size)
+            for doc in cursor:
+                vectors.append(doc.pop(self._embedding_key))
+                texts.append(doc.pop(self._text_key, ""))
+                metadatas.append(doc)
+            self._set_state(vectors, texts, metadatas)
+            self.catalog_version = version
+            logger.info(f"Loaded {len(texts)} products (catalog version {version}) into local vector index")
+
+    def save(self, path: str):
+        """Writes a snapshot (<path>.npy and <path>.json) usable without any MongoDB"""
+        state = self._state
+        np.save(f"{path}.npy", state.matrix)
+        with open(f"{path}.json", "w") as f:
+            json.dump({"texts": state.texts, "metadatas": state.metadatas}, f, default=str)
+
+    @classmethod
+    def load(cls, path: str, embedding: Embeddings, **kwargs) -> "LocalVectorSearch":
+        store = cls(embedding, **kwargs)
+        matrix = np.load(f"{path}.npy")
+        with open(f"{path}.json") as f:
+            data = json.load(f)
+        store._state = _IndexState(matrix, data["texts"], data["metadatas"])
+        store.last_refresh = time.time()
+        return store
+
+    def add_texts(self, texts: Iterable[str], metadatas: Optional[List[dict]] = None,
+                  **kwargs: Any) -> List[int]:
+        texts = list(texts)
+        metadatas = metadatas or [{} for _ in texts]
+        vectors = self._embedding.embed_documents(texts)
+        with self._refresh_lock:
+            state = self._state
+            all_vectors = state.matrix.tolist() + vectors
+            start = len(state.texts)
+            self._set_state(all_vectors, state.texts + texts, state.metadatas + list(metadatas))
+        return list(range(start, start + len(texts)))
+
+    def _candidates(self, state, pre_filter):
+        if not pre_filter:
+            return None
+        return np.array([i for i, metadata in enumerate(state.metadatas) if matches_filter(metadata, pre_filter)],
+                        dtype=np.int64)
+
+    def _vector_hits(self, state, embedding, k, pre_filter):
+        if not state.texts:
+            return []
+        query = _normalize(np.asarray(embedding, dtype=np.float32)[None, :])
+        candidates = self._candidates(state, pre_filter)
+
+        if candidates is None and state.index is not None:
+            scores, ids = state.index.search(query, min(k, len(state.texts)))
+            return [(int(i), float(s)) for i, s in zip(ids[0], scores[0]) if i >= 0]
+
+        matrix = state.matrix if candidates is None else state.matrix[candidates]
+        if not len(matrix):
+            return []
+        scores = matrix @ query[0]
+        top = np.argpartition(-scores, min(k, len(scores)) - 1)[:k]
+        top = top[np.argsort(-scores[top])]
+        ids = top if candidates is None else candidates[top]
+        return [(int(i), float(scores[j])) for i, j in zip(ids, top)]
+
+    def _text_hits(self, state, query, k, paths, pre_filter):
+        if not state.texts:
+            return []
+        paths = tuple(paths or (self._text_key,))
+        index = state.lexical.get(paths)
+        if index is None:
+            index = state.lexical[paths] = BM25Index([
+                " ".join(str(text if path == self._text_key else metadata.get(path, "")) for path in paths)
+                for text, metadata in zip(state.texts, state.metadatas)
+            ])
+        candidates = self._candidates(state, pre_filter)
+        return index.search(query, k, candidates=None if candidates is None else set(candidates.tolist()))
+
+    def _documents(self, state, hits):
+        # Same shape as MongoDBAtlasVectorSearch: the text becomes page_content, the rest metadata
+        return [(Document(page_content=state.texts[i], metadata=dict(state.metadatas[i])), score)
+                for i, score in hits]
+
+    def _records(self, state, hits, with_embeddings=False):
+        return [ProductRecord.from_result(state.metadatas[i], score=score,
+                                          embedding=state.matrix[i] if with_embeddings else None)
+                for i, score in hits]
+
+    def similarity_search_records(self, embedding: List[float], k: int = 4, pre_filter: Optional[Dict] = None,
+                                  with_embeddings: bool = False) -> List[ProductRecord]:
+        """Like similarity_search_by_vector, without building Documents"""
+        state = self._state
+        return self._records(state, self._vector_hits(state, embedding, k, pre_filter), with_embeddings)
+
+    def text_search_records(self, query: str, k: int = 4, paths: Optional[List[str]] = None,
+                            pre_filter: Optional[Dict] = None, with_embeddings: bool = False) -> List[ProductRecord]:
+        """Keyword search over the metadata fields in `paths`, standing in for Atlas Search"""
+        state = self._state
+        return self._records(state, self._text_hits(state, query, k, paths, pre_filter), with_embeddings)
+
+    def similarity_search_by_vector_with_score(self, embedding: List[float], k: int = 4,
+                                               pre_filter: Optional[Dict] = None,
+                                               **kwargs: Any) -> List[Tuple[Document, float]]:
+        state = self._state
+        return self._documents(state, self._vector_hits(state, embedding, k, pre_filter))
+
+    def text_search_with_score(self, query: str, k: int = 4, paths: Optional[List[str]] = None,
+                               pre_filter: Optional[Dict] = None) -> List[Tuple[Document, float]]:
+        state = self._state
+        return self._documents(state, self._text_hits(state, query, k, paths, pre_filter))
+
+    def similarity_search_with_score(self, query: str, k: int = 4, pre_filter: Optional[Dict] = None,
+                                     **kwargs: Any) -> List[Tuple[Document, float]]:
+        embedding = self._embedding.embed_query(query)
+        return self.similarity_search_by_vector_with_score(embedding, k=k, pre_filter=pre_filter)
+
+    def similarity_search(self, query: str, k: int = 4, pre_filter: Optional[Dict] = None,
+                          **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_with_score(query, k=k, pre_filter=pre_filter)]
+
+    def similarity_search_by_vector(self, embedding: List[float], k: int = 4,
+                                    **kwargs: Any) -> List[Document]:
+        return [doc for doc, _ in self.similarity_search_by_vector_with_score(embedding, k=k, **kwargs)]
+
+    @classmethod
+    def from_texts(cls, texts: List[str], embedding: Embeddings, metadatas: Optional[List[dict]] = None,
+                   **kwargs: Any) -> "LocalVectorSearch":
+        store = cls(embedding, **kwargs)
+        store.add_texts(texts, metadatas)
+        return store
@@ -0,0 +1,255 @@
+"""Per-session conversation memory with a hard token budget.
+
+Every session keeps its last `window_turns` exchanges verbatim. Older exchanges are folded
+into a rolling summary, and the summary plus the window never exceed `max_tokens`. Sessions
+live in an in-process LRU store or in a MongoDB collection, so they survive restarts and
+can be served by any replica.
+"""
+import logging
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import List, Optional
+
+from langchain_core.messages import AIMessage, BaseMessage, HumanMessage, SystemMessage, messages_from_dict, messages_to_dict
+
+from utils.tokens import token_counter
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_SESSION = "default"
+
+SUMMARY_PREFIX = "Summary of the earlier conversation: "
+
+SUMMARY_PROMPT = """
+
+Human: Progressively summarize the lines of a conversation between a shopper and ShoppingBot, adding onto the previous summary and returning a new summary.
+Keep product names, order ids, quantities, return reasons and email addresses.
+
+<summary>{summary}</summary>
+
+<new_lines>{new_lines}</new_lines>
+
+Only output the new summary.
+
+Assistant:"""
+
+
+def _format_lines(messages):
+    # Not "Human:"/"Assistant:", the Bedrock LLM would read every line as a turn of the prompt
+    return "\n".join(f"{'Shopper' if m.type == 'human' else 'ShoppingBot'}: {m.content}" for m in messages)
+
+
+class InMemorySessionStore:
+    """Keeps session state in process, evicting idle or least recently used sessions"""
+
+    def __init__(self, max_sessions: int = 10000, ttl: float = 3600):
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions = OrderedDict()
+        self._lock = threading.Lock()
+
+    def load(self, session_id):
+        with self._lock:
+            state = self._sessions.get(session_id)
+            if state is None:
+                return None
+            if time.time() - state["updated_at"] > self.ttl:
+                del self._sessions[session_id]
+                return None
+            self._sessions.move_to_end(session_id)
+            return {"messages": list(state["messages"]), "summary": state["summary"]}
+
+    def save(self, session_id, messages, summary):
+        with self._lock:
+            self._sessions[session_id] = {"messages": list(messages), "summary": summary, "updated_at": time.time()}
+            self._sessions.move_to_end(session_id)
+            while len(self._sessions) > self.max_sessions:
+                self._sessions.popitem(last=False)
+
+    def delete(self, session_id):
+        with self._lock:
+            self._sessions.pop(session_id, None)
+
+
+class MongoSessionStore:
+    """Stores session state in a MongoDB collection, expired by a TTL index on updated_at"""
+
+    def __init__(self, collection, ttl: float = 86400):
+        self.collection = collection
+        self.ttl = ttl
+        # The TTL index is created by the first write, not by every assistant built
+        self._indexed = False
+        self._index_lock = threading.Lock()
+
+    def ensure_indexes(self):
+        with self._index_lock:
+            if not self._indexed:
+                self.collection.create_index("updated_at", expireAfterSeconds=int(self.ttl))
+                self._indexed = True
+
+    def load(self, session_id):
+        doc = self.collection.find_one({"_id": session_id})
+        if doc is None:
+            return None
+        return {"messages": messages_from_dict(doc["messages"]), "summary": doc.get("summary", "")}
+
+    def save(self, session_id, messages, summary):
+        self.ensure_indexes()
+        self.collection.replace_one(
+            {"_id": session_id},
+            {"messages": messages_to_dict(messages), "summary": summary,
+             "updated_at": datetime.now(timezone.utc)},
+            upsert=True,
+        )
+
+    def delete(self, session_id):
+        self.collection.delete_one({"_id": session_id})
+
+
+class NamespacedSessionStore:
+    """Lets several assistants share one store without mixing up their histories"""
+
+    def __init__(self, store, namespace):
+        self.store = store
+        self.namespace = namespace
+
+    def _key(self, session_id):
+        return f"{self.namespace}:{session_id}"
+
+    def load(self, session_id):
+        return self.store.load(self._key(session_id))
+
+    def save(self, session_id, messages, summary):
+        self.store.save(self._key(session_id), messages, summary)
+
+    def delete(self, session_id):
+        self.store.delete(self._key(session_id))
+
+
+class ConversationMemory:
+    """Session-keyed chat history shared by all the sessions of one LangChainAssistant.
+
+    `summary_llm` is optional: without it, dropped turns are kept as a truncated transcript
+    instead of an LLM written summary, which costs no extra Bedrock call.
+
+    Writes load, prune and save the session state, they run one at a time per session so
+    that two turns of a session finishing together do not drop one another.
+    """
+
+    def __init__(self, store=None, max_tokens: int = 2000, window_turns: int = 3,
+                 summary_tokens: Optional[int] = None, summary_llm=None,
+                 initial_ai_message: Optional[str] = None, count_tokens=token_counter):
+        self.store = store if store is not None else InMemorySessionStore()
+        self.max_tokens = max_tokens
+        self.window_turns = window_turns
+        self.summary_tokens = summary_tokens if summary_tokens is not None else max_tokens // 3
+        self.summary_llm = summary_llm
+        self.initial_ai_message = initial_ai_message
+        self.count_tokens = count_tokens
+        # session id -> lock, dropped once no write of the session holds it
+        self._locks = weakref.WeakValueDictionary()
+        self._locks_lock = threading.Lock()
+
+    def _session_lock(self, session_id):
+        with self._locks_lock:
+            lock = self._locks.get(session_id)
+            if lock is None:
+                lock = self._locks[session_id] = threading.Lock()
+            return lock
+
+    def _load(self, session_id):
+        state = self.store.load(session_id)
+        if state is None:
+            messages = [AIMessage(content=self.initial_ai_message)] if self.initial_ai_message else []
+            return messages, ""
+        return state["messages"], state["summary"]
+
+    def messages(self, session_id: str = DEFAULT_SESSION) -> List[BaseMessage]:
+        """The history to put in the prompt: the rolling summary followed by the recent turns"""
+        messages, summary = self._load(session_id)
+        if summary:
+            return [SystemMessage(content=f"{SUMMARY_PREFIX}{summary}")] + messages
+        return messages
+
+    def has_history(self, session_id: str = DEFAULT_SESSION) -> bool:
+        messages, summary = self._load(session_id)
+        return bool(summary) or any(m.type == "human" for m in messages)
+
+    def save_turn(self, session_id: str, human: str, ai: str):
+        with self._session_lock(session_id):
+            messages, summary = self._load(session_id)
+            messages = messages + [HumanMessage(content=human), AIMessage(content=ai)]
+            messages, summary = self._prune(messages, summary)
+            self.store.save(session_id, messages, summary)
+
+    def add_ai_message(self, session_id: str, text: str):
+        with self._session_lock(session_id):
+            messages, summary = self._load(session_id)
+            self.store.save(session_id, messages + [AIMessage(content=text)], summary)
+
+    def clear(self, session_id: str = DEFAULT_SESSION, initial_text: Optional[str] = None):
+        with self._session_lock(session_id):
+            self.store.delete(session_id)
+            if initial_text is not None:
+                self.store.save(session_id, [AIMessage(content=initial_text)], "")
+
+    def _tokens(self, messages, summary):
+        summary_tokens = self.count_tokens(SUMMARY_PREFIX + summary) if summary else 0
+        return summary_tokens + sum(self.count_tokens(m.content) for m in messages)
+
+    def _prune(self, messages, summary):
+        dropped = []
+        # Sliding window: a turn is a human message, the answer to it and anything before it
+        while sum(1 for m in messages if m.type == "human") > self.window_turns:
+            cut = self._first_turn_end(messages)
+            dropped.extend(messages[:cut])
+            messages = messages[cut:]
+        while sum(1 for m in messages if m.type == "human") > 1 and self._tokens(messages, summary) > self.max_tokens:
+            cut = self._first_turn_end(messages)
+            dropped.extend(messages[:cut])
+            messages = messages[cut:]
+
+        if dropped:
+            summary = self._summarize(summary, dropped)
+
+        # Hard budget: trim the summary first, then the oldest remaining messages
+        overflow = self._tokens(messages, summary) - self.max_tokens
+        if overflow > 0 and summary:
+            summary = self._truncate(summary, self.count_tokens(summary) - overflow, keep_end=True)
+            overflow = self._tokens(messages, summary) - self.max_tokens
+        for i, message in enumerate(messages):
+            if overflow <= 0:
+                break
+            tokens = self.count_tokens(message.content)
+            content = self._truncate(message.content, tokens - overflow)
+            messages[i] = message.__class__(content=content)
+            overflow -= tokens - self.count_tokens(content)
+        return messages, summary
+
+    def _first_turn_end(self, messages):
+        first_human = next(i for i, m in enumerate(messages) if m.type == "human")
+        return min(first_human + 2, len(messages))
+
+    def _truncate(self, text, tokens, keep_end=False):
+        if tokens <= 0:
+            return ""
+        chars = max(int(len(text) * tokens / max(self.count_tokens(text), 1)) - 1, 0)
+        return text[-chars:] if keep_end else text[:chars]
+
+    def _summarize(self, summary, dropped):
+        new_lines = _format_lines(dropped)
+        if self.summary_llm is not None:
+            try:
+                summary = self.summary_llm.predict(SUMMARY_PROMPT.format(summary=summary, new_lines=new_lines)).strip()
+            except Exception as e:
+                logger.warning(f"Could not summarize conversation: {e}")
+                summary = f"{summary}\n{new_lines}".strip()
+        else:
+            summary = f"{summary}\n{new_lines}".strip()
+        if self.count_tokens(summary) > self.summary_tokens:
+            # The most recent part of the transcript is the most relevant one
+            summary = self._truncate(summary, self.summary_tokens, keep_end=True)
+        return summary
@@ -0,0 +1,239 @@
+"""Model choice per call type, with latency budgets and fallbacks.
+
+Every LLM call of LangChainAssistant belongs to a route:
+
+- condense: rewriting a follow-up into a standalone question
+- tool_selection: the agent picking a tool (or giving its final answer)
+- simple_answer: answering a single-product question from the retrieved products
+- complex_answer: answering multi-product or comparison questions
+
+Each route lists models in order of preference and a latency budget. ModelRouter sends a
+call to the first model whose recent p95 latency is within the budget and that is not
+rate limited (see utils.ratelimit), and falls back to the next, faster one otherwise. The
+high-volume, low-complexity routes default to Claude Instant. Routing is off unless
+MODEL_ROUTING=true.
+
+The LLMs are built with the primary model and RoutedBedrockClient swaps the model id of
+each request, so the models of a route must share a request format (same provider).
+Decisions are counted in the metrics, kept in memory and optionally appended to a JSON
+lines file.
+"""
+import json
+import logging
+import re
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+from attrs import define
+
+from utils.ratelimit import bedrock_limiter
+from utils.tracing import tracer as default_tracer
+
+CONDENSE = "condense"
+TOOL_SELECTION = "tool_selection"
+SIMPLE_ANSWER = "simple_answer"
+COMPLEX_ANSWER = "complex_answer"
+
+# Stands for the model the assistant was created with
+PRIMARY = "primary"
+FAST_MODEL = "anthropic.claude-instant-v1"
+
+ROUTE_METRIC = "shopping_model_route_total"
+
+logger = logging.getLogger(__name__)
+
+
+@define(kw_only=True)
+class Route:
+    # Model ids in order of preference, the last one is used whatever its latency
+    models: List[str]
+    # Seconds, p95 of the recent calls of a model, up to the first chunk for streamed calls
+    latency_budget: float
+
+
+DEFAULT_ROUTES = {
+    CONDENSE: Route(models=[FAST_MODEL], latency_budget=2.0),
+    TOOL_SELECTION: Route(models=[PRIMARY, FAST_MODEL], latency_budget=6.0),
+    SIMPLE_ANSWER: Route(models=[FAST_MODEL], latency_budget=5.0),
+    COMPLEX_ANSWER: Route(models=[PRIMARY, FAST_MODEL], latency_budget=10.0),
+}
+
+_COMPARISON = re.compile(r"\b(?:compare|comparison|difference|differences|versus|vs|better|best between|which one)\b",
+                         re.IGNORECASE)
+
+
+def answer_route(question: str, decomposer=None, max_simple_words: int = 30) -> str:
+    """complex_answer for multi-product, comparison and long questions, simple_answer otherwise"""
+    if decomposer is not None and len(decomposer.split(question)) > 1:
+        return COMPLEX_ANSWER
+    if _COMPARISON.search(question) or len(question.split()) > max_simple_words:
+        return COMPLEX_ANSWER
+    return SIMPLE_ANSWER
+
+
+def parse_routes(spec: str) -> Dict[str, Route]:
+    """MODEL_ROUTES format: route=model,model@budget_seconds;route=..."""
+    routes = {}
+    for entry in filter(None, (e.strip() for e in spec.split(';'))):
+        name, _, value = entry.partition('=')
+        models, _, budget = value.partition('@')
+        default = DEFAULT_ROUTES.get(name.strip())
+        routes[name.strip()] = Route(models=[m.strip() for m in models.split(',') if m.strip()],
+                                     latency_budget=float(budget) if budget else (default.latency_budget if default else 10.0))
+    return routes
+
+
+class _LatencyWindow:
+    """Latencies of the last `seconds`: a model that fell back recovers once its slow calls age out"""
+
+    def __init__(self, seconds: float = 120.0):
+        self.seconds = seconds
+        self.samples = deque()
+
+    def add(self, latency):
+        self.samples.append((time.monotonic(), latency))
+
+    def p95(self, min_samples):
+        cutoff = time.monotonic() - self.seconds
+        while self.samples and self.samples[0][0] < cutoff:
+            self.samples.popleft()
+        if len(self.samples) < min_samples:
+            return None
+        latencies = sorted(latency for _, latency in self.samples)
+        return latencies[min(len(latencies) - 1, int(round(0.95 * (len(latencies) - 1))))]
+
+
+class ModelRouter:
+    """Process-wide routing policy, see the module docstring"""
+
+    def __init__(self, routes: Optional[Dict[str, Route]] = None, limiter=bedrock_limiter, tracer=default_tracer,
+                 window_seconds: float = 120.0, min_samples: int = 5, log_path: Optional[str] = None,
+                 max_decisions: int = 1000, enabled: bool = True):
+        self.routes = dict(DEFAULT_ROUTES if routes is None else routes)
+        self.limiter = limiter
+        self.tracer = tracer
+        self.window_seconds = window_seconds
+        # Fewer samples than this and the model is assumed to be within budget
+        self.min_samples = min_samples
+        self.log_path = log_path
+        self.enabled = enabled
+        self.decisions = deque(maxlen=max_decisions)
+        self._latencies: Dict[str, _LatencyWindow] = {}
+        self._lock = threading.Lock()
+
+    def configure_from_env(self, env):
+        self.enabled = env.get('MODEL_ROUTING', 'false').lower() == 'true'
+        if env.get('MODEL_ROUTES'):
+            self.routes = {**DEFAULT_ROUTES, **parse_routes(env['MODEL_ROUTES'])}
+        if env.get('ROUTING_LOG'):
+            self.log_path = env['ROUTING_LOG']
+
+    def candidates(self, route: str, primary: str) -> List[str]:
+        config = self.routes.get(route)
+        if not self.enabled or config is None:
+            return [primary]
+        provider = primary.split('.')[0]
+        models = []
+        for model in config.models:
+            model = primary if model == PRIMARY else model
+            # Another provider would need another request body
+            if model.split('.')[0] == provider and model not in models:
+                models.append(model)
+        return models or [primary]
+
+    def latency_p95(self, model_id) -> Optional[float]:
+        with self._lock:
+            window = self._latencies.get(model_id)
+            return window.p95(self.min_samples) if window is not None else None
+
+    def observe(self, model_id, latency):
+        with self._lock:
+            window = self._latencies.get(model_id)
+            if window is None:
+                window = self._latencies[model_id] = _LatencyWindow(self.window_seconds)
+            window.add(latency)
+
+    def choose(self, route: str, primary: str) -> str:
+        models = self.candidates(route, primary)
+        budget = self.routes[route].latency_budget if route in self.routes else None
+        skipped = []
+        for i, model in enumerate(models):
+            p95 = self.latency_p95(model)
+            if i < len(models) - 1:
+                if self.limiter is not None and self.limiter.saturated(model):
+                    skipped.append({"model": model, "reason": "rate_limited", "p95": p95})
+                    continue
+                if budget is not None and p95 is not None and p95 > budget:
+                    skipped.append({"model": model, "reason": "over_budget", "p95": p95})
+                    continue
+            self._record(route, model, p95, budget, skipped)
+            return model
+
+    def _record(self, route, model, p95, budget, skipped):
+        reason = skipped[-1]["reason"] if skipped else "preferred"
+        decision = {"time": time.time(), "route": route, "model": model, "reason": reason,
+                    "p95": p95, "budget": budget, "skipped": skipped}
+        self.decisions.append(decision)
+        self.tracer.inc(ROUTE_METRIC, route=route, model=model, reason=reason)
+        if self.log_path:
+            try:
+                with self._lock, open(self.log_path, "a") as f:
+                    f.write(json.dumps(decision) + "\n")
+            except OSError as e:
+                logger.warning(f"Could not write routing decision: {e}")
+
+    def stats(self) -> dict:
+        """Calls and fallbacks per route and model, over the recent decisions"""
+        stats = {}
+        for decision in list(self.decisions):
+            route = stats.setdefault(decision["route"], {})
+            model = route.setdefault(decision["model"], {"calls": 0, "fallbacks": 0})
+            model["calls"] += 1
+            model["fallbacks"] += decision["reason"] != "preferred"
+        return stats
+
+
+# Shared by every assistant of the process, so latencies are learned from all calls. Off until
+# configure_from_env finds MODEL_ROUTING=true
+model_router = ModelRouter(enabled=False)
+
+
+class RoutedBedrockClient:
+    """Wraps the bedrock-runtime client of one LLM: its requests go to the model `router`
+    chooses for `route`, instead of `primary`"""
+
+    def __init__(self, client, route: str, primary: str, router: ModelRouter = model_router):
+        self._client = client
+        self.route = route
+        self.primary = primary
+        self._router = router
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def invoke_model(self, **kwargs):
+        model_id = self._router.choose(self.route, self.primary)
+        start = time.perf_counter()
+        response = self._client.invoke_model(**{**kwargs, "modelId": model_id})
+        self._router.observe(model_id, time.perf_counter() - start)
+        return response
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        model_id = self._router.choose(self.route, self.primary)
+        start = time.perf_counter()
+        response = self._client.invoke_model_with_response_stream(**{**kwargs, "modelId": model_id})
+        response["body"] = self._watch_stream(model_id, response["body"], start)
+        return response
+
+    def _watch_stream(self, model_id, stream, start):
+        # Time to the first chunk, what the shopper waits for before the answer starts
+        observed = False
+        for event in stream:
+            if not observed:
+                self._router.observe(model_id, time.perf_counter() - start)
+                observed = True
+            yield event
+        if not observed:
+            self._router.observe(model_id, time.perf_counter() - start)
@@ -1,12 +1,38 @@
-from langchain.schema import BaseRetriever
-from langchain.callbacks.manager import CallbackManagerForRetrieverRun
-from langchain.vectorstores import MongoDBAtlasVectorSearch
-from langchain.schema import Document
+from langchain_core.retrievers import BaseRetriever
+from langchain_core.callbacks import CallbackManagerForRetrieverRun, AsyncCallbackManagerForRetrieverRun
+from langchain_community.vectorstores.mongodb_atlas import MongoDBAtlasVectorSearch
+from langchain_core.documents import Document
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.vectorstores import VectorStore
 from pydantic import Field
-from attrs import define
-from typing import  List
-from pymongo import MongoClient
-import certifi
+from attrs import define, field
+from typing import  Any, List, Optional
+import asyncio
+import contextvars
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from utils.clients import get_async_mongo_client, get_mongo_client
+from utils.decompose import intent_quotas
+from utils.embedding_cache import normalize_text
+from utils.hybrid import hybrid_pipeline, reciprocal_rank_fusion, split_rankings
+from utils.local_vector import LocalVectorSearch
+from utils.records import ProductRecord, product_projection
+from utils.rerank import rerank_records
+from utils.singleflight import digest
+from utils.tracing import tracer
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def _intent_executor():
+    # Shared by all retrievers, the sub-queries of a question are searched on it
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="retriever")
+        return _executor
+
 
 @define(kw_only=True)
 class MongoDBVector:
@@ -14,14 +40,23 @@ class MongoDBVector:
     db_name: str
     collection_name: str
     index_name: str
+    # "atlas" queries Atlas Vector Search, "local" serves searches from an in-process index
+    backend: str = "atlas"
+    # Seconds between reloads of the local index from the collection
+    refresh_interval: Optional[float] = 300
+    # Local index snapshot, used instead of the collection when no uri is set
+    snapshot_path: Optional[str] = None
+    # Pool settings passed to the shared clients, see utils.clients.MONGO_DEFAULTS
+    client_options: dict = field(factory=dict)
 
     def get_vector_db(self, embeddings):
+        if self.backend == "local":
+            return self.get_local_vector_db(embeddings)
+        elif self.backend != "atlas":
+            raise ValueError(f"Unsupported vector backend: {self.backend}")
 
-        # initialize MongoDB python client
-        client = MongoClient(
-            self.uri,
-            tlsCAFile=certifi.where()
-        )
+        # MongoDB python client shared by every vector db on this uri
+        client = get_mongo_client(self.uri, **self.client_options)
         collection = client[self.db_name][self.collection_name]
 
         vectordb = MongoDBAtlasVectorSearch(
@@ -32,17 +67,56 @@ class MongoDBVector:
 
         return vectordb
 
+    def get_async_collection(self):
+        # Used by MongoDBExtendedRetriever._aget_relevant_documents, the client binds to the running event loop
+        client = get_async_mongo_client(self.uri, **self.client_options)
+        return client[self.db_name][self.collection_name]
+
+    def get_local_vector_db(self, embeddings):
+        if not self.uri:
+            # dev/test mode without any MongoDB
+            return LocalVectorSearch.load(self.snapshot_path, embedding=embeddings)
+
+        client = get_mongo_client(self.uri, **self.client_options)
+        collection = client[self.db_name][self.collection_name]
+
+        return LocalVectorSearch(
+            embedding=embeddings,
+            collection=collection,
+            refresh_interval=self.refresh_interval,
+        )
+
 
 class MongoDBExtendedRetriever(BaseRetriever):
-    vectorstore: MongoDBAtlasVectorSearch
+    vectorstore: VectorStore
     search_type: str = "similarity"
-    """Type of search to perform. Defaults to "similarity"."""
+    """Type of search to perform, "similarity" or "hybrid". Defaults to "similarity"."""
     search_kwargs: dict = Field(default_factory=dict)
+    # Hybrid search: Atlas Search index over the text fields and the RRF weights of both rankings
+    text_index_name: str = "products-text"
+    text_search_paths: List[str] = ["item_name", "item_keywords"]
+    vector_weight: float = 1.0
+    text_weight: float = 1.0
+    rrf_k: int = 60
+    # Optional QueryConstraintExtractor, turns catalog values named in the query into pre-filters
+    constraint_extractor: Optional[Any] = None
+    # numCandidates = factor * limit, a pre-filtered search needs fewer candidates
+    num_candidates_factor: int = 10
+    filtered_num_candidates_factor: int = 5
+    # Motor collection for the async path, without it async searches run in a thread
+    async_collection: Optional[Any] = None
+    # Optional ContextCompressor, renders the hits as compact table rows instead of combine_metadata
+    compressor: Optional[Any] = None
+    # Optional QueryDecomposer, multi-product questions are searched as one sub-query per product
+    decomposer: Optional[Any] = None
+    # Optional SingleFlight, identical searches running at the same time are only sent once
+    single_flight: Optional[Any] = None
  
     class Config:
         arbitrary_types_allowed = True
  
     def combine_metadata(self, doc) -> str:
+        # doc is a ProductRecord or a Document
         metadata = doc.metadata
         content = ("Item Name: " + metadata["item_name"] + ". " +
            "Item Description: " + metadata["bullet_point"] + ". " +
@@ -64,31 +138,251 @@ class MongoDBExtendedRetriever(BaseRetriever):
         self, query: str, *, run_manager: CallbackManagerForRetrieverRun
     ) -> List[Document]:
         
-        #print('In fuction: ',self.vectorstore._index_name, query)
+        sub_queries = self._decompose(query)
+        if len(sub_queries) > 1:
+            return self._grouped_documents(sub_queries, self._search_intents(sub_queries))
+        records = self._search_query(query)
+
+        #print('Docs: ',records)
+
+        return self._to_documents(records, query)
+
+    async def _aget_relevant_documents(
+        self, query: str, *, run_manager: AsyncCallbackManagerForRetrieverRun
+    ) -> List[Document]:
+        sub_queries = self._decompose(query)
+        if len(sub_queries) > 1:
+            groups = await asyncio.gather(*[self._asearch_query(sub_query, k) for sub_query, k
+                                            in zip(sub_queries, intent_quotas(self._k, len(sub_queries)))])
+            return self._grouped_documents(sub_queries, groups)
+        return self._to_documents(await self._asearch_query(query), query)
+
+    @property
+    def _k(self):
+        return self.search_kwargs.get("k", 4)
+
+    def _decompose(self, query):
+        if self.decomposer is None:
+            return [query]
+        return self.decomposer.split(query)
+
+    def _query_kwargs(self, query, k=None):
+        search_kwargs = self._search_kwargs(query)
+        return search_kwargs if k is None else {**search_kwargs, "k": k}
+
+    def _flight_key(self, query, search_kwargs):
+        # Retrievers of other assistants on the same index share the searches
+        collection = getattr(self.vectorstore, "_collection", None)
+        index = (getattr(collection, "full_name", None), getattr(self.vectorstore, "_index_name", None))
+        if index == (None, None):
+            index = id(self.vectorstore)
+        return digest("search", index, self.search_type, normalize_text(query), search_kwargs)
+
+    def _search_query(self, query, k=None):
+        search_kwargs = self._query_kwargs(query, k)
+        if self.single_flight is None:
+            return self._run_search_query(query, search_kwargs)
+        return self.single_flight.do(self._flight_key(query, search_kwargs),
+                                     lambda: self._run_search_query(query, search_kwargs))
+
+    async def _asearch_query(self, query, k=None):
+        search_kwargs = self._query_kwargs(query, k)
+        if self.single_flight is None:
+            return await self._arun_search_query(query, search_kwargs)
+        return await self.single_flight.ado(self._flight_key(query, search_kwargs),
+                                            lambda: self._arun_search_query(query, search_kwargs))
+
+    def _run_search_query(self, query, search_kwargs):
+        records = self.search_records(query, **search_kwargs)
+        if not records and search_kwargs.get("pre_filter") is not self.search_kwargs.get("pre_filter"):
+            # A misread constraint should not leave the shopper without any product
+            records = self.search_records(query, **{**self.search_kwargs, "k": search_kwargs.get("k", self._k)})
+        return records
+
+    async def _arun_search_query(self, query, search_kwargs):
+        records = await self.asearch_records(query, **search_kwargs)
+        if not records and search_kwargs.get("pre_filter") is not self.search_kwargs.get("pre_filter"):
+            records = await self.asearch_records(query, **{**self.search_kwargs, "k": search_kwargs.get("k", self._k)})
+        return records
+
+    def _search_intents(self, sub_queries):
+        """Searches the sub-queries concurrently, each with its share of k. Every worker embeds
+        its own sub-query: Titan has no batch API, a batched call would embed them one by one"""
+        quotas = intent_quotas(self._k, len(sub_queries))
+        # copy_context keeps the request trace in the worker threads
+        futures = [_intent_executor().submit(contextvars.copy_context().run, self._search_query, sub_query, k)
+                   for sub_query, k in zip(sub_queries, quotas)]
+        return [future.result() for future in futures]
+
+    def _grouped_documents(self, sub_queries, groups):
+        # One block per intent, a product found by several intents is only listed in the first
+        seen = set()
+        docs = []
+        for sub_query, records in zip(sub_queries, groups):
+            records = [r for r in records if r.key not in seen]
+            seen.update(r.key for r in records)
+            group = self._to_documents(records, sub_query)
+            for doc in group:
+                doc.metadata["intent"] = sub_query
+            if group:
+                group[0].page_content = f"Products for \"{sub_query}\":\n{group[0].page_content}"
+            docs.extend(group)
+        return docs
+
+    def _search_kwargs(self, query):
+        if self.constraint_extractor is None:
+            return self.search_kwargs
+        pre_filter = self.search_kwargs.get("pre_filter")
+        merged = self.constraint_extractor.merge(query, pre_filter)
+        if merged is pre_filter:
+            return self.search_kwargs
+        return {**self.search_kwargs, "pre_filter": merged}
+
+    def _num_candidates(self, limit, pre_filter):
+        factor = self.filtered_num_candidates_factor if pre_filter else self.num_candidates_factor
+        return limit * factor
+
+    def search_records(self, query, k=4, pre_filter=None, post_filter_pipeline=None, fetch_k=None,
+                       lambda_mult=0.5, dedup_threshold=0.97, **kwargs) -> List[ProductRecord]:
+        """Searches the catalog. With fetch_k > k, fetch_k candidates are reranked down to k
+        by near-duplicate collapsing and MMR (see utils.rerank)."""
+        rerank = bool(fetch_k) and fetch_k > k
+        limit = fetch_k if rerank else k
+        if not isinstance(self.vectorstore, (LocalVectorSearch, MongoDBAtlasVectorSearch)):
+            if pre_filter:
+                kwargs["pre_filter"] = pre_filter
+            if post_filter_pipeline is not None:
+                kwargs["post_filter_pipeline"] = post_filter_pipeline
+            records = [ProductRecord.from_document(doc, score)
+                       for doc, score in self.vectorstore.similarity_search_with_score(query, k=limit, **kwargs)]
+            return rerank_records(None, records, k) if rerank else records
+
+        with tracer.span("embedding"):
+            embedding = self.vectorstore.embeddings.embed_query(query)
+        with tracer.span("vector_search", search_type=self.search_type):
+            records = self._search(query, embedding, limit, pre_filter, post_filter_pipeline, with_embeddings=rerank)
+        if not rerank:
+            return records
+        with tracer.span("rerank"):
+            return rerank_records(embedding, records, k, lambda_mult, dedup_threshold)
+
+    async def asearch_records(self, query, k=4, pre_filter=None, post_filter_pipeline=None, fetch_k=None,
+                              lambda_mult=0.5, dedup_threshold=0.97, **kwargs) -> List[ProductRecord]:
+        rerank = bool(fetch_k) and fetch_k > k
+        limit = fetch_k if rerank else k
+        if not isinstance(self.vectorstore, (LocalVectorSearch, MongoDBAtlasVectorSearch)):
+            # In a copy of the context, so the embedding and search are part of the trace
+            return await run_in_executor(
+                None, lambda: self.search_records(query, k=k, pre_filter=pre_filter,
+                                                  post_filter_pipeline=post_filter_pipeline, fetch_k=fetch_k,
+                                                  lambda_mult=lambda_mult, dedup_threshold=dedup_threshold, **kwargs)
+            )
+
+        with tracer.span("embedding"):
+            embedding = await self.vectorstore.embeddings.aembed_query(query)
+        with tracer.span("vector_search", search_type=self.search_type):
+            records = await self._asearch(query, embedding, limit, pre_filter, post_filter_pipeline, with_embeddings=rerank)
+        if not rerank:
+            return records
+        with tracer.span("rerank"):
+            return rerank_records(embedding, records, k, lambda_mult, dedup_threshold)
+
+    def _search(self, query, embedding, limit, pre_filter, post_filter_pipeline, with_embeddings=False):
+        if self.search_type == "hybrid":
+            return self._hybrid_search(query, embedding, limit, pre_filter, with_embeddings)
+        if isinstance(self.vectorstore, LocalVectorSearch):
+            return self.vectorstore.similarity_search_records(embedding, k=limit, pre_filter=pre_filter,
+                                                              with_embeddings=with_embeddings)
+        pipeline = self._vector_pipeline(embedding, limit, pre_filter, post_filter_pipeline, with_embeddings)
+        return [ProductRecord.from_result(res, embedding_key=self.vectorstore._embedding_key)
+                for res in self.vectorstore._collection.aggregate(pipeline)]
+
+    async def _asearch(self, query, embedding, limit, pre_filter, post_filter_pipeline, with_embeddings=False):
+        if isinstance(self.vectorstore, LocalVectorSearch):
+            # In-process search, only the embedding call waits on I/O
+            return self._search(query, embedding, limit, pre_filter, post_filter_pipeline, with_embeddings)
+        if self.async_collection is None:
+            return await run_in_executor(
+                None, lambda: self._search(query, embedding, limit, pre_filter, post_filter_pipeline, with_embeddings)
+            )
+
+        if self.search_type == "hybrid":
+            pipeline = self._hybrid_pipeline(query, embedding, self._hybrid_limit(limit), pre_filter, with_embeddings)
+            results = [res async for res in self.async_collection.aggregate(pipeline)]
+            return self._fuse(*split_rankings(results, self.vectorstore._embedding_key), limit)
+        pipeline = self._vector_pipeline(embedding, limit, pre_filter, post_filter_pipeline, with_embeddings)
+        return [ProductRecord.from_result(res, embedding_key=self.vectorstore._embedding_key)
+                async for res in self.async_collection.aggregate(pipeline)]
+
+    def _vector_pipeline(self, embedding, k, pre_filter=None, post_filter_pipeline=None, with_embeddings=False):
+        # Same search as MongoDBAtlasVectorSearch, but only the fields used in the prompt
+        # are sent back. post_filter_pipeline stages only see the projected fields.
+        params = {
+            "queryVector": embedding,
+            "path": self.vectorstore._embedding_key,
+            "numCandidates": self._num_candidates(k, pre_filter),
+            "limit": k,
+            "index": self.vectorstore._index_name,
+        }
+        if pre_filter:
+            params["filter"] = pre_filter
+        pipeline = [
+            {"$vectorSearch": params},
+            product_projection("vectorSearchScore",
+                               embedding_key=self.vectorstore._embedding_key if with_embeddings else None),
+        ]
+        if post_filter_pipeline is not None:
+            pipeline.extend(post_filter_pipeline)
+        return pipeline
+
+    def _hybrid_limit(self, k):
+        # Each ranking contributes more than k hits so documents found by both can rise to the top
+        return max(k * 2, 10)
+
+    def _hybrid_pipeline(self, query, embedding, limit, pre_filter, with_embeddings=False):
+        return hybrid_pipeline(
+            query, embedding,
+            collection_name=self.vectorstore._collection.name,
+            vector_index=self.vectorstore._index_name,
+            text_index=self.text_index_name,
+            text_paths=self.text_search_paths,
+            limit=limit,
+            embedding_key=self.vectorstore._embedding_key,
+            pre_filter=pre_filter,
+            num_candidates=self._num_candidates(limit, pre_filter),
+            include_embedding=with_embeddings,
+        )
+
+    def _fuse(self, vector_records, text_records, k):
+        return reciprocal_rank_fusion([vector_records, text_records], [self.vector_weight, self.text_weight],
+                                      k=k, rrf_k=self.rrf_k)
+
+    def _hybrid_search(self, query, embedding, k, pre_filter=None, with_embeddings=False):
+        limit = self._hybrid_limit(k)
+        if isinstance(self.vectorstore, LocalVectorSearch):
+            vector_records = self.vectorstore.similarity_search_records(
+                embedding, k=limit, pre_filter=pre_filter, with_embeddings=with_embeddings)
+            text_records = self.vectorstore.text_search_records(
+                query, k=limit, paths=self.text_search_paths, pre_filter=pre_filter, with_embeddings=with_embeddings)
+            return self._fuse(vector_records, text_records, k)
+
+        # Both searches run in a single aggregation ($vectorSearch + $unionWith $search)
+        pipeline = self._hybrid_pipeline(query, embedding, limit, pre_filter, with_embeddings)
+        results = self.vectorstore._collection.aggregate(pipeline)
+        return self._fuse(*split_rankings(results, self.vectorstore._embedding_key), k)
+
+    def _to_documents(self, records, query=None):
+        # The chain boundary: only the final hits become Documents
+        if self.compressor is not None:
+            with tracer.span("compress"):
+                rows = self.compressor.compress(query, records)
+            return [Document(page_content=row, metadata=record.metadata) for row, record in rows]
         docs_list = []
-        # mongo_query = [
-        #     {
-        #         "$search": {
-        #             "index": self.vectorstore._index_name,
-        #             "knnBeta": {
-        #                 "vector": self.vectorstore.embeddings.embed_query(query),
-        #                 "path": "embedding",
-        #                 "k": 10,
-        #             }
-        #         }
-        #     }
-        # ]
-        # docs = self.vectorstore._collection.aggregate(mongo_query)
-
-        docs =self.vectorstore.similarity_search(query, **self.search_kwargs)
-
-        #print('Docs: ',docs)
-
-        for doc in docs:
-            content, metadata = self.combine_metadata(doc)
+        for record in records:
+            content, metadata = self.combine_metadata(record)
             docs_list.append(Document(
                 page_content=content,
                 metadata=metadata
             ))
  
-        return docs_list
\ No newline at end of file
+        return docs_list
@@ -0,0 +1,183 @@
+"""Orders and returns data for the agent tools.
+
+Orders live in a MongoDB collection, one document per order:
+
+    {"orderId": "OT1002", "customerId": "...", "status": "delivered", "orderDate": ...,
+     "items": [{"name": "Knitted Cap", "price": "100", "quantity": "2", ...}]}
+
+MongoOrderStore reads them with two indexes, (customerId, status, orderId) for the list of
+returnable orders and a unique one on orderId for lookups, and only projects the line item
+fields the tools print. Lists are paginated on orderId, so a customer with hundreds of
+orders costs one small page per call. InMemoryOrderStore serves the sample orders, as the
+orders of DEMO_CUSTOMER, when no customer mapping is configured.
+
+OrderRepository adds a short per-session cache: the return flow asks for the same orders
+several turns in a row.
+"""
+import contextvars
+import threading
+import time
+from collections import OrderedDict
+from typing import List, Optional
+
+# Fields printed by the tools, nothing else leaves the server
+ORDER_PROJECTION = {"_id": 0, "orderId": 1, "items.name": 1, "items.price": 1, "items.quantity": 1}
+
+RETURNABLE_STATUS = "delivered"
+
+RETURN_REASONS = ['Low Quality', 'Large Size', 'Small Size', 'Other - Please specify']
+
+# Customer of the sample orders, seen by every session of a demo
+DEMO_CUSTOMER = "demo"
+
+# Served by InMemoryOrderStore, the orders the tools used to hardcode
+SAMPLE_ORDERS = [
+    {"orderId": "OT1003", "status": RETURNABLE_STATUS,
+     "items": [{"name": "Blue Shirt", "price": "300", "quantity": "1"}]},
+    {"orderId": "OT1002", "status": RETURNABLE_STATUS,
+     "items": [{"name": "Knitted Cap", "price": "100", "quantity": "2"}]},
+]
+
+# Session of the request being served, set by ShoppingAssistant since tools only get their arguments
+current_session = contextvars.ContextVar("current_session", default=None)
+
+
+class OrderPage:
+    __slots__ = ("orders", "next_cursor")
+
+    def __init__(self, orders: List[dict], next_cursor: Optional[str] = None):
+        self.orders = orders
+        # orderId to pass as `after` for the next page, None on the last page
+        self.next_cursor = next_cursor
+
+
+class MongoOrderStore:
+    def __init__(self, collection, create_indexes: bool = True):
+        self.collection = collection
+        if create_indexes:
+            self.ensure_indexes()
+
+    def ensure_indexes(self):
+        # Equality on customerId and status, then sorted on orderId: no in-memory sort
+        self.collection.create_index([("customerId", 1), ("status", 1), ("orderId", -1)],
+                                     name="customer_status_order")
+        self.collection.create_index("orderId", unique=True, name="order_id")
+
+    def find_by_status(self, customer_id, status=RETURNABLE_STATUS, after=None, limit=10) -> OrderPage:
+        query = {"customerId": customer_id, "status": status}
+        if after is not None:
+            query["orderId"] = {"$lt": after}
+        # One extra order tells whether there is a next page
+        cursor = self.collection.find(query, ORDER_PROJECTION).sort("orderId", -1).limit(limit + 1)
+        orders = list(cursor)
+        if len(orders) > limit:
+            return OrderPage(orders[:limit], orders[limit - 1]["orderId"])
+        return OrderPage(orders)
+
+    def find_by_order_id(self, order_id, customer_id=None) -> Optional[dict]:
+        query = {"orderId": order_id}
+        if customer_id is not None:
+            # Shoppers can only see their own orders
+            query["customerId"] = customer_id
+        return self.collection.find_one(query, ORDER_PROJECTION)
+
+
+class InMemoryOrderStore:
+    """Same interface and customer scoping over a list of orders, SAMPLE_ORDERS by default"""
+
+    def __init__(self, orders: Optional[List[dict]] = None):
+        if orders is None:
+            orders = [{**order, "customerId": DEMO_CUSTOMER} for order in SAMPLE_ORDERS]
+        self.orders = sorted(orders, key=lambda order: order["orderId"], reverse=True)
+
+    def _project(self, order):
+        return {"orderId": order["orderId"],
+                "items": [{k: item[k] for k in ("name", "price", "quantity") if k in item} for item in order["items"]]}
+
+    def find_by_status(self, customer_id, status=RETURNABLE_STATUS, after=None, limit=10) -> OrderPage:
+        orders = [o for o in self.orders if o.get("customerId") == customer_id and o.get("status") == status
+                  and (after is None or o["orderId"] < after)]
+        page = [self._project(o) for o in orders[:limit]]
+        return OrderPage(page, page[-1]["orderId"] if len(orders) > limit else None)
+
+    def find_by_order_id(self, order_id, customer_id=None) -> Optional[dict]:
+        for order in self.orders:
+            if order["orderId"] == order_id and (customer_id is None or order.get("customerId") == customer_id):
+                return self._project(order)
+        return None
+
+
+class OrderRepository:
+    """Order lookups for a session, cached for `ttl` seconds.
+
+    `customer_id` maps a session to the customer whose orders it sees, by default the
+    session id itself.
+    """
+
+    def __init__(self, store, ttl: float = 300, page_size: int = 10, max_sessions: int = 10000,
+                 customer_id=None):
+        self.store = store
+        self.ttl = ttl
+        self.page_size = page_size
+        self.max_sessions = max_sessions
+        self.customer_id = customer_id if customer_id is not None else (lambda session_id: session_id)
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    def _get(self, session_id, key, default=None):
+        with self._lock:
+            entry = self._cache.get(session_id)
+            if entry is None or entry["expires_at"] <= time.time() or key not in entry["values"]:
+                return default
+            self._cache.move_to_end(session_id)
+            return entry["values"][key]
+
+    def _put(self, session_id, key, value):
+        now = time.time()
+        with self._lock:
+            entry = self._cache.get(session_id)
+            if entry is None or entry["expires_at"] <= now:
+                entry = self._cache[session_id] = {"expires_at": now + self.ttl, "values": {}}
+            entry["values"][key] = value
+            self._cache.move_to_end(session_id)
+            while len(self._cache) > self.max_sessions:
+                self._cache.popitem(last=False)
+
+    def _cached(self, session_id, key, load):
+        missing = object()
+        value = self._get(session_id, key, missing)
+        if value is not missing:
+            self.counters["hits"] += 1
+            return value
+        self.counters["misses"] += 1
+        value = load()
+        self._put(session_id, key, value)
+        return value
+
+    def returnable_orders(self, session_id, more: bool = False) -> OrderPage:
+        """The first page of returnable orders, or the page after the last one shown with `more`"""
+        customer_id = self.customer_id(session_id)
+        after = self._get(session_id, "next_cursor") if more else None
+        if more and after is None:
+            # Every order was shown already
+            return OrderPage([])
+        page = self._cached(session_id, ("status", RETURNABLE_STATUS, after), lambda: self.store.find_by_status(
+            customer_id, RETURNABLE_STATUS, after=after, limit=self.page_size))
+        self._put(session_id, "next_cursor", page.next_cursor)
+        return page
+
+    def order(self, session_id, order_id) -> Optional[dict]:
+        customer_id = self.customer_id(session_id)
+        return self._cached(session_id, ("order", order_id),
+                            lambda: self.store.find_by_order_id(order_id, customer_id))
+
+    def invalidate(self, session_id):
+        with self._lock:
+            self._cache.pop(session_id, None)
+
+
+def seed_sample_orders(collection, customer_id):
+    """Copies SAMPLE_ORDERS to the collection for one customer, e.g. a demo account"""
+    for order in SAMPLE_ORDERS:
+        collection.replace_one({"orderId": order["orderId"]}, {**order, "customerId": customer_id}, upsert=True)
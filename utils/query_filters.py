@@ -0,0 +1,150 @@
+"""Query understanding: structured pre-filters extracted from the shopper's question.
+
+The lexicon is built from the distinct values of a few catalog fields (product_type by
+default), so "red sandals for the beach" is searched within product_type SANDAL only. The
+filters go to $vectorSearch as a pre-filter, which needs every filtered field declared as a
+"filter" path in the vector index (see README).
+"""
+import re
+from typing import Dict, Iterable, List, Optional
+
+from utils.embedding_cache import normalize_text
+
+# Shopper words for the compound product types of the catalog (see SELECTED_CATEGORIES)
+PRODUCT_TYPE_SYNONYMS = {
+    "shoe": ["SHOES"], "sneaker": ["SHOES"], "trainer": ["SHOES"], "loafer": ["SHOES"], "heel": ["SHOES"],
+    "flip flop": ["SANDAL"], "slipper": ["SANDAL"],
+    "ring": ["FASHIONRING"], "fashion ring": ["FASHIONRING"],
+    "fashion earring": ["FASHIONEARRING"], "fine earring": ["FINEEARRING"],
+    "fashion necklace": ["FASHIONNECKLACEBRACELETANKLET"], "fine necklace": ["FINENECKLACEBRACELETANKLET"],
+    "fashion bracelet": ["FASHIONNECKLACEBRACELETANKLET"], "fine bracelet": ["FINENECKLACEBRACELETANKLET"],
+    "earring": ["FASHIONEARRING", "FINEEARRING"], "stud": ["FASHIONEARRING", "FINEEARRING"],
+    "necklace": ["FASHIONNECKLACEBRACELETANKLET", "FINENECKLACEBRACELETANKLET"],
+    "bracelet": ["FASHIONNECKLACEBRACELETANKLET", "FINENECKLACEBRACELETANKLET"],
+    "anklet": ["FASHIONNECKLACEBRACELETANKLET", "FINENECKLACEBRACELETANKLET"],
+    "pendant": ["FASHIONNECKLACEBRACELETANKLET", "FINENECKLACEBRACELETANKLET"],
+    "cap": ["HAT"], "beanie": ["HAT"],
+    "cosmetic case": ["COSMETIC_CASE"], "makeup bag": ["COSMETIC_CASE"], "toiletry bag": ["COSMETIC_CASE"],
+}
+
+NEGATIONS = ("no", "not", "without", "except", "excluding", "other than")
+# Skipped between a negation and the product it negates: "without a hat", "not any rings"
+DETERMINERS = {"a", "an", "the", "any", "some", "my", "your", "his", "her", "their", "our", "this", "that",
+               "these", "those"}
+
+
+def _singular(word: str) -> str:
+    if word.endswith("ies") and len(word) > 4:
+        return word[:-3] + "y"
+    if word.endswith(("ses", "xes", "ches", "shes")):
+        return word[:-2]
+    if word.endswith("s") and not word.endswith("ss") and len(word) > 3:
+        return word[:-1]
+    return word
+
+
+def _phrase(value: str) -> str:
+    return " ".join(_singular(word) for word in re.findall(r"[a-z0-9]+", normalize_text(str(value))))
+
+
+class QueryConstraintExtractor:
+    """Maps words of a query to catalog values, with a rules lexicon and no LLM call.
+
+    `values` maps a field name to its distinct values in the collection. `synonyms` maps
+    extra shopper phrases to values of a field and is only applied to values that exist.
+    """
+
+    def __init__(self, values: Dict[str, Iterable], synonyms: Optional[Dict[str, Dict[str, List]]] = None):
+        self.values = {field: [v for v in field_values if v not in (None, "")] for field, field_values in values.items()}
+        synonyms = synonyms if synonyms is not None else {"product_type": PRODUCT_TYPE_SYNONYMS}
+        # phrase -> [(field, value)], phrases are matched on singularized words
+        self.lexicon: Dict[str, List] = {}
+        for field, field_values in self.values.items():
+            known = set(field_values)
+            for value in field_values:
+                self._add(_phrase(value), field, value)
+            for phrase, targets in synonyms.get(field, {}).items():
+                for value in targets:
+                    if value in known:
+                        self._add(_phrase(phrase), field, value)
+        self._max_words = max((len(phrase.split()) for phrase in self.lexicon), default=1)
+        # Last word of multi-word values, "case" finds COSMETIC_CASE. Compound values like
+        # FASHIONEARRING are only reached through their synonyms: "fashion" is not a product
+        self.head_words: Dict[str, List] = {}
+        for field, field_values in self.values.items():
+            for value in field_values:
+                words = _phrase(value).split()
+                if len(words) > 1:
+                    self.head_words.setdefault(words[-1], []).append((field, value))
+        self.counters = {"queries": 0, "filtered": 0}
+
+    def _add(self, phrase, field, value):
+        if phrase and (field, value) not in self.lexicon.setdefault(phrase, []):
+            self.lexicon[phrase].append((field, value))
+
+    @classmethod
+    def from_collection(cls, collection, fields=("product_type",), **kwargs) -> "QueryConstraintExtractor":
+        return cls({field: collection.distinct(field) for field in fields}, **kwargs)
+
+    @classmethod
+    def from_metadatas(cls, metadatas: Iterable[dict], fields=("product_type",), **kwargs) -> "QueryConstraintExtractor":
+        values = {field: set() for field in fields}
+        for metadata in metadatas:
+            for field in fields:
+                if isinstance(metadata.get(field), str):
+                    values[field].add(metadata[field])
+        return cls({field: sorted(field_values) for field, field_values in values.items()}, **kwargs)
+
+    @staticmethod
+    def _negated(raw_words, i):
+        # Determiners are read before singularizing, "these" is not a plural
+        while i > 0 and raw_words[i - 1] in DETERMINERS:
+            i -= 1
+        preceding = " ".join(raw_words[max(i - 2, 0):i])
+        return any(preceding == n or preceding.endswith(f" {n}") for n in NEGATIONS)
+
+    def extract(self, query: str) -> Dict[str, List]:
+        """Returns {field: [values]} for every field mentioned in the query"""
+        raw_words = re.findall(r"[a-z0-9]+", normalize_text(query))
+        words = [_singular(word) for word in raw_words]
+        found: Dict[str, List] = {}
+        i = 0
+        while i < len(words):
+            matched = None
+            for size in range(min(self._max_words, len(words) - i), 0, -1):
+                phrase = " ".join(words[i:i + size])
+                if phrase in self.lexicon:
+                    matched = (self.lexicon[phrase], size)
+                    break
+            if matched is None and words[i] in self.head_words:
+                matched = (self.head_words[words[i]], 1)
+            if matched is None:
+                i += 1
+                continue
+            targets, size = matched
+            if not self._negated(raw_words, i):
+                for field, value in targets:
+                    if value not in found.setdefault(field, []):
+                        found[field].append(value)
+            i += size
+        return found
+
+    def to_filter(self, query: str) -> Optional[dict]:
+        """The MQL pre-filter for the constraints found in the query, or None"""
+        self.counters["queries"] += 1
+        constraints = self.extract(query)
+        if not constraints:
+            return None
+        self.counters["filtered"] += 1
+        clauses = [{field: values[0]} if len(values) == 1 else {field: {"$in": values}}
+                   for field, values in constraints.items()]
+        return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+    def merge(self, query: str, pre_filter: Optional[dict] = None) -> Optional[dict]:
+        """Combines the extracted filter with an explicit pre_filter from search_kwargs"""
+        extracted = self.to_filter(query)
+        if extracted is None:
+            return pre_filter
+        if not pre_filter:
+            return extracted
+        return {"$and": [pre_filter, extracted]}
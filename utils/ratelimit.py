@@ -0,0 +1,430 @@
+"""Client-side rate limiting of Bedrock requests.
+
+Every Bedrock, BedrockChat and BedrockEmbeddings instance of the process shares the same
+bedrock-runtime client, and used to send requests as fast as sessions asked for them.
+Under load Bedrock answers with ThrottlingException, every session retries at once and
+the storm goes on. RateLimitedBedrockClient sends all requests through one
+BedrockRateLimiter, which keeps, per model id:
+
+- token buckets for the requests and tokens per minute quotas, when they are configured.
+  Requests reserve their estimated prompt tokens and the bucket is corrected with the
+  counts Bedrock reports
+- an AIMD concurrency limit: +1 per round of successful requests, halved on a throttle
+  (once per round: requests sent before the last decrease do not decrease it again)
+- a priority queue for the concurrency slots, so answers (INTERACTIVE) go before
+  ingestion (BACKGROUND)
+
+Throttled requests are retried after a jittered exponential backoff. The limiter is the only
+one retrying them: the clients it wraps are built with LIMITED_CLIENT_OPTIONS, without botocore
+retries.
+"""
+import contextlib
+import contextvars
+import heapq
+import itertools
+import json
+import random
+import threading
+import time
+import weakref
+from typing import Dict, Optional, Tuple
+
+from utils.tokens import token_counter
+from utils.tracing import tracer as default_tracer
+
+INTERACTIVE = 0
+BACKGROUND = 10
+
+THROTTLING_CODES = {"ThrottlingException", "TooManyRequestsException", "ServiceQuotaExceededException"}
+
+# For get_bedrock_client: botocore would retry throttles behind the limiter's back
+LIMITED_CLIENT_OPTIONS = {"max_attempts": 1}
+
+THROTTLES_METRIC = "shopping_bedrock_throttles_total"
+QUEUE_METRIC = "shopping_bedrock_queue_seconds"
+
+# Priority of the requests sent from the current thread or task, see `priority`
+current_priority = contextvars.ContextVar("current_priority", default=INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    token = current_priority.set(level)
+    try:
+        yield
+    finally:
+        current_priority.reset(token)
+
+
+def is_throttle(error: Exception) -> bool:
+    # botocore ClientError, the error code is in the parsed response
+    response = getattr(error, "response", None) or {}
+    return response.get("Error", {}).get("Code") in THROTTLING_CODES
+
+
+class TokenBucket:
+    """Grants at most `per_minute` units in any minute, up to `burst_seconds` worth of them at once.
+
+    The refill rate leaves room for the burst, a full bucket plus a minute of refill must
+    stay within the quota. Reservations may take the bucket below zero, the caller then
+    waits for the debt to be refilled: a request larger than the bucket still goes
+    through, just later.
+    """
+
+    def __init__(self, per_minute: float, burst_seconds: float = 5.0):
+        self.capacity = max(per_minute * burst_seconds / 60.0, 1.0)
+        self.rate = max(per_minute - self.capacity, 1.0) / 60.0
+        self.level = self.capacity
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now):
+        self.level = min(self.capacity, self.level + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, amount: float) -> float:
+        """Takes `amount` units, returns the seconds to wait before using them"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level -= amount
+            return max(-self.level / self.rate, 0.0)
+
+    def adjust(self, amount: float):
+        """Gives back (positive) or takes (negative) units after the fact"""
+        with self._lock:
+            self._refill(time.monotonic())
+            self.level = min(self.capacity, self.level + amount)
+
+
+class AdaptiveConcurrency:
+    """AIMD limit on the requests in flight, with a priority queue for the free slots"""
+
+    def __init__(self, initial: float = 8, minimum: float = 1, maximum: float = 32, decrease: float = 0.5):
+        self.limit = float(initial)
+        self.minimum = minimum
+        self.maximum = maximum
+        self.decrease = decrease
+        self.in_flight = 0
+        # Bumped on every decrease, requests remember the epoch they were sent in
+        self.epoch = 0
+        self._waiters = []
+        self._sequence = itertools.count()
+        self._condition = threading.Condition()
+
+    def acquire(self, level: int = INTERACTIVE) -> int:
+        """Waits for a slot, returns the epoch to pass to `release`"""
+        with self._condition:
+            entry = (level, next(self._sequence))
+            heapq.heappush(self._waiters, entry)
+            try:
+                while self._waiters[0] != entry or self.in_flight >= max(int(self.limit), 1):
+                    self._condition.wait()
+            except BaseException:
+                self._waiters.remove(entry)
+                heapq.heapify(self._waiters)
+                self._condition.notify_all()
+                raise
+            heapq.heappop(self._waiters)
+            self.in_flight += 1
+            # The next waiter may fit too
+            self._condition.notify_all()
+            return self.epoch
+
+    def release(self, epoch: int, throttled: bool = False):
+        with self._condition:
+            self.in_flight -= 1
+            if throttled:
+                # The other throttles of the same burst were sent under the old limit too
+                if epoch == self.epoch:
+                    self.limit = max(self.limit * self.decrease, self.minimum)
+                    self.epoch += 1
+            elif self.in_flight + 1 >= int(self.limit):
+                # +1 once every `limit` successes, i.e. per round of requests, while the limit is reached
+                self.limit = min(self.limit + 1.0 / self.limit, self.maximum)
+            self._condition.notify_all()
+
+    def queued(self) -> int:
+        with self._condition:
+            return len(self._waiters)
+
+
+class _ModelState:
+    def __init__(self, requests_per_minute, tokens_per_minute, concurrency: AdaptiveConcurrency, burst_seconds):
+        self.requests = TokenBucket(requests_per_minute, burst_seconds) if requests_per_minute else None
+        self.tokens = TokenBucket(tokens_per_minute, burst_seconds) if tokens_per_minute else None
+        self.concurrency = concurrency
+        self.counters = {"requests": 0, "throttled": 0, "retries": 0, "failed": 0, "wait_seconds": 0.0}
+        self.last_throttle = None
+
+
+class Slot:
+    """A request allowed to run, `release` must be called once it is done"""
+
+    def __init__(self, model_id, state: _ModelState, epoch: int, reserved_tokens: int):
+        self.model_id = model_id
+        self._state = state
+        self._epoch = epoch
+        self.reserved_tokens = reserved_tokens
+        self._released = False
+        self._lock = threading.Lock()
+
+    def release(self, throttled: bool = False, used_tokens: Optional[int] = None):
+        # Also called by the finalizer of a stream, from whichever thread collects it
+        with self._lock:
+            if self._released:
+                return
+            self._released = True
+        if throttled and self._state.requests is not None:
+            self._state.requests.adjust(1)
+        if self._state.tokens is not None:
+            if throttled:
+                # Throttled requests are not counted by Bedrock
+                self._state.tokens.adjust(self.reserved_tokens)
+            elif used_tokens is not None:
+                self._state.tokens.adjust(self.reserved_tokens - used_tokens)
+        self._state.concurrency.release(self._epoch, throttled)
+
+
+class BedrockRateLimiter:
+    """Process-wide limiter, see the module docstring.
+
+    `requests_per_minute` and `tokens_per_minute` apply to every model, `limits` overrides
+    them per model id with (requests_per_minute, tokens_per_minute) tuples. None means no
+    bucket: only the adaptive concurrency applies.
+    """
+
+    def __init__(self, requests_per_minute: Optional[float] = None, tokens_per_minute: Optional[float] = None,
+                 limits: Optional[Dict[str, Tuple]] = None, initial_concurrency: int = 8, max_concurrency: int = 32,
+                 burst_seconds: float = 5.0, max_retries: int = 4, base_delay: float = 0.5, max_delay: float = 20.0,
+                 tracer=default_tracer):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.limits = dict(limits or {})
+        self.initial_concurrency = initial_concurrency
+        self.max_concurrency = max_concurrency
+        self.burst_seconds = burst_seconds
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.tracer = tracer
+        self._models: Dict[str, _ModelState] = {}
+        self._lock = threading.Lock()
+
+    def configure(self, **settings):
+        """Changes the settings, models already seen keep their buckets and concurrency"""
+        for name, value in settings.items():
+            if value is not None:
+                setattr(self, name, value)
+
+    def configure_from_env(self, env):
+        limits = {}
+        # BEDROCK_MODEL_LIMITS=anthropic.claude-instant-v1=400/300000;amazon.titan-embed-text-v1=2000/
+        for entry in filter(None, env.get('BEDROCK_MODEL_LIMITS', '').split(';')):
+            model_id, _, values = entry.partition('=')
+            rpm, _, tpm = values.partition('/')
+            limits[model_id.strip()] = (float(rpm) if rpm else None, float(tpm) if tpm else None)
+        self.configure(
+            requests_per_minute=float(env['BEDROCK_REQUESTS_PER_MINUTE']) if env.get('BEDROCK_REQUESTS_PER_MINUTE') else None,
+            tokens_per_minute=float(env['BEDROCK_TOKENS_PER_MINUTE']) if env.get('BEDROCK_TOKENS_PER_MINUTE') else None,
+            limits={**self.limits, **limits} if limits else None,
+            max_concurrency=int(env['BEDROCK_MAX_CONCURRENCY']) if env.get('BEDROCK_MAX_CONCURRENCY') else None,
+            max_retries=int(env['BEDROCK_THROTTLE_RETRIES']) if env.get('BEDROCK_THROTTLE_RETRIES') else None,
+        )
+
+    def _model(self, model_id) -> _ModelState:
+        with self._lock:
+            state = self._models.get(model_id)
+            if state is None:
+                requests_per_minute, tokens_per_minute = self.limits.get(
+                    model_id, (self.requests_per_minute, self.tokens_per_minute))
+                concurrency = AdaptiveConcurrency(initial=min(self.initial_concurrency, self.max_concurrency),
+                                                  maximum=self.max_concurrency)
+                state = self._models[model_id] = _ModelState(requests_per_minute, tokens_per_minute, concurrency,
+                                                             self.burst_seconds)
+            return state
+
+    def acquire(self, model_id: str, tokens: int = 0, level: Optional[int] = None) -> Slot:
+        """Waits for the bucket capacity of one request, then for a concurrency slot"""
+        state = self._model(model_id)
+        start = time.perf_counter()
+        # Buckets first: a request waiting for its minute does not hold a slot
+        delay = 0.0
+        if state.requests is not None:
+            delay = state.requests.reserve(1)
+        if state.tokens is not None and tokens:
+            delay = max(delay, state.tokens.reserve(tokens))
+        try:
+            if delay:
+                time.sleep(delay)
+            epoch = state.concurrency.acquire(current_priority.get() if level is None else level)
+        except BaseException:
+            # Not sent, the reservations go back
+            if state.requests is not None:
+                state.requests.adjust(1)
+            if state.tokens is not None and tokens:
+                state.tokens.adjust(tokens)
+            raise
+        waited = time.perf_counter() - start
+        with self._lock:
+            state.counters["requests"] += 1
+            state.counters["wait_seconds"] += waited
+        self.tracer.observe(QUEUE_METRIC, waited, model=model_id)
+        return Slot(model_id, state, epoch, tokens)
+
+    def backoff(self, attempt: int) -> float:
+        # Full jitter: sessions throttled together do not retry together
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def call(self, model_id: str, send, tokens: int = 0, level: Optional[int] = None, done=None):
+        """Runs `send()` within the limits and retries it when throttled. `done(slot, response)`
+        releases the slot and returns the response, by default as soon as `send` returns"""
+        for attempt in itertools.count():
+            slot = self.acquire(model_id, tokens, level)
+            try:
+                response = send()
+            except Exception as e:
+                throttled = is_throttle(e)
+                slot.release(throttled=throttled)
+                if not throttled:
+                    raise
+                self._throttled(model_id, attempt)
+                if attempt >= self.max_retries:
+                    raise
+                time.sleep(self.backoff(attempt))
+                continue
+            if done is None:
+                slot.release()
+                return response
+            return done(slot, response)
+
+    def _count(self, model_id, name):
+        state = self._model(model_id)
+        with self._lock:
+            state.counters[name] += 1
+
+    def _throttled(self, model_id, attempt):
+        self._model(model_id).last_throttle = time.monotonic()
+        self._count(model_id, "throttled")
+        self._count(model_id, "retries" if attempt < self.max_retries else "failed")
+        self.tracer.inc(THROTTLES_METRIC, model=model_id)
+
+    def saturated(self, model_id: str, recent: float = 5.0) -> bool:
+        """Whether requests to the model queue for a slot, wait for a bucket, or were throttled
+        in the last `recent` seconds"""
+        with self._lock:
+            state = self._models.get(model_id)
+        if state is None:
+            return False
+        if state.concurrency.queued() or (state.last_throttle is not None
+                                          and time.monotonic() - state.last_throttle < recent):
+            return True
+        return any(bucket is not None and bucket.level < 0 for bucket in (state.requests, state.tokens))
+
+    def stats(self) -> dict:
+        with self._lock:
+            models = list(self._models.items())
+        return {model_id: {**state.counters,
+                           "wait_seconds": round(state.counters["wait_seconds"], 3),
+                           "in_flight": state.concurrency.in_flight,
+                           "concurrency_limit": round(state.concurrency.limit, 2),
+                           "queued": state.concurrency.queued()}
+                for model_id, state in models}
+
+
+# Shared by every Bedrock client of the process
+bedrock_limiter = BedrockRateLimiter()
+
+
+def _request_tokens(body) -> int:
+    """Prompt tokens of a request body, what the token bucket reserves up front"""
+    try:
+        request = json.loads(body)
+    except (TypeError, ValueError):
+        return 0
+    text = request.get("prompt") or request.get("inputText") or ""
+    if not text and request.get("messages"):
+        text = json.dumps(request["messages"])
+    return token_counter.count(text) if text else 0
+
+
+def _response_tokens(response) -> Optional[int]:
+    headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+    if "x-amzn-bedrock-input-token-count" not in headers:
+        return None
+    return int(headers["x-amzn-bedrock-input-token-count"]) + int(headers.get("x-amzn-bedrock-output-token-count", 0))
+
+
+class RateLimitedBedrockClient:
+    """Wraps a bedrock-runtime client so its requests go through `limiter`.
+
+    `level` fixes the priority of every request of this client, e.g. BACKGROUND for
+    ingestion, otherwise it is read from `current_priority`.
+    """
+
+    def __init__(self, client, limiter: BedrockRateLimiter = bedrock_limiter, level: Optional[int] = None):
+        self._client = client
+        self._limiter = limiter
+        self._level = level
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def invoke_model(self, **kwargs):
+        return self._limiter.call(kwargs.get("modelId", "unknown"), lambda: self._client.invoke_model(**kwargs),
+                                  tokens=_request_tokens(kwargs.get("body")), level=self._level, done=self._release)
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return self._limiter.call(kwargs.get("modelId", "unknown"),
+                                  lambda: self._client.invoke_model_with_response_stream(**kwargs),
+                                  tokens=_request_tokens(kwargs.get("body")), level=self._level, done=self._hold)
+
+    @staticmethod
+    def _release(slot, response):
+        slot.release(used_tokens=_response_tokens(response))
+        return response
+
+    @staticmethod
+    def _hold(slot, response):
+        # The slot is held until the stream is read, open streams count against the quota
+        response["body"] = _HeldStream(slot, response["body"])
+        return response
+
+
+class _HeldStream:
+    """Response stream that releases its slot once read to the end, closed or garbage collected.
+
+    A generator would only release it in a `finally`, which never runs when the body is
+    dropped before the first read, and the slot would be lost for good.
+    """
+
+    def __init__(self, slot: Slot, stream):
+        self._slot = slot
+        self._stream = stream
+        self._events = None
+        self.used_tokens = None
+        # Must not reference self, or the stream would never be collected
+        self._finalizer = weakref.finalize(self, slot.release)
+
+    def __iter__(self):
+        # Readers iterate this object, so it stays alive as long as they read
+        return self
+
+    def __next__(self):
+        if self._events is None:
+            self._events = iter(self._stream)
+        try:
+            event = next(self._events)
+        except BaseException:
+            self.close()
+            raise
+        chunk = event.get("chunk")
+        if chunk and b"invocationMetrics" in chunk.get("bytes", b""):
+            metrics = json.loads(chunk["bytes"]).get("amazon-bedrock-invocationMetrics", {})
+            self.used_tokens = metrics.get("inputTokenCount", 0) + metrics.get("outputTokenCount", 0)
+        return event
+
+    def close(self):
+        self._finalizer.detach()
+        self._slot.release(used_tokens=self.used_tokens)
+        if hasattr(self._stream, "close"):
+            self._stream.close()
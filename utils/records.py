@@ -0,0 +1,71 @@
+"""Lightweight product search hits.
+
+Search results are kept as slotted ProductRecord objects holding only the fields the
+prompt needs. They are turned into LangChain Documents only for the final k hits handed to
+the chain, so over-fetched candidates never allocate a Document or a metadata dict.
+"""
+from typing import Optional
+
+# Fields read by MongoDBExtendedRetriever.combine_metadata and the pre-filters
+PRODUCT_FIELDS = ("item_name", "bullet_point", "item_keywords", "product_type")
+
+
+def product_projection(score_meta: Optional[str] = None, extra: Optional[dict] = None,
+                       embedding_key: Optional[str] = None) -> dict:
+    """$project stage keeping only PRODUCT_FIELDS and _id.
+
+    It is an inclusion projection, so the embedding array (unless `embedding_key` is given)
+    and every other CSV column stay on the server.
+    """
+    projection = {field: 1 for field in PRODUCT_FIELDS}
+    if embedding_key:
+        projection[embedding_key] = 1
+    if score_meta:
+        projection["score"] = {"$meta": score_meta}
+    if extra:
+        projection.update(extra)
+    return {"$project": projection}
+
+
+class ProductRecord:
+    __slots__ = ("id", "item_name", "bullet_point", "item_keywords", "product_type", "score", "embedding")
+
+    def __init__(self, id=None, item_name="", bullet_point="", item_keywords="", product_type=None,
+                 score: float = 0.0, embedding=None):
+        self.id = id
+        self.item_name = item_name
+        self.bullet_point = bullet_point
+        self.item_keywords = item_keywords
+        self.product_type = product_type
+        self.score = score
+        # Only fetched when the hits are reranked, see utils.rerank
+        self.embedding = embedding
+
+    @classmethod
+    def from_result(cls, res: dict, score: Optional[float] = None, embedding=None,
+                    embedding_key: str = "embedding") -> "ProductRecord":
+        # Missing or null CSV values become empty strings, like the notebook's fillna
+        return cls(
+            id=res.get("_id"),
+            item_name=res.get("item_name") or "",
+            bullet_point=res.get("bullet_point") or "",
+            item_keywords=res.get("item_keywords") or "",
+            product_type=res.get("product_type"),
+            score=res.get("score", 0.0) if score is None else score,
+            embedding=res.get(embedding_key) if embedding is None else embedding,
+        )
+
+    @classmethod
+    def from_document(cls, doc, score: float = 0.0) -> "ProductRecord":
+        return cls.from_result(doc.metadata, score=score)
+
+    @property
+    def key(self) -> str:
+        return str(self.id) if self.id is not None else self.item_name
+
+    @property
+    def metadata(self) -> dict:
+        return {field: getattr(self, field) for field in PRODUCT_FIELDS}
+
+    def __repr__(self):
+        return f"ProductRecord(id={self.id!r}, item_name={self.item_name!r}, score={self.score:.4f})"
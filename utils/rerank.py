@@ -0,0 +1,84 @@
+"""Diversity reranking of over-fetched search hits.
+
+Product variants (same listing in another color or size) are nearly identical to the
+embeddings and can fill the whole top k. The retriever fetches `fetch_k` candidates with
+their embeddings, collapses near-duplicates and picks the final k by maximal marginal
+relevance (MMR), all with NumPy on the candidates' similarity matrix.
+"""
+from typing import List
+
+import numpy as np
+
+from utils.embedding_cache import normalize_text
+from utils.records import ProductRecord
+
+
+def _normalize(matrix):
+    norms = np.linalg.norm(matrix, axis=-1, keepdims=True)
+    norms[norms == 0] = 1
+    return matrix / norms
+
+
+def collapse_near_duplicates(relevance, similarity, threshold: float, names=None) -> np.ndarray:
+    """Indices of the candidates to keep, dropping any candidate with a cosine similarity of
+    at least `threshold` (or the same name) to a more relevant candidate that was kept"""
+    kept = []
+    seen_names = set()
+    for i in np.argsort(-relevance):
+        if names is not None and names[i] in seen_names:
+            continue
+        if kept and similarity[i, kept].max() >= threshold:
+            continue
+        kept.append(int(i))
+        if names is not None:
+            seen_names.add(names[i])
+    return np.array(kept, dtype=np.int64)
+
+
+def mmr(relevance, similarity, k: int, lambda_mult: float = 0.5) -> List[int]:
+    """Greedy MMR: argmax(lambda * rel(d) - (1 - lambda) * max sim(d, selected))"""
+    n = len(relevance)
+    if n == 0:
+        return []
+    k = min(k, n)
+    first = int(np.argmax(relevance))
+    selected = [first]
+    available = np.ones(n, dtype=bool)
+    available[first] = False
+    # Highest similarity of every candidate to the selected set, updated in place
+    max_similarity = similarity[first].copy()
+    while len(selected) < k:
+        scores = lambda_mult * relevance - (1 - lambda_mult) * max_similarity
+        scores[~available] = -np.inf
+        best = int(np.argmax(scores))
+        selected.append(best)
+        available[best] = False
+        np.maximum(max_similarity, similarity[best], out=max_similarity)
+    return selected
+
+
+def rerank_records(query_embedding, records: List[ProductRecord], k: int, lambda_mult: float = 0.5,
+                   dedup_threshold: float = 0.97) -> List[ProductRecord]:
+    """Returns the k records to put in the prompt, in MMR selection order"""
+    if not records:
+        return []
+    names = [normalize_text(record.item_name) for record in records]
+    if any(record.embedding is None for record in records):
+        # No vectors (e.g. a third party vector store), only exact duplicates can be removed
+        unique = {}
+        for name, record in zip(names, records):
+            unique.setdefault(name, record)
+        return list(unique.values())[:k]
+
+    matrix = _normalize(np.asarray([record.embedding for record in records], dtype=np.float32))
+    query = _normalize(np.asarray(query_embedding, dtype=np.float32))
+    relevance = matrix @ query
+    similarity = matrix @ matrix.T
+
+    kept = collapse_near_duplicates(relevance, similarity, dedup_threshold, names)
+    selected = mmr(relevance[kept], similarity[np.ix_(kept, kept)], k, lambda_mult)
+    reranked = [records[kept[i]] for i in selected]
+    for record in reranked:
+        # The vectors are not needed past this point
+        record.embedding = None
+    return reranked
@@ -0,0 +1,130 @@
+"""Query rewriting ahead of retrieval.
+
+ConversationalRetrievalChain calls the condense question LLM on every turn that has
+history. QuestionRewriter only does so when it has to: first turns and questions that
+read as standalone are passed through as is, and actual rewrites are cached per
+(history, question).
+"""
+import re
+import threading
+from collections import OrderedDict
+from hashlib import sha256
+from typing import Callable, List, Optional
+
+from utils.embedding_cache import normalize_text
+
+# Words that usually point back at something said earlier in the conversation
+REFERRING_WORDS = {
+    "it", "its", "itself", "that", "this", "those", "these", "them", "they", "their", "theirs",
+    "one", "ones", "same", "other", "others", "another", "else", "former", "latter",
+    "above", "previous", "earlier", "there", "here", "he", "she", "him", "her",
+    # comparatives only make sense against a previous answer
+    "more", "less", "cheaper", "bigger", "smaller", "larger", "better", "similar",
+}
+
+# Openers of elliptical follow-ups ("and in red?", "what about sandals?")
+FOLLOW_UP_OPENERS = ("and ", "also ", "but ", "or ", "what about ", "how about ", "same ", "any other ")
+
+_WORD = re.compile(r"[a-z0-9']+")
+
+
+def is_standalone(question: str, min_words: int = 3) -> bool:
+    """Cheap check that a question can be understood without the chat history"""
+    text = normalize_text(question)
+    if text.startswith(FOLLOW_UP_OPENERS) or text.startswith(("...", "…")):
+        return False
+    words = _WORD.findall(text)
+    # Very short questions ("in red?", "size 9?") are almost always ellipsis
+    if len(words) < min_words:
+        return False
+    return not any(word in REFERRING_WORDS for word in words)
+
+
+class QuestionRewriter:
+    """Turns a follow-up question into a standalone one, calling the LLM only when needed.
+
+    `question_generator` is the condense question LLMChain of the retrieval chain and
+    `get_chat_history` formats the history for its prompt.
+    """
+
+    def __init__(self, question_generator, get_chat_history: Callable[[List], str],
+                 max_entries: int = 1000, is_standalone: Callable[[str], bool] = is_standalone):
+        self.question_generator = question_generator
+        self.get_chat_history = get_chat_history
+        self.max_entries = max_entries
+        self.is_standalone = is_standalone
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"no_history": 0, "standalone": 0, "cache_hits": 0, "llm_rewrites": 0}
+
+    def _count(self, name):
+        with self._lock:
+            self.counters[name] += 1
+
+    def _key(self, history: str, question: str) -> str:
+        digest = sha256(history.encode("utf-8")).hexdigest()
+        return f"{digest}:{normalize_text(question)}"
+
+    def _get(self, key) -> Optional[str]:
+        with self._lock:
+            question = self._cache.get(key)
+            if question is not None:
+                self._cache.move_to_end(key)
+                self.counters["cache_hits"] += 1
+            return question
+
+    def _put(self, key, question):
+        with self._lock:
+            self._cache[key] = question
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+
+    def _fast_path(self, question, chat_history):
+        """Returns (question, None) when no LLM call is needed, else (None, (key, history))"""
+        history = self.get_chat_history(chat_history) if chat_history else ""
+        # A greeting from the assistant alone is not something to refer back to
+        if not history or all(getattr(m, "type", None) == "ai" for m in chat_history):
+            self._count("no_history")
+            return question, None
+        if self.is_standalone(question):
+            self._count("standalone")
+            return question, None
+        key = self._key(history, question)
+        cached = self._get(key)
+        if cached is not None:
+            return cached, None
+        return None, (key, history)
+
+    def rewrite(self, question: str, chat_history: List, callbacks=None) -> str:
+        rewritten, pending = self._fast_path(question, chat_history)
+        if pending is None:
+            return rewritten
+        key, history = pending
+        rewritten = self.question_generator.invoke({"question": question, "chat_history": history},
+                                                   config={"callbacks": callbacks})["text"].strip()
+        self._count("llm_rewrites")
+        rewritten = rewritten or question
+        self._put(key, rewritten)
+        return rewritten
+
+    async def arewrite(self, question: str, chat_history: List, callbacks=None) -> str:
+        rewritten, pending = self._fast_path(question, chat_history)
+        if pending is None:
+            return rewritten
+        key, history = pending
+        rewritten = (await self.question_generator.ainvoke({"question": question, "chat_history": history},
+                                                           config={"callbacks": callbacks}))["text"].strip()
+        self._count("llm_rewrites")
+        rewritten = rewritten or question
+        self._put(key, rewritten)
+        return rewritten
+
+    def stats(self) -> dict:
+        with self._lock:
+            calls = sum(self.counters.values())
+            return {
+                **self.counters,
+                "entries": len(self._cache),
+                "llm_rate": self.counters["llm_rewrites"] / calls if calls else 0.0,
+            }
@@ -0,0 +1,144 @@
+"""Deterministic intent routing ahead of the ReAct agent.
+
+The structured chat agent spends a Bedrock call on every turn just to pick a tool, even when
+the shopper says "add the blue cap to my cart" or "I want to return items from order
+OT1002". IntentRouter recognizes those turns with rules, extracts the tool arguments and
+returns the tool to call directly. The rules only fire when they are unambiguous: compound
+requests, questions and anything the rules do not cover fall through to the agent.
+
+Some intents depend on the previous answer, e.g. a reason for return is only expected
+right after the reasons were listed, and a product only counts as the one to return when it
+is an item of the order just listed. Once the shopper gave an email address, the reason goes
+to the agent, which can generate the return label straight away.
+"""
+import re
+from typing import Callable, Dict, List, Optional
+
+from utils.embedding_cache import normalize_text
+from utils.orders import RETURN_REASONS
+
+# Reasons as shoppers type them, without the " - Please specify" hint
+REASONS = [reason.split(" - ")[0] for reason in RETURN_REASONS]
+
+ORDER_ID = re.compile(r"\b([A-Za-z]{2}\d{3,})\b")
+# The order get_return_items listed, see ShoppingAssistant.get_tools
+_LISTED_ORDER = re.compile(r"OrderId:\s*([A-Za-z]{2}\d{3,})")
+_QUANTITY = re.compile(r"^(?:qty:?\s*|quantity:?\s*|x\s*)?(\d+)$", re.IGNORECASE)
+
+_ADD_TO_CART = re.compile(
+    r"^(?:please\s+)?(?:can you\s+|could you\s+)?(?:add|put)\s+(?P<product>.+?)\s+(?:to|in|into)\s+"
+    r"(?:my\s+|the\s+)?(?:shopping\s+)?(?:cart|basket|bag)(?:\s+please)?[\s.!]*$", re.IGNORECASE)
+_RETURN = re.compile(r"\b(?:return|returning|refund|send back)\b", re.IGNORECASE)
+# A second request in the same turn, e.g. "add it to my cart and show me hats"
+_COMPOUND = re.compile(r"\b(?:and|then|also)\s+(?:show|find|search|recommend|suggest|tell|add|return|what|which|how|do|can|is|are)\b",
+                       re.IGNORECASE)
+_ARTICLE = re.compile(r"^(?:the|a|an|one|some)\s+", re.IGNORECASE)
+_PRONOUN = re.compile(r"^(?:it|this|that|them|these|those|this one|that one)$", re.IGNORECASE)
+_EMAIL = re.compile(r"[\w.+-]+@[\w-]+(?:\.[\w-]+)+")
+
+# Prompts of the tools the previous answer came from, see ShoppingAssistant.get_tools
+ASKED_FOR_PRODUCT = "Please specify 'Product, Quantity"
+ASKED_FOR_REASON = "Please select reason for your return"
+
+
+class RoutedIntent:
+    __slots__ = ("name", "tool_name", "tool_input")
+
+    def __init__(self, name: str, tool_name: str, tool_input: dict):
+        self.name = name
+        self.tool_name = tool_name
+        self.tool_input = tool_input
+
+    def __repr__(self):
+        return f"RoutedIntent(name={self.name!r}, tool_name={self.tool_name!r}, tool_input={self.tool_input!r})"
+
+
+class IntentRouter:
+    """Maps high-confidence turns to a tool call, `route` returns None for the agent to decide"""
+
+    def __init__(self, tools: Dict, return_reasons: List[str] = REASONS, max_selection_words: int = 12,
+                 order_lookup: Optional[Callable[[str], Optional[dict]]] = None):
+        # Tool name -> LangChain tool, intents whose tool is missing never fire
+        self.tools = tools
+        # order id -> order of the current shopper, without it product selections go to the agent
+        self.order_lookup = order_lookup
+        self.return_reasons = return_reasons
+        self.max_selection_words = max_selection_words
+        self.counters = {"agent": 0}
+
+    def _last_answer(self, chat_history) -> str:
+        for message in reversed(chat_history or []):
+            if message.type == "ai":
+                return message.content
+        return ""
+
+    def _gave_email(self, text, chat_history) -> bool:
+        # The rolling summary of the memory keeps the email addresses of older turns
+        return bool(_EMAIL.search(text)) or any(
+            _EMAIL.search(message.content) for message in chat_history or [] if message.type in ("human", "system"))
+
+    def _reason(self, text) -> Optional[str]:
+        normalized = normalize_text(text)
+        found = [reason for reason in self.return_reasons if normalize_text(reason) in normalized]
+        return found[0] if len(found) == 1 else None
+
+    def _selected_item(self, text, last_answer) -> Optional[str]:
+        """'Product, Quantity' when the product is an item of the order listed in `last_answer`"""
+        order_ids = set(_LISTED_ORDER.findall(last_answer))
+        if self.order_lookup is None or len(order_ids) != 1:
+            return None
+        order = self.order_lookup(order_ids.pop().upper())
+        if not order:
+            return None
+        product, *rest = [part.strip() for part in text.rstrip(".").split(",")]
+        product = _ARTICLE.sub("", product)
+        items = [item for item in order.get("items", []) if normalize_text(item["name"]) == normalize_text(product)]
+        if len(items) != 1 or len(rest) > 1:
+            return None
+        if not rest:
+            return items[0]["name"]
+        quantity = _QUANTITY.match(rest[0])
+        ordered = str(items[0].get("quantity", ""))
+        if quantity is None or int(quantity.group(1)) < 1 or (ordered.isdigit() and int(quantity.group(1)) > int(ordered)):
+            return None
+        return f"{items[0]['name']}, {quantity.group(1)}"
+
+    def _match(self, text, chat_history) -> Optional[RoutedIntent]:
+        text = text.strip()
+        if not text or _COMPOUND.search(text):
+            return None
+        last_answer = self._last_answer(chat_history)
+
+        match = _ADD_TO_CART.match(text)
+        if match:
+            product = _ARTICLE.sub("", match.group("product").strip(" \"'"))
+            # "add it to my cart" needs the history to know what "it" is
+            if product and not _PRONOUN.match(product):
+                return RoutedIntent("add_to_cart", "add_product_to_cart", {"product": product})
+            return None
+
+        order_ids = {order_id.upper() for order_id in ORDER_ID.findall(text)}
+        if len(order_ids) == 1 and _RETURN.search(text) and "?" not in text:
+            return RoutedIntent("return_order", "get_return_items", {"order_no": order_ids.pop()})
+
+        short_answer = "?" not in text and len(text.split()) <= self.max_selection_words
+        if short_answer and (ASKED_FOR_REASON in last_answer or ASKED_FOR_PRODUCT in last_answer):
+            reason = self._reason(text)
+            if reason is not None and not self._gave_email(text, chat_history):
+                return RoutedIntent("return_reason", "get_email_for_return", {"reason": reason})
+        if short_answer and ASKED_FOR_PRODUCT in last_answer and not order_ids:
+            product = self._selected_item(text, last_answer)
+            if product is not None:
+                return RoutedIntent("return_product", "get_return_reasons", {"product": product})
+        return None
+
+    def route(self, text: str, chat_history=None) -> Optional[RoutedIntent]:
+        intent = self._match(text, chat_history)
+        if intent is None or intent.tool_name not in self.tools:
+            self.counters["agent"] += 1
+            return None
+        self.counters[intent.name] = self.counters.get(intent.name, 0) + 1
+        return intent
+
+    def run(self, intent: RoutedIntent) -> str:
+        return self.tools[intent.tool_name].run(intent.tool_input)
@@ -0,0 +1,180 @@
+"""Pool of warm assistants behind server.py.
+
+Each assistant type ("chat_doc", "chat_agent") gets `workers` ShoppingAssistant instances,
+built and warmed up before the server takes traffic. A session is always served by the same
+instance, picked by a stable hash of its id, so its in-memory history stays in one place,
+and its turns run one at a time, in the order they arrived.
+
+An instance runs at most `concurrency` turns at once and up to `queue_size` more wait for a
+slot. Past that, or after `queue_timeout` seconds of waiting, a request fails with Overloaded
+straight away instead of piling up behind the load balancer's idle timeout. A session
+waiting for its previous turn does not hold a slot.
+
+On shutdown the pool stops admitting requests and waits for the admitted ones to finish.
+"""
+import asyncio
+import contextlib
+import time
+import zlib
+from typing import Callable, Dict, Optional
+
+from utils.tracing import tracer as default_tracer
+
+REQUESTS_METRIC = "shopping_server_requests_total"
+QUEUE_WAIT_METRIC = "shopping_server_queue_wait_seconds"
+
+
+class Overloaded(Exception):
+    """The instance serving the session is at capacity, retry after `retry_after` seconds"""
+
+    def __init__(self, message, retry_after=1):
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class ShuttingDown(Exception):
+    pass
+
+
+class Worker:
+    """One warm assistant with its admission limits"""
+
+    def __init__(self, assistant, concurrency: int = 4, queue_size: int = 16):
+        self.assistant = assistant
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        # Admitted turns, running or waiting
+        self.pending = 0
+        self.running = 0
+        self._slots = asyncio.Semaphore(concurrency)
+        # session id -> [lock, turns of the session admitted]
+        self._sessions = {}
+
+    @property
+    def waiting(self):
+        return self.pending - self.running
+
+    def admit(self):
+        if self.pending >= self.concurrency + self.queue_size:
+            raise Overloaded(f"{self.pending} requests in progress or queued")
+        self.pending += 1
+
+    @contextlib.asynccontextmanager
+    async def turn(self, session_id, timeout: Optional[float] = None):
+        """Admitted turn of `session_id`, yields the assistant once it has a slot"""
+        self.admit()
+        session = self._sessions.setdefault(session_id, [asyncio.Lock(), 0])
+        session[1] += 1
+        deadline = time.monotonic() + timeout if timeout else None
+        try:
+            # Session order first, so a session holds at most one slot
+            await self._acquire(session[0], deadline)
+            try:
+                await self._acquire(self._slots, deadline)
+                self.running += 1
+                try:
+                    yield self.assistant
+                finally:
+                    self.running -= 1
+                    self._slots.release()
+            finally:
+                session[0].release()
+        finally:
+            self.pending -= 1
+            session[1] -= 1
+            if not session[1]:
+                del self._sessions[session_id]
+
+    @staticmethod
+    async def _acquire(lock, deadline):
+        if deadline is None:
+            return await lock.acquire()
+        try:
+            await asyncio.wait_for(lock.acquire(), max(deadline - time.monotonic(), 0))
+        except asyncio.TimeoutError:
+            raise Overloaded("timed out waiting for a slot") from None
+
+    def stats(self) -> dict:
+        return {"running": self.running, "waiting": self.waiting, "sessions": len(self._sessions)}
+
+
+class AssistantPool:
+    """`factories` maps an assistant type to a function building one ShoppingAssistant"""
+
+    def __init__(self, factories: Dict[str, Callable], workers: int = 2, concurrency: int = 4,
+                 queue_size: int = 16, queue_timeout: float = 30.0, tracer=default_tracer):
+        self.factories = dict(factories)
+        self.workers = workers
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.queue_timeout = queue_timeout
+        self.tracer = tracer
+        self.pools: Dict[str, list] = {}
+        self.ready = False
+        self.accepting = True
+
+    @classmethod
+    def from_env(cls, env, factories, **kwargs):
+        types = [t.strip() for t in env.get('SERVER_ASSISTANTS', ','.join(factories)).split(',') if t.strip()]
+        unknown = [t for t in types if t not in factories]
+        if unknown:
+            raise ValueError(f"Unknown SERVER_ASSISTANTS {unknown}, expected some of {list(factories)}")
+        return cls({t: factories[t] for t in types},
+                   workers=int(env.get('SERVER_WORKERS', 2)),
+                   concurrency=int(env.get('SERVER_CONCURRENCY', 4)),
+                   queue_size=int(env.get('SERVER_QUEUE_SIZE', 16)),
+                   queue_timeout=float(env.get('SERVER_QUEUE_TIMEOUT', 30)), **kwargs)
+
+    async def start(self):
+        """Builds and warms up every instance, one at a time since they share the clients and caches"""
+        loop = asyncio.get_running_loop()
+        for assistant_type, factory in self.factories.items():
+            workers = []
+            for _ in range(self.workers):
+                assistant = await loop.run_in_executor(None, lambda: factory().warm_up())
+                workers.append(Worker(assistant, self.concurrency, self.queue_size))
+            self.pools[assistant_type] = workers
+        self.ready = True
+
+    def worker(self, assistant_type, session_id) -> Worker:
+        workers = self.pools.get(assistant_type)
+        if not workers:
+            raise KeyError(assistant_type)
+        # hash() is salted per process, crc32 picks the same instance on every replica
+        return workers[zlib.crc32(session_id.encode("utf-8")) % len(workers)]
+
+    @contextlib.asynccontextmanager
+    async def turn(self, assistant_type, session_id):
+        """The assistant serving `session_id`, once the session's turn has a slot"""
+        if not self.accepting:
+            raise ShuttingDown("the server is shutting down")
+        worker = self.worker(assistant_type, session_id)
+        start = time.perf_counter()
+        try:
+            async with worker.turn(session_id, self.queue_timeout) as assistant:
+                self.tracer.observe(QUEUE_WAIT_METRIC, time.perf_counter() - start, assistant=assistant_type)
+                yield assistant
+        except Overloaded:
+            self.tracer.inc(REQUESTS_METRIC, assistant=assistant_type, outcome="rejected")
+            raise
+        except BaseException:
+            self.tracer.inc(REQUESTS_METRIC, assistant=assistant_type, outcome="error")
+            raise
+        self.tracer.inc(REQUESTS_METRIC, assistant=assistant_type, outcome="ok")
+
+    @property
+    def pending(self):
+        return sum(w.pending for workers in self.pools.values() for w in workers)
+
+    async def drain(self, timeout: float = 25.0):
+        """Stops admitting requests and waits up to `timeout` seconds for the admitted ones,
+        returns how many were still pending"""
+        self.accepting = False
+        deadline = time.monotonic() + timeout
+        while self.pending and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        return self.pending
+
+    def stats(self) -> dict:
+        return {"ready": self.ready, "accepting": self.accepting,
+                "assistants": {t: [w.stats() for w in workers] for t, workers in self.pools.items()}}
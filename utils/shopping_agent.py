@@ -1,35 +1,196 @@
-import boto3
-from langchain.embeddings import BedrockEmbeddings
+import functools
+import logging
+import re
+
 from utils.mongoretriever import MongoDBExtendedRetriever, MongoDBVector
+from utils.local_vector import LocalVectorSearch
+from utils.query_filters import QueryConstraintExtractor
+from utils.compress import ContextCompressor
+from utils.decompose import QueryDecomposer
+from utils.router import IntentRouter
+from utils.orders import DEMO_CUSTOMER, RETURN_REASONS, InMemoryOrderStore, MongoOrderStore, OrderRepository, current_session
+from utils.embedding_cache import CachedEmbeddings
+from utils.answer_cache import SemanticAnswerCache, get_catalog_version
 from utils.langchain import LangChainAssistant
-from langchain.tools import tool
-from langchain.tools import StructuredTool
+from langchain_core.runnables.config import run_in_executor
+from langchain_core.tools import StructuredTool, tool
 from utils.load_env import load_env
+from utils.clients import bedrock_options_from_env, get_bedrock_client, get_mongo_client, mongo_options_from_env
+from utils.tracing import InstrumentedBedrockClient, tracer
+from utils.ratelimit import LIMITED_CLIENT_OPTIONS, RateLimitedBedrockClient, bedrock_limiter
+from utils.singleflight import CoalescingBedrockClient, single_flight
+from utils.model_routing import FAST_MODEL, model_router
+from utils.memory import DEFAULT_SESSION, ConversationMemory, InMemorySessionStore, MongoSessionStore, NamespacedSessionStore
+
+module_logger = logging.getLogger(__name__)
 
 class ShoppingAssistant():
-    def __init__(self,modelId,prompt_data, model_type="chat_doc", logger= None):
+    def __init__(self,modelId,prompt_data, model_type="chat_doc", logger= None, use_answer_cache=False):
         env = load_env()
-        self.boto3_bedrock  = boto3.client(
-            service_name="bedrock-runtime",
-            region_name=env.get('REGION'),
-        )
-        self.logger = logger
+        # Trace file and metrics endpoint, see utils.tracing
+        tracer.configure_from_env(env)
+        # Shared with every other assistant in the process, see utils.clients. The wrappers
+        # time every Bedrock request, count the tokens it reports and keep the process under
+        # the Bedrock quotas, see utils.ratelimit
+        bedrock_limiter.configure_from_env(env)
+        bedrock_options = {**bedrock_options_from_env(env), **LIMITED_CLIENT_OPTIONS}
+        self.boto3_bedrock = RateLimitedBedrockClient(
+            InstrumentedBedrockClient(get_bedrock_client(env.get('REGION'), **bedrock_options)))
+        # Identical embeddings, searches and completions running at the same time are sent
+        # once, see utils.singleflight. REQUEST_COALESCING=false turns it off
+        self.single_flight = None
+        if env.get('REQUEST_COALESCING', 'true').lower() != 'false':
+            self.single_flight = single_flight
+            self.boto3_bedrock = CoalescingBedrockClient(self.boto3_bedrock, single_flight)
+        # Model per call type with latency budgets and fallbacks, see utils.model_routing.
+        # Off unless MODEL_ROUTING=true, every call goes to modelId then
+        model_router.configure_from_env(env)
+        self.model_router = model_router if model_router.enabled else None
+        self.logger = logger if logger is not None else module_logger
         self.modelId = modelId
-        self.br_embeddings = BedrockEmbeddings(client=self.boto3_bedrock, model_id='amazon.titan-embed-text-v1')
+        self.embedding_cache_path = env.get('EMBEDDING_CACHE_PATH', '.cache/embeddings.sqlite')
         self.domain_index = "products-metadata"
         self.mdb_endpoint = env.get('MDB_URI')
         self.mdb_collection = env.get('MDB_COLLECTION')
         self.mdb_database = env.get('MDB_DATABASE')
-        self.retriever = self.get_retriever( search_kwargs={"k": 7})
-        self.product_qa = self.get_product_qa()
+        self.vector_backend = env.get('VECTOR_BACKEND', 'atlas')
+        self.vector_snapshot_path = env.get('VECTOR_SNAPSHOT_PATH')
+        self.search_type = env.get('SEARCH_TYPE', 'similarity')
+        # Catalog fields used as vector search pre-filters, they must be "filter" paths of the index
+        self.query_filter_fields = [f.strip() for f in env.get('QUERY_FILTER_FIELDS', '').split(',') if f.strip()]
+        self.mdb_client_options = mongo_options_from_env(env)
+        self.use_answer_cache = use_answer_cache
+        # Cosine similarity from which a past question gets the same answer, and seconds it is kept
+        self.answer_cache_threshold = float(env.get('ANSWER_CACHE_THRESHOLD', 0.95))
+        self.answer_cache_ttl = float(env.get('ANSWER_CACHE_TTL', 600))
+        self.memory_store = self.get_memory_store(env)
+        self.memory_max_tokens = int(env.get('MEMORY_MAX_TOKENS', 2000))
+        # Writes the summary of the turns leaving the window, MEMORY_SUMMARY_MODEL=none keeps a
+        # truncated transcript instead
+        self.memory_summary_model = env.get('MEMORY_SUMMARY_MODEL', FAST_MODEL)
+        # Hybrid search ranks exact keyword matches higher, so fewer documents are needed
+        self.search_kwargs = search_kwargs = {"k": 5 if self.search_type == "hybrid" else 7}
+        # Over-fetch and rerank for diversity, RERANK_FETCH_K=0 turns it off
+        fetch_k = int(env.get('RERANK_FETCH_K', 30))
+        if fetch_k:
+            search_kwargs.update(fetch_k=fetch_k, lambda_mult=float(env.get('RERANK_LAMBDA', 0.7)))
+        # Compact table of the hits in the prompt, CONTEXT_COMPRESSION=false restores the verbose strings
+        self.compressor = None
+        if env.get('CONTEXT_COMPRESSION', 'true').lower() != 'false':
+            self.compressor = ContextCompressor(max_description_tokens=int(env.get('CONTEXT_ITEM_TOKENS', 80)))
+        # "a hat and earrings" is searched as one sub-query per product, QUERY_DECOMPOSITION=false turns it off
+        self.decomposer = QueryDecomposer() if env.get('QUERY_DECOMPOSITION', 'true').lower() != 'false' else None
+        # Orders of the return tools, see get_orders
+        self.orders_collection = env.get('ORDERS_COLLECTION', 'orders')
+        self.orders_customer_id = env.get('ORDERS_CUSTOMER_ID')
+        self.orders_by_session = env.get('ORDERS_CUSTOMER_FROM_SESSION', 'false').lower() == 'true'
+        self.orders_cache_ttl = float(env.get('ORDERS_CACHE_TTL', 300))
+        # The embeddings, retriever, product_qa and orders are built on first use, see the properties below
         self.tools = self.get_tools()
-        self.product_agent = LangChainAssistant(modelId=modelId, bedrock_client=self.boto3_bedrock, retriever= self.retriever, prompt_data= prompt_data, model_type= model_type, tools=self.tools)
+        # Simple tool actions skip the agent, INTENT_ROUTER=false sends every turn to it
+        self.router = None
+        if model_type == "chat_agent" and env.get('INTENT_ROUTER', 'true').lower() != 'false':
+            self.router = IntentRouter(self.direct_tools, order_lookup=lambda order_id: self.orders.order(
+                current_session.get() or DEFAULT_SESSION, order_id))
+        # The agent only reaches the retriever through its tools, it is built on the first search
+        retriever = self.retriever if model_type != "chat_agent" else None
+        self.product_agent = LangChainAssistant(modelId=modelId, bedrock_client=self.boto3_bedrock, retriever= retriever, prompt_data= prompt_data, model_type= model_type, tools=self.tools,
+                                                answer_cache=self.get_answer_cache() if model_type == "chat_doc" else None,
+                                                model_router=self.model_router,
+                                                memory=self.get_memory(namespace=model_type, initial_ai_message="How can I help you?" if model_type == "chat_agent" else None))
+
+    def run(self, query, session_id=DEFAULT_SESSION):
+        # The order tools read the session from the context
+        current_session.set(session_id)
+        intent = self.route(query, session_id)
+        if intent is not None:
+            return self.run_intent(intent, query, session_id)
+        return self.product_agent.run(query, session_id=session_id) 
+
+    async def arun(self, query, session_id=DEFAULT_SESSION):
+        current_session.set(session_id)
+        # Routing reads the history and routed tools read the orders, both can be MongoDB
+        # queries: they run on a thread, with the context, so they don't block the event loop
+        intent = await run_in_executor(None, self.route, query, session_id)
+        if intent is not None:
+            return await run_in_executor(None, self.run_intent, intent, query, session_id)
+        return await self.product_agent.arun(query, session_id=session_id)
 
-    def run(self, query):
-        return self.product_agent.run(query) 
+    def stream(self, query, session_id=DEFAULT_SESSION):
+        current_session.set(session_id)
+        intent = self.route(query, session_id)
+        if intent is not None:
+            return iter([self.run_intent(intent, query, session_id)])
+        return self.product_agent.stream(query, session_id=session_id)
+
+    async def astream(self, query, session_id=DEFAULT_SESSION):
+        current_session.set(session_id)
+        intent = await run_in_executor(None, self.route, query, session_id)
+        if intent is not None:
+            yield await run_in_executor(None, self.run_intent, intent, query, session_id)
+            return
+        async for token in self.product_agent.astream(query, session_id=session_id):
+            yield token
+
+    def route(self, query, session_id=DEFAULT_SESSION):
+        if self.router is None:
+            return None
+        return self.router.route(query, self.product_agent.memory.messages(session_id))
+
+    def run_intent(self, intent, query, session_id=DEFAULT_SESSION):
+        # The tools are local and answer in microseconds, no Bedrock call is made
+        with tracer.trace("router", session_id=session_id, intent=intent.name):
+            with tracer.span(f"tool.{intent.tool_name}"):
+                output = self.router.run(intent)
+        self.product_agent.memory.save_turn(session_id, query, output)
+        return output
     
-    def clear_history(self):
-        return self.product_agent.clear_history()
+    def clear_history(self, session_id=DEFAULT_SESSION, initial_text=None):
+        return self.product_agent.clear_history(initial_text=initial_text, session_id=session_id)
+
+    @functools.cached_property
+    def br_embeddings(self):
+        from langchain_community.embeddings.bedrock import BedrockEmbeddings
+        return CachedEmbeddings(
+            BedrockEmbeddings(client=self.boto3_bedrock, model_id='amazon.titan-embed-text-v1'),
+            db_path=self.embedding_cache_path
+        )
+
+    @functools.cached_property
+    def retriever(self):
+        return self.get_retriever(search_kwargs=self.search_kwargs)
+
+    @functools.cached_property
+    def product_qa(self):
+        return self.get_product_qa()
+
+    @functools.cached_property
+    def orders(self):
+        return self.get_orders()
+
+    @functools.cached_property
+    def summary_llm(self):
+        if not self.memory_summary_model or self.memory_summary_model.lower() == 'none':
+            return None
+        from langchain_community.llms.bedrock import Bedrock
+        return Bedrock(model_id=self.memory_summary_model, client=self.boto3_bedrock,
+                       model_kwargs={"temperature": 0, "max_tokens_to_sample": 512})
+
+    def warm_up(self):
+        """Builds what the first query would, e.g. before a server takes traffic"""
+        self.retriever
+        return self
+
+    def get_memory_store(self, env):
+        if env.get('MEMORY_STORE') == 'mongo':
+            # Sessions survive restarts and can be served by any replica
+            client = get_mongo_client(self.mdb_endpoint, **mongo_options_from_env(env))
+            return MongoSessionStore(client[self.mdb_database][env.get('MEMORY_COLLECTION', 'chat_sessions')])
+        return InMemorySessionStore()
+
+    def get_memory(self, namespace, initial_ai_message=None):
+        return ConversationMemory(NamespacedSessionStore(self.memory_store, namespace), max_tokens=self.memory_max_tokens,
+                                  summary_llm=self.summary_llm, initial_ai_message=initial_ai_message)
 
     def get_product_qa(self):
         prompt_data = """You are ShoppingBot, a retail shopping assistant who helps in finding products from catalog.
@@ -43,9 +204,22 @@ class ShoppingAssistant():
 
         <question>{question}</question>"""
         modelId="anthropic.claude-instant-v1"
-        assistant = LangChainAssistant(modelId=modelId, bedrock_client=self.boto3_bedrock, retriever= self.retriever, prompt_data= prompt_data, model_type= "chat_doc")
+        assistant = LangChainAssistant(modelId=modelId, bedrock_client=self.boto3_bedrock, retriever= self.retriever, prompt_data= prompt_data, model_type= "chat_doc",
+                                       answer_cache=self.get_answer_cache(), memory=self.get_memory(namespace="product_qa"),
+                                       model_router=self.model_router)
+
+        return assistant
 
-        return assistant.model
+    def get_answer_cache(self):
+        if not self.use_answer_cache:
+            return None
+
+        # Cached answers are dropped whenever the product collection is re-ingested
+        collection = self.retriever.vectorstore._collection
+        options = dict(threshold=self.answer_cache_threshold, ttl=self.answer_cache_ttl)
+        if collection is None:
+            return SemanticAnswerCache(self.br_embeddings, **options)
+        return SemanticAnswerCache(self.br_embeddings, catalog_version=lambda: get_catalog_version(collection), **options)
     
     def get_retriever(self, search_kwargs):
         self.logger.info('In retriever')
@@ -56,18 +230,53 @@ class ShoppingAssistant():
             uri= self.mdb_endpoint,
             db_name = self.mdb_database,
             collection_name = self.mdb_collection,
-            index_name = self.domain_index
+            index_name = self.domain_index,
+            backend = self.vector_backend,
+            snapshot_path = self.vector_snapshot_path,
+            client_options = self.mdb_client_options
          )
 
         vectordb = vector.get_vector_db(embeddings = self.br_embeddings)     
 
-        retriever = MongoDBExtendedRetriever(vectorstore= vectordb, search_type='similarity', search_kwargs={"k": 7})
+        async_collection = vector.get_async_collection() if self.vector_backend == 'atlas' else None
+
+        retriever = MongoDBExtendedRetriever(vectorstore= vectordb, search_type=self.search_type, search_kwargs=search_kwargs,
+                                             async_collection=async_collection,
+                                             constraint_extractor=self.get_constraint_extractor(vectordb),
+                                             compressor=self.compressor,
+                                             decomposer=self.decomposer,
+                                             single_flight=self.single_flight)
 
         print('Got retriever')
         self.logger.info('Got retriever')
 
         return retriever
 
+    def get_orders(self):
+        # ORDERS_CUSTOMER_ID pins one account for every session, ORDERS_CUSTOMER_FROM_SESSION=true
+        # is for frontends whose session id is the customer id. Without either, every session
+        # sees the sample orders
+        if self.mdb_endpoint and (self.orders_customer_id or self.orders_by_session):
+            client = get_mongo_client(self.mdb_endpoint, **self.mdb_client_options)
+            store = MongoOrderStore(client[self.mdb_database][self.orders_collection])
+            customer_id = (lambda session_id: self.orders_customer_id) if self.orders_customer_id else None
+        else:
+            store = InMemoryOrderStore()
+            customer_id = lambda session_id: DEMO_CUSTOMER
+        return OrderRepository(store, ttl=self.orders_cache_ttl, customer_id=customer_id)
+
+    def get_constraint_extractor(self, vectordb):
+        if not self.query_filter_fields:
+            return None
+        try:
+            if isinstance(vectordb, LocalVectorSearch):
+                return QueryConstraintExtractor.from_metadatas(vectordb._state.metadatas, fields=self.query_filter_fields)
+            return QueryConstraintExtractor.from_collection(vectordb._collection, fields=self.query_filter_fields)
+        except Exception as e:
+            # Searches still work without the pre-filters
+            self.logger.warning(f"Could not build query filters: {e}")
+            return None
+
     def get_tools(self):
 
         # @tool(return_direct=True)
@@ -80,8 +289,7 @@ class ShoppingAssistant():
         #     Useful for finding products with name, description, color, size, weight and other product attributes.
         #     Return the output without processing further.
         #     """
-        #     res = self.product_qa(query)
-        #     output = res['result']
+        #     output = self.product_qa.run(query)
         #     # documents = self.product_retriever.get_relevant_documents(query)
         #     # print(documents)
         #     # output = ''
@@ -106,6 +314,13 @@ class ShoppingAssistant():
                 output = f"{output}{doc.page_content}\n"
             return output
 
+        async def aretrieve_products(query: str) -> str:
+            documents = await self.retriever.aget_relevant_documents(query)
+            return "".join(f"{doc.page_content}\n" for doc in documents)
+
+        # Lets the agent's async path await the retriever instead of blocking a thread
+        retrieve_products.coroutine = aretrieve_products
+
         # @tool
         # def retrieve_products(query: str) -> str:
         #     """Find and suggest products from catalog based on users needs or preferences in the query. 
@@ -141,97 +356,44 @@ class ShoppingAssistant():
             Return orderId and Items and ask user to 'Select items for return & reason for return from the list'.
             """
             try:
-                #result = self.db.getItemsByStatus("delivered")
-                result = [
-                    {
-                        "orderId": "OT1002",
-                        "items": [
-                            {
-                                "name": "Knitted Cap",
-                                "price": "100",
-                                "quantity": "2"
-                            }
-                        ]
-                    },
-                    {
-                        "orderId": "OT1003",
-                        "items": [
-                            {
-                                "name": "Blue Shirt",
-                                "price": "300",
-                                "quantity": "1"
-                            }
-                        ]
-                    }
-                ]
-
-                orders = ''
-
-                for order in result:
-                    format = "\n ".join([f"- {item['name']}, Price: {item['price']},  Qty: {item['quantity']}" for item in order['items']])
-                    orders = f"{orders}OrderId: {order['orderId']} \n {format} \n\n"
+                session_id = current_session.get() or DEFAULT_SESSION
+                # "show me more orders" continues after the last page shown in this session
+                more = _MORE_ORDERS.search(query) is not None
+                page = self.orders.returnable_orders(session_id, more=more)
+                if not page.orders:
+                    return "There are no more orders available for return." if more else "There are no orders available for return."
 
-                
-                reasons = [
-                'Low Quality',
-                'Large Size',
-                'Small Size',
-                'Other - Please specify'
-                ]
-                return_reasons = "\n ".join([f"- {item}" for item in reasons])
-                
-                #output = f"Please select an order you want to initiate return for: \n\n {orders}"
+                orders = "".join(
+                    f"OrderId: {order['orderId']} \n " + "\n ".join(_format_item(item) for item in order['items']) + " \n\n"
+                    for order in page.orders
+                )
+                if page.next_cursor is not None:
+                    orders = f"{orders}There are more orders, ask to see more orders. \n\n"
+                return_reasons = "\n ".join([f"- {item}" for item in RETURN_REASONS])
 
                 output = f"Please specify a product you want you want to initiate return for in the format 'OrderId, Product, Quantity, Return Reason': \n\n {orders} Return Reasons: \n {return_reasons}"
                 
-                return result
+                return output
             except Exception as e:
-                print(e)
+                self.logger.warning(f"Could not get the orders: {e}")
+                return "Could not get the orders, please try again later."
         
-        # @tool(return_direct=True)
-        @tool
+        # Its output is the answer, as when the intent router calls it
+        @tool(return_direct=True)
         def get_return_items(order_no: str) -> str:
             """Gets the list of products in order with order_no.
             Use it ONLY when the user asks for returning the products and gives the order number. For example `I would like to return products for order OT1002.`
             Return the output without processing further.
             """
-            #result = self.db.getItemsByOrderId(order_no)
-            result = [
-                    {
-                        "orderId": "OT1002",
-                        "items": [
-                            {
-                                "name": "Graph Paper",
-                                "price": "100",
-                                "quantity": "2"
-                            }
-                        ]
-                    },
-                    {
-                        "orderId": "OT1003",
-                        "items": [
-                            {
-                                "name": "Blue Shirt",
-                                "price": "300",
-                                "quantity": "1"
-                            }
-                        ]
-                    }
-                ]
-
-            #print(str(result))
-
-            reasons = [
-                'Low Quality',
-                'Large Size',
-                'Small Size',
-                'Other - Please specify'
-                ]
-            return_reasons = "\n ".join([f"- {item}" for item in reasons])
-
-            format = "\n ".join([f"- {item['name']}, Price: {item['price']},  Qty: {item['quantity']}" for item in result[0]['items']])
-            orders = f"OrderId: {result[0]['orderId']} \n {format}"
-            #output = f"Please select product you want to return: \n\n OrderId: {result[0]['orderId']} \n\n {format}"
+            order = self.orders.order(current_session.get() or DEFAULT_SESSION, order_no.strip().upper())
+            if order is None:
+                return f"Could not find order {order_no}. Please check the order number."
+
+            return_reasons = "\n ".join([f"- {item}" for item in RETURN_REASONS])
+
+            format = "\n ".join(_format_item(item) for item in order['items'])
+            orders = f"OrderId: {order['orderId']} \n {format}"
+            #output = f"Please select product you want to return: \n\n OrderId: {order['orderId']} \n\n {format}"
             output = f"Please specify 'Product, Quantity: \n\n {orders} \n\n also mention Return Reason: \n {return_reasons}"
             return output
         
@@ -241,13 +403,7 @@ class ShoppingAssistant():
             Use this to get list of return reasons once the user selects a product to return. 
             Return the output without processing further.
             """
-            reasons = [
-                'Low Quality',
-                'Large Size',
-                'Small Size',
-                'Other - Please specify'
-            ]
-            format = "\n ".join([f"- {item}" for item in reasons])
+            format = "\n ".join([f"- {item}" for item in RETURN_REASONS])
             output = f"Added {product} for return. Please select reason for your return: \n\n {format}"
             return output
         
@@ -284,5 +440,15 @@ class ShoppingAssistant():
         label_tool = StructuredTool.from_function(generate_return_label)
         
         tools = [retrieve_products, add_product_to_cart,get_orders_for_return, get_return_items, get_email_for_return, label_tool]
+        # Tools the intent router may call without the agent
+        self.direct_tools = {t.name: t for t in [add_product_to_cart, get_return_items, get_return_reasons, get_email_for_return]}
 
         return tools
+
+
+# Whole words, "anymore" or "nextday" do not ask for the next page
+_MORE_ORDERS = re.compile(r"\b(?:more|next|older)\b", re.IGNORECASE)
+
+
+def _format_item(item):
+    return f"- {item['name']}, Price: {item['price']},  Qty: {item['quantity']}"
@@ -0,0 +1,277 @@
+"""Single-flight coalescing of identical concurrent calls.
+
+When many shoppers send the same question at once, each one used to embed it, run the same
+vector search and send the same first-turn completion. SingleFlight runs one call per key
+at a time: callers that arrive while it is in flight wait for its result instead of
+issuing a duplicate. Nothing is kept once the call returns, so there is no staleness
+window, unlike the embedding and answer caches.
+
+Threads and asyncio tasks share the same calls. The work of an async call runs in its own
+task, so a caller that is cancelled does not cancel it for the others.
+
+CoalescingBedrockClient applies it to the Bedrock requests, keyed by model id and request
+body. A response stream stays shared until it ends: a caller that joins while it is read
+gets the events received so far, then the rest as they arrive.
+"""
+import asyncio
+import concurrent.futures
+import io
+import json
+import threading
+import weakref
+from hashlib import sha256
+
+
+_NO_EVENT = object()
+
+
+def digest(*parts) -> str:
+    """Stable key of an operation's inputs, e.g. digest("search", query, search_kwargs)"""
+    payload = json.dumps(parts, sort_keys=True, separators=(",", ":"), default=str)
+    return sha256(payload.encode("utf-8")).hexdigest()
+
+
+class _Call:
+    __slots__ = ("future", "loop", "task")
+
+    def __init__(self, loop=None):
+        self.future = concurrent.futures.Future()
+        # Event loop running the call, None when it runs in a thread
+        self.loop = loop
+        self.task = None
+
+
+def _running_loop():
+    try:
+        return asyncio.get_running_loop()
+    except RuntimeError:
+        return None
+
+
+class SingleFlight:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+        self.counters = {"calls": 0, "coalesced": 0}
+
+    def _join(self, key, loop=None, blocking=False):
+        """The call in flight for `key` and whether the caller leads it, None when a blocking
+        caller would wait on the event loop that runs the call"""
+        with self._lock:
+            self.counters["calls"] += 1
+            call = self._calls.get(key)
+            if call is None:
+                call = self._calls[key] = _Call(loop)
+                return call, True
+            if blocking and call.loop is not None and call.loop is _running_loop():
+                return None, False
+            self.counters["coalesced"] += 1
+            return call, False
+
+    def _finish(self, key, call, result=None, error=None):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+        if error is not None:
+            call.future.set_exception(error)
+        else:
+            call.future.set_result(result)
+
+    def do(self, key, fn):
+        """Returns fn(), or the result of the identical call in flight"""
+        call, leader = self._join(key, blocking=True)
+        if call is None:
+            return fn()
+        if not leader:
+            return call.future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            raise
+        self._finish(key, call, result)
+        return result
+
+    async def ado(self, key, coroutine_fn):
+        """Returns await coroutine_fn(), or the result of the identical call in flight"""
+        loop = asyncio.get_running_loop()
+        call, leader = self._join(key, loop)
+        if leader:
+            call.task = loop.create_task(self._lead(key, call, coroutine_fn))
+        return await asyncio.shield(asyncio.wrap_future(call.future))
+
+    async def _lead(self, key, call, coroutine_fn):
+        try:
+            result = await coroutine_fn()
+        except BaseException as e:
+            self._finish(key, call, error=e)
+            return
+        self._finish(key, call, result)
+
+    def stream(self, key, open_stream):
+        """Returns open_stream(), whose "body" is shared with the identical calls made until it
+        has been read"""
+        call, leader = self._join(key, blocking=True)
+        if call is None:
+            return open_stream()
+        if leader:
+            try:
+                response = open_stream()
+            except BaseException as e:
+                self._finish(key, call, error=e)
+                raise
+            shared = _SharedStream(response["body"], on_end=lambda: self._forget(key, call))
+            # Unlike `do`, the call stays in flight until the stream ends
+            call.future.set_result((response, shared))
+        else:
+            response, shared = call.future.result()
+        return {**response, "body": shared.subscribe()}
+
+    def _forget(self, key, call):
+        with self._lock:
+            if self._calls.get(key) is call:
+                del self._calls[key]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {**self.counters, "in_flight": len(self._calls)}
+
+
+class _SharedStream:
+    """Replays the events of one stream to every subscriber, whichever reads first pulls the next.
+
+    The source is read outside the lock, one subscriber at a time: while it waits for the
+    next event, the others still replay the events already received.
+    """
+
+    def __init__(self, source, on_end):
+        self._source = iter(source)
+        self._on_end = on_end
+        self._events = []
+        self._done = False
+        self._error = None
+        self._pulling = False
+        self._subscribers = 0
+        self._condition = threading.Condition()
+
+    def subscribe(self):
+        with self._condition:
+            self._subscribers += 1
+        return _Subscription(self)
+
+    def _get(self, i):
+        """Event `i`, pulled from the source if no subscriber did yet"""
+        while True:
+            with self._condition:
+                while i >= len(self._events) and not self._done and self._pulling:
+                    self._condition.wait()
+                if i < len(self._events):
+                    return self._events[i]
+                if self._error is not None:
+                    raise self._error
+                if self._done:
+                    raise StopIteration
+                self._pulling = True
+            self._pull()
+
+    def _unsubscribe(self):
+        with self._condition:
+            self._subscribers -= 1
+            abandoned = self._subscribers == 0 and not self._done
+        if abandoned:
+            # New calls open their own stream, a late subscriber can still finish this one
+            self._end()
+
+    def _end(self):
+        # The callback references the call, whose result references this stream: dropping it
+        # breaks the cycle, so the source is collected (and its rate limit slot released) as
+        # soon as nobody reads it
+        on_end, self._on_end = self._on_end, None
+        if on_end is not None:
+            on_end()
+
+    def _pull(self):
+        event = _NO_EVENT
+        error = None
+        done = False
+        try:
+            event = next(self._source)
+        except StopIteration:
+            done = True
+        except Exception as e:
+            error = e
+            done = True
+        finally:
+            # Also when the puller is interrupted, another subscriber then pulls instead
+            with self._condition:
+                self._pulling = False
+                if event is not _NO_EVENT:
+                    self._events.append(event)
+                if done:
+                    self._done = True
+                    self._error = error
+                self._condition.notify_all()
+        if done:
+            self._end()
+
+
+class _Subscription:
+    """Position of one subscriber in a _SharedStream. It unsubscribes once read to the end,
+    closed or garbage collected, even if it was never read"""
+
+    def __init__(self, shared: _SharedStream):
+        self._shared = shared
+        self._next = 0
+        self._finalizer = weakref.finalize(self, shared._unsubscribe)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        try:
+            event = self._shared._get(self._next)
+        except BaseException:
+            self.close()
+            raise
+        self._next += 1
+        return event
+
+    def close(self):
+        # Runs _unsubscribe at most once
+        self._finalizer()
+
+
+# Shared by the retrievers and Bedrock clients of the process
+single_flight = SingleFlight()
+
+
+def _buffered(response):
+    # The body stream can only be read once, every caller gets its own copy
+    return {**response, "body": response["body"].read()}
+
+
+class CoalescingBedrockClient:
+    """Wraps a bedrock-runtime client so identical concurrent requests are sent once"""
+
+    def __init__(self, client, flight: SingleFlight = single_flight):
+        self._client = client
+        self._flight = flight
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    @staticmethod
+    def _key(operation, kwargs):
+        body = kwargs.get("body")
+        if isinstance(body, (bytes, bytearray)):
+            body = sha256(body).hexdigest()
+        return digest(operation, kwargs.get("modelId"), body, kwargs.get("accept"), kwargs.get("contentType"))
+
+    def invoke_model(self, **kwargs):
+        key = self._key("invoke_model", kwargs)
+        response = self._flight.do(key, lambda: _buffered(self._client.invoke_model(**kwargs)))
+        return {**response, "body": io.BytesIO(response["body"])}
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        return self._flight.stream(self._key("invoke_model_with_response_stream", kwargs),
+                                   lambda: self._client.invoke_model_with_response_stream(**kwargs))
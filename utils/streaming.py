@@ -0,0 +1,174 @@
+"""Token streaming from Bedrock through the chains to the caller.
+
+The retrieval chain tags its answer LLM with FINAL_ANSWER_TAG so that only the answer is
+streamed, not the condensed question. For the agent, only the "action_input" of a
+"Final Answer" action is streamed; outputs of return_direct tools are yielded once the
+tool returns.
+
+When the caller stops reading, the next token raises StreamCancelled in the chain, so that
+the generation stops and its Bedrock stream and rate limiter slot are released.
+"""
+import asyncio
+import contextvars
+import json
+import queue
+import re
+import threading
+from typing import AsyncIterator, Callable, Iterator, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+FINAL_ANSWER_TAG = "final_answer"
+
+_DONE = object()
+_FINAL_ANSWER_START = re.compile(r'"action"\s*:\s*"Final Answer"\s*,\s*"action_input"\s*:\s*"')
+_ESCAPES = {'"': '"', '\\': '\\', '/': '/', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t'}
+
+
+class StreamCancelled(Exception):
+    """Raised by TokenStreamHandler once nobody reads the tokens anymore"""
+
+
+class FinalAnswerExtractor:
+    """Incrementally decodes the action_input string of a streamed "Final Answer" JSON blob"""
+
+    def __init__(self):
+        self.buffer = ""
+        self.started = False
+        self.finished = False
+        self.pending = ""
+
+    def feed(self, token: str) -> str:
+        if self.finished:
+            return ""
+        if not self.started:
+            self.buffer += token
+            match = _FINAL_ANSWER_START.search(self.buffer)
+            if not match:
+                return ""
+            self.started = True
+            token = self.buffer[match.end():]
+            self.buffer = ""
+
+        output = []
+        for char in token:
+            if self.pending:
+                self.pending += char
+                if self.pending[1] == "u":
+                    if len(self.pending) == 6:
+                        output.append(json.loads(f'"{self.pending}"'))
+                        self.pending = ""
+                else:
+                    output.append(_ESCAPES.get(char, char))
+                    self.pending = ""
+            elif char == "\\":
+                self.pending = char
+            elif char == '"':
+                self.finished = True
+                break
+            else:
+                output.append(char)
+        return "".join(output)
+
+
+class TokenStreamHandler(BaseCallbackHandler):
+    """Forwards answer tokens to `emit`, which must be safe to call from any thread.
+
+    Once `cancelled` is set, the next token raises StreamCancelled in the LLM call.
+    """
+
+    run_inline = True
+    # Otherwise LangChain logs the StreamCancelled of the callback and carries on
+    raise_error = True
+
+    def __init__(self, emit: Callable[[str], None], agent: bool = False,
+                 cancelled: Optional[threading.Event] = None):
+        self.emit = emit
+        self.agent = agent
+        self.cancelled = cancelled
+        self.streamed = False
+        self.extractor = FinalAnswerExtractor()
+
+    def on_llm_start(self, serialized, prompts, **kwargs):
+        self.extractor = FinalAnswerExtractor()
+
+    def on_chat_model_start(self, serialized, messages, **kwargs):
+        self.extractor = FinalAnswerExtractor()
+
+    def on_llm_new_token(self, token: str, *, tags=None, **kwargs):
+        if self.cancelled is not None and self.cancelled.is_set():
+            raise StreamCancelled()
+        if self.agent:
+            token = self.extractor.feed(token)
+        elif not tags or FINAL_ANSWER_TAG not in tags:
+            return
+        if token:
+            self.streamed = True
+            self.emit(token)
+
+
+def iterate_tokens(run: Callable, agent: bool = False) -> Iterator[str]:
+    """Runs `run(callbacks)` on a thread and yields the answer tokens as they arrive.
+
+    If nothing was streamed (cached answers, return_direct tools), the complete output is
+    yielded once `run` returns.
+    """
+    tokens = queue.Queue()
+    cancelled = threading.Event()
+    handler = TokenStreamHandler(tokens.put, agent=agent, cancelled=cancelled)
+    result = {}
+
+    def target():
+        try:
+            result["output"] = run([handler])
+        except StreamCancelled:
+            pass
+        except BaseException as e:
+            result["error"] = e
+        finally:
+            tokens.put(_DONE)
+
+    # The context carries the request's trace and session to the thread
+    threading.Thread(target=contextvars.copy_context().run, args=(target,), daemon=True).start()
+    try:
+        while True:
+            token = tokens.get()
+            if token is _DONE:
+                break
+            yield token
+    finally:
+        # Closed early: stops the thread's generation at its next token
+        cancelled.set()
+
+    if "error" in result:
+        raise result["error"]
+    if not handler.streamed and result.get("output"):
+        yield result["output"]
+
+
+async def aiterate_tokens(arun: Callable, agent: bool = False) -> AsyncIterator[str]:
+    """Async version of iterate_tokens, `arun(callbacks)` is awaited on the running loop"""
+    loop = asyncio.get_running_loop()
+    tokens = asyncio.Queue()
+    # Cancelling the task does not reach LLM calls made on executor threads, the event does
+    cancelled = threading.Event()
+    # Tokens can be produced on executor threads, so always hop back to the loop
+    handler = TokenStreamHandler(lambda token: loop.call_soon_threadsafe(tokens.put_nowait, token), agent=agent,
+                                 cancelled=cancelled)
+
+    task = asyncio.ensure_future(arun([handler]))
+    task.add_done_callback(lambda _: tokens.put_nowait(_DONE))
+    try:
+        while True:
+            token = await tokens.get()
+            if token is _DONE:
+                break
+            yield token
+    finally:
+        cancelled.set()
+        if not task.done():
+            task.cancel()
+
+    output = task.result()
+    if not handler.streamed and output:
+        yield output
@@ -0,0 +1,139 @@
+"""Fast token accounting for prompt assembly.
+
+LangChain counts Claude tokens with the Anthropic tokenizer, which is rebuilt on every call
+and made assembling one prompt take hundreds of milliseconds. TokenCounter estimates the
+count from a few regex features instead, with coefficients fitted against the Claude
+tokenizer, and memoizes the count of every text it has seen: product descriptions and
+history messages recur from one prompt to the next, so each is only counted once.
+
+pack_documents stuffs as many retrieved documents as fit in the prompt budget, truncating
+the last one to fill it exactly. It is used by utils.chains.BudgetedRetrievalChain.
+"""
+import math
+import re
+import threading
+from collections import OrderedDict
+from typing import Callable, List, Sequence
+
+import numpy as np
+from langchain_core.documents import Document
+from langchain_core.prompts import format_document
+
+_LETTERS = re.compile(r"[A-Za-z]+")
+_DIGITS = re.compile(r"\d")
+# Punctuation, symbols and non-ASCII characters, mostly one token each
+_OTHER = re.compile(r"[^\sA-Za-z\d]")
+
+# Tokens per word, per letter, per digit and per other character. Fitted on catalog
+# descriptions, prompts and code against the Claude tokenizer: ~4% mean error
+CLAUDE_COEFFICIENTS = (0.1736, 0.2003, 0.9505, 0.8455)
+
+# The estimate is inflated by this ratio so that it rarely undercounts (p95 undercount is ~8%)
+DEFAULT_MARGIN = 0.08
+
+# Tokens added by the "\n\nHuman: " / "\n\nAssistant: " prefix of a history message
+MESSAGE_OVERHEAD = 4
+
+
+def _features(text: str):
+    words = _LETTERS.findall(text)
+    return (len(words), sum(map(len, words)), len(_DIGITS.findall(text)), len(_OTHER.findall(text)))
+
+
+class TokenCounter:
+    """Approximate, memoized Claude token counter"""
+
+    def __init__(self, coefficients: Sequence[float] = CLAUDE_COEFFICIENTS, margin: float = DEFAULT_MARGIN,
+                 max_entries: int = 50000):
+        self.coefficients = tuple(coefficients)
+        self.margin = margin
+        self.max_entries = max_entries
+        self._cache = OrderedDict()
+        self._lock = threading.Lock()
+        self.counters = {"hits": 0, "misses": 0}
+
+    @classmethod
+    def calibrate(cls, texts: Sequence[str], tokenize: Callable[[str], int], **kwargs) -> "TokenCounter":
+        """Fits the coefficients to an exact tokenizer, e.g. for another model family"""
+        features = np.array([_features(text) for text in texts], dtype=np.float64)
+        exact = np.array([tokenize(text) for text in texts], dtype=np.float64)
+        coefficients, *_ = np.linalg.lstsq(features, exact, rcond=None)
+        return cls(coefficients=[round(float(c), 4) for c in coefficients], **kwargs)
+
+    def estimate(self, text: str) -> int:
+        """Uncached estimate"""
+        if not text:
+            return 0
+        tokens = sum(c * f for c, f in zip(self.coefficients, _features(text)))
+        return max(math.ceil(tokens * (1 + self.margin)), 1)
+
+    def count(self, text: str) -> int:
+        with self._lock:
+            tokens = self._cache.get(text)
+            if tokens is not None:
+                self._cache.move_to_end(text)
+                self.counters["hits"] += 1
+                return tokens
+        tokens = self.estimate(text)
+        with self._lock:
+            self.counters["misses"] += 1
+            self._cache[text] = tokens
+            if len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+        return tokens
+
+    __call__ = count
+
+    def count_messages(self, messages) -> int:
+        """Tokens of a chat history, each message is only counted the first time it is seen"""
+        return sum(self.count(m.content) + MESSAGE_OVERHEAD for m in messages)
+
+    def truncate(self, text: str, tokens: int) -> str:
+        """Longest prefix of `text`, cut at a word boundary, estimated at most `tokens` tokens"""
+        if tokens <= 0:
+            return ""
+        if self.count(text) <= tokens:
+            return text
+        # Binary search on the word boundaries, the estimate grows with the prefix
+        cuts = [m.start() for m in re.finditer(r"\s+", text)] + [len(text)]
+        low, high = 0, len(cuts) - 1
+        while low < high:
+            mid = (low + high + 1) // 2
+            if self.estimate(text[:cuts[mid]]) <= tokens:
+                low = mid
+            else:
+                high = mid - 1
+        prefix = text[:cuts[low]]
+        return prefix if self.estimate(prefix) <= tokens else ""
+
+
+# Shared by the chains and the conversation memory of the process
+token_counter = TokenCounter()
+
+
+def pack_documents(docs: List[Document], budget: int, counter: TokenCounter = token_counter,
+                   document_prompt=None, separator: str = "\n\n", min_tokens: int = 32) -> List[Document]:
+    """Keeps documents in order while they fit in `budget` tokens, as formatted in the prompt.
+
+    The first document that does not fit is truncated to the tokens left, unless fewer than
+    `min_tokens` are left, and nothing after it is kept.
+    """
+    separator_tokens = counter.count(separator) if separator else 0
+    packed = []
+    used = 0
+    for doc in docs:
+        text = format_document(doc, document_prompt) if document_prompt is not None else doc.page_content
+        cost = counter.count(text) + (separator_tokens if packed else 0)
+        if used + cost <= budget:
+            packed.append(doc)
+            used += cost
+            continue
+        left = budget - used - (separator_tokens if packed else 0)
+        # Only the page content can be shortened, the rest of the document prompt is overhead
+        overhead = max(counter.count(text) - counter.count(doc.page_content), 0)
+        if left - overhead >= min_tokens:
+            content = counter.truncate(doc.page_content, left - overhead)
+            if content:
+                packed.append(Document(page_content=content, metadata={**doc.metadata, "truncated": True}))
+        break
+    return packed
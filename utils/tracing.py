@@ -0,0 +1,421 @@
+"""Request tracing and Prometheus-style metrics.
+
+Every LangChainAssistant call runs inside a trace. TracingCallbackHandler turns the
+LangChain callbacks into spans (retrieval, condense and answer LLM calls, agent
+iterations, tools), the retriever adds embedding and vector search spans, and
+InstrumentedBedrockClient reads the token counts Bedrock returns with every response, so
+nothing is re-tokenized. Durations go into per-stage histograms, exposed in the Prometheus
+text format (render_prometheus, write_metrics or start_http_server). Finished traces can
+be appended to a local JSON lines file.
+
+The current trace is a context variable: work handed to a thread only records into it when
+it runs in a copy of the context, with langchain_core's run_in_executor or
+contextvars.copy_context().run.
+"""
+import contextlib
+import contextvars
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from collections import deque
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Dict, Optional
+
+from langchain_core.callbacks import BaseCallbackHandler
+
+from utils.streaming import FINAL_ANSWER_TAG
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+CONDENSE_TAG = "condense_question"
+AGENT_TAG = "agent"
+
+STAGE_METRIC = "shopping_stage_duration_seconds"
+BEDROCK_METRIC = "shopping_bedrock_request_duration_seconds"
+TOKENS_METRIC = "shopping_bedrock_tokens_total"
+ERRORS_METRIC = "shopping_errors_total"
+
+_current_trace = contextvars.ContextVar("current_trace", default=None)
+
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS, window: int = 1000):
+        self.buckets = buckets
+        self.counts = [0] * len(buckets)
+        self.count = 0
+        self.sum = 0.0
+        # Recent samples, for local percentiles without a Prometheus server
+        self.recent = deque(maxlen=window)
+
+    def observe(self, value):
+        self.count += 1
+        self.sum += value
+        self.recent.append(value)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+
+    def percentile(self, q):
+        samples = sorted(self.recent)
+        if not samples:
+            return 0.0
+        return samples[min(len(samples) - 1, int(round(q * (len(samples) - 1))))]
+
+
+class Trace:
+    """Spans and token usage of one assistant call"""
+
+    def __init__(self, name, **attrs):
+        self.trace_id = uuid.uuid4().hex
+        self.name = name
+        self.attrs = attrs
+        self.started = time.time()
+        self._start = time.perf_counter()
+        self.duration = None
+        self.spans = []
+        self.usage = {"input_tokens": 0, "output_tokens": 0, "bedrock_calls": 0}
+        self._lock = threading.Lock()
+
+    def add_span(self, name, start, duration, **attrs):
+        with self._lock:
+            self.spans.append({
+                "name": name,
+                "start_ms": round((start - self._start) * 1000, 3),
+                "duration_ms": round(duration * 1000, 3),
+                **attrs,
+            })
+
+    def add_usage(self, input_tokens, output_tokens):
+        with self._lock:
+            self.usage["input_tokens"] += input_tokens
+            self.usage["output_tokens"] += output_tokens
+            self.usage["bedrock_calls"] += 1
+
+    def to_dict(self):
+        return {
+            "trace_id": self.trace_id,
+            "name": self.name,
+            "timestamp": self.started,
+            "duration_ms": round((self.duration or 0.0) * 1000, 3),
+            **self.attrs,
+            "usage": self.usage,
+            "spans": sorted(self.spans, key=lambda span: span["start_ms"]),
+        }
+
+
+def _labels(labels):
+    return tuple(sorted(labels.items()))
+
+
+def _format_labels(labels, extra=()):
+    items = list(labels) + list(extra)
+    if not items:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in items) + "}"
+
+
+class Tracer:
+    """Process-wide metrics registry and trace exporter"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS, trace_path: Optional[str] = None):
+        self.buckets = buckets
+        self.trace_path = trace_path
+        self._lock = threading.Lock()
+        self._histograms: Dict = {}
+        self._counters: Dict = {}
+        self._server = None
+
+    def configure(self, trace_path: Optional[str] = None, metrics_port: Optional[int] = None,
+                  metrics_host: str = "127.0.0.1"):
+        """Sets the trace file and starts the metrics endpoint, both optional and idempotent"""
+        if trace_path:
+            self.trace_path = trace_path
+        if metrics_port and self._server is None:
+            self.start_http_server(metrics_port, metrics_host)
+
+    def configure_from_env(self, env):
+        # The endpoint is local by default, METRICS_HOST=0.0.0.0 lets another host scrape it
+        self.configure(trace_path=env.get('TRACE_FILE') or None,
+                       metrics_port=int(env['METRICS_PORT']) if env.get('METRICS_PORT') else None,
+                       metrics_host=env.get('METRICS_HOST') or "127.0.0.1")
+
+    def observe(self, name, seconds, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(seconds)
+
+    def inc(self, name, value=1, **labels):
+        key = (name, _labels(labels))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def record_usage(self, model_id, input_tokens, output_tokens):
+        self.inc(TOKENS_METRIC, input_tokens, model=model_id, type="input")
+        self.inc(TOKENS_METRIC, output_tokens, model=model_id, type="output")
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.add_usage(input_tokens, output_tokens)
+
+    def record_span(self, stage, start, duration, trace=None, error=False, **attrs):
+        self.observe(STAGE_METRIC, duration, stage=stage)
+        if error:
+            self.inc(ERRORS_METRIC, stage=stage)
+        trace = trace if trace is not None else _current_trace.get()
+        if trace is not None:
+            trace.add_span(stage, start, duration, error=error, **attrs)
+
+    @contextlib.contextmanager
+    def span(self, stage, **attrs):
+        start = time.perf_counter()
+        error = False
+        try:
+            yield
+        except BaseException:
+            error = True
+            raise
+        finally:
+            self.record_span(stage, start, time.perf_counter() - start, error=error, **attrs)
+
+    @contextlib.contextmanager
+    def trace(self, name, **attrs):
+        trace = Trace(name, **attrs)
+        token = _current_trace.set(trace)
+        error = False
+        try:
+            yield trace
+        except BaseException:
+            error = True
+            raise
+        finally:
+            _current_trace.reset(token)
+            trace.duration = time.perf_counter() - trace._start
+            self.observe(STAGE_METRIC, trace.duration, stage=name)
+            if error:
+                self.inc(ERRORS_METRIC, stage=name)
+            self._export(trace)
+
+    def _export(self, trace):
+        if not self.trace_path:
+            return
+        line = json.dumps(trace.to_dict(), default=str)
+        try:
+            with self._lock, open(self.trace_path, "a") as f:
+                f.write(line + "\n")
+        except OSError as e:
+            logger.warning(f"Could not write trace: {e}")
+
+    def percentiles(self) -> dict:
+        """p50/p95/p99 per stage over the recent samples"""
+        with self._lock:
+            items = [(dict(labels).get("stage"), h) for (name, labels), h in self._histograms.items()
+                     if name == STAGE_METRIC]
+            return {stage: {"count": h.count, "p50": h.percentile(0.5), "p95": h.percentile(0.95),
+                            "p99": h.percentile(0.99)} for stage, h in items}
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+        typed = set()
+        for (name, labels), histogram in histograms:
+            if name not in typed:
+                lines.append(f"# TYPE {name} histogram")
+                typed.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets, histogram.counts):
+                cumulative += count
+                lines.append(f"{name}_bucket{_format_labels(labels, [('le', bound)])} {cumulative}")
+            lines.append(f"{name}_bucket{_format_labels(labels, [('le', '+Inf')])} {histogram.count}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        for (name, labels), value in counters:
+            if name not in typed:
+                lines.append(f"# TYPE {name} counter")
+                typed.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_metrics(self, path):
+        """Writes the metrics for the node_exporter textfile collector"""
+        with open(f"{path}.tmp", "w") as f:
+            f.write(self.render_prometheus())
+        os.replace(f"{path}.tmp", path)
+
+    def start_http_server(self, port, host="127.0.0.1"):
+        tracer = self
+
+        class MetricsHandler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                body = tracer.render_prometheus().encode("utf-8")
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        try:
+            self._server = ThreadingHTTPServer((host, port), MetricsHandler)
+        except OSError as e:
+            # e.g. a second streamlit session in the same process
+            logger.warning(f"Could not start metrics endpoint on {host}:{port}: {e}")
+            return None
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+        return self._server
+
+
+# Shared by every assistant in the process, like the clients in utils.clients
+tracer = Tracer()
+
+
+class TracingCallbackHandler(BaseCallbackHandler):
+    """Records the LangChain runs of one assistant call as spans of `trace`"""
+
+    run_inline = True
+
+    def __init__(self, tracer: Tracer, trace: Optional[Trace] = None):
+        self.tracer = tracer
+        self.trace = trace
+        self._runs = {}
+        self._iteration_start = None
+        self.iterations = 0
+
+    def _start(self, run_id, stage, **attrs):
+        self._runs[run_id] = (stage, time.perf_counter(), attrs)
+
+    def _end(self, run_id, error=False, **attrs):
+        run = self._runs.pop(run_id, None)
+        if run is None:
+            return
+        stage, start, start_attrs = run
+        self.tracer.record_span(stage, start, time.perf_counter() - start, trace=self.trace, error=error,
+                                **start_attrs, **attrs)
+
+    def _llm_stage(self, tags):
+        tags = tags or []
+        if FINAL_ANSWER_TAG in tags:
+            return "llm.answer"
+        if CONDENSE_TAG in tags:
+            return "llm.condense"
+        if AGENT_TAG in tags:
+            return "llm.agent"
+        return "llm"
+
+    def _on_llm_start(self, run_id, tags):
+        stage = self._llm_stage(tags)
+        if stage == "llm.agent" and self._iteration_start is None:
+            # An agent iteration is one LLM call plus the tool it picks
+            self._iteration_start = time.perf_counter()
+            self.iterations += 1
+        self._start(run_id, stage)
+
+    def _end_iteration(self):
+        if self._iteration_start is not None:
+            start, self._iteration_start = self._iteration_start, None
+            self.tracer.record_span("agent_iteration", start, time.perf_counter() - start, trace=self.trace,
+                                    iteration=self.iterations)
+
+    def on_llm_start(self, serialized, prompts, *, run_id, tags=None, **kwargs):
+        self._on_llm_start(run_id, tags)
+
+    def on_chat_model_start(self, serialized, messages, *, run_id, tags=None, **kwargs):
+        self._on_llm_start(run_id, tags)
+
+    def on_llm_end(self, response, *, run_id, **kwargs):
+        self._end(run_id)
+
+    def on_llm_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_retriever_start(self, serialized, query, *, run_id, **kwargs):
+        self._start(run_id, "retrieval")
+
+    def on_retriever_end(self, documents, *, run_id, **kwargs):
+        self._end(run_id, documents=len(documents))
+
+    def on_retriever_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+
+    def on_tool_start(self, serialized, input_str, *, run_id, **kwargs):
+        self._start(run_id, f"tool.{serialized.get('name', 'unknown')}")
+
+    def on_tool_end(self, output, *, run_id, **kwargs):
+        self._end(run_id)
+        self._end_iteration()
+
+    def on_tool_error(self, error, *, run_id, **kwargs):
+        self._end(run_id, error=True)
+        self._end_iteration()
+
+    def on_agent_finish(self, finish, *, run_id, **kwargs):
+        self._end_iteration()
+
+
+class InstrumentedBedrockClient:
+    """Wraps a bedrock-runtime client to time requests and count the tokens Bedrock reports.
+
+    Token counts come from the x-amzn-bedrock-*-token-count response headers, or from the
+    invocation metrics Bedrock appends to the last chunk of a response stream.
+    """
+
+    def __init__(self, client, tracer: Tracer = tracer):
+        self._client = client
+        self._tracer = tracer
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def invoke_model(self, **kwargs):
+        model_id = kwargs.get("modelId", "unknown")
+        start = time.perf_counter()
+        try:
+            response = self._client.invoke_model(**kwargs)
+        except Exception:
+            self._tracer.inc(ERRORS_METRIC, stage=f"bedrock:{model_id}")
+            raise
+        self._tracer.observe(BEDROCK_METRIC, time.perf_counter() - start, model=model_id, api="invoke_model")
+        headers = response.get("ResponseMetadata", {}).get("HTTPHeaders", {})
+        if "x-amzn-bedrock-input-token-count" in headers:
+            self._tracer.record_usage(model_id, int(headers["x-amzn-bedrock-input-token-count"]),
+                                      int(headers.get("x-amzn-bedrock-output-token-count", 0)))
+        return response
+
+    def invoke_model_with_response_stream(self, **kwargs):
+        model_id = kwargs.get("modelId", "unknown")
+        start = time.perf_counter()
+        try:
+            response = self._client.invoke_model_with_response_stream(**kwargs)
+        except Exception:
+            self._tracer.inc(ERRORS_METRIC, stage=f"bedrock:{model_id}")
+            raise
+        response["body"] = self._watch_stream(model_id, response["body"], start)
+        return response
+
+    def _watch_stream(self, model_id, stream, start):
+        first = True
+        for event in stream:
+            chunk = event.get("chunk")
+            if first and chunk:
+                first = False
+                self._tracer.observe(BEDROCK_METRIC, time.perf_counter() - start, model=model_id,
+                                     api="first_token")
+            # Only the last chunk carries the metrics, skip decoding the others
+            if chunk and b"invocationMetrics" in chunk.get("bytes", b""):
+                metrics = json.loads(chunk["bytes"]).get("amazon-bedrock-invocationMetrics", {})
+                self._tracer.record_usage(model_id, metrics.get("inputTokenCount", 0),
+                                          metrics.get("outputTokenCount", 0))
+            yield event
+        self._tracer.observe(BEDROCK_METRIC, time.perf_counter() - start, model=model_id,
+                             api="invoke_model_with_response_stream")